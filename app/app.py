@@ -1,8 +1,15 @@
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request
+import os
+import sys
 import requests
 from datetime import datetime, timedelta
 import pymysql.cursors
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import METRICS
+from upstream import ARPAE_API_URL, arpae_params, upstream_client
+
 
 app = Flask(__name__)
 
@@ -41,10 +48,13 @@ def home():
     selected_date = request.args.get('date', today)  # Data odierna come predefinita
     selected_station = request.args.get('station')  # Aggiunto per la stazione selezionata
 
-    api_url = f'https://apps.arpae.it/REST/meteo_osservati?where={{"anagrafica.variabili":"livello_idro"}}&projection={{"dati.{selected_date}":1,"anagrafica":1}}&max_results=1000'
-    response = requests.get(api_url)
+    try:
+        response = upstream_client().get(ARPAE_API_URL, params=arpae_params(selected_date, max_results=1000))
+    except requests.RequestException as e:
+        print(f"Errore durante il recupero dei dati dall'API: {e}")
+        response = None
     
-    if response.status_code == 200:
+    if response is not None:
         data = response.json()  # Dati JSON
         
         # stations = data['_items']  # Salva le stazioni
@@ -99,5 +109,10 @@ def home():
                            selected_station=selected_station, today=today, yesterday=yesterday, twodaysbefore=twodaysbefore, 
                            oggi=oggi, ieri=ieri, altroieri=altroieri)
 
+@app.route('/metrics')
+def metrics():
+    # Stato del client ARPAE (richieste, ritentativi, circuit breaker) in formato Prometheus
+    return Response(METRICS.render(), mimetype='text/plain')
+
 if __name__ == '__main__':
     app.run(debug=True)
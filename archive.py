@@ -0,0 +1,175 @@
+"""Archivio delle risposte grezze dell'API ARPAE, per registrare e rigiocare le importazioni.
+
+Ogni interrogazione viene salvata compressa in gzip come
+    <archive_dir>/<YYYYMMDD>/<YYYYMMDDTHHMMSS>_<sha256>[_parziale].json.gz
+cioè per data richiesta, istante di download e impronta del contenuto: una
+risposta identica a una già archiviata per la stessa data non viene riscritta.
+Un archivio contiene sempre un'interrogazione intera: le pagine di una query
+paginata vengono scritte nello stesso file man mano che arrivano
+(ArchiveItemsWriter) e le query di più variabili vengono archiviate già unite
+(save_items). Le interrogazioni che non coprono tutte le stazioni e tutta la
+giornata (fetch delta, query filtrate) sono marcate _parziale, così
+l'ultimo archivio completo di una data si trova senza aprirli.
+
+Solo le risposte a pagina unica (save) conservano i byte ricevuti. Le query
+paginate e quelle di più variabili archiviano gli item già decodificati e
+riserializzati in JSON compatto: il rigioco ne ricostruisce gli stessi valori,
+ma non i byte originali, e l'impronta nel nome del file dipende dalla
+modalità di download. La stessa giornata scaricata in modi diversi produce
+quindi archivi distinti, che non vengono riconosciuti come duplicati.
+"""
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+try:
+    import ijson
+except ImportError:  # senza ijson l'archivio viene letto per intero
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIX = '.json.gz'
+# Marca degli archivi di interrogazioni parziali (slot o stazioni ristretti)
+PARTIAL_MARK = '_parziale'
+
+class ResponseArchive:
+    """Archivio su disco delle risposte grezze, indirizzato per data e contenuto."""
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+
+    def _date_dir(self, selected_date: str) -> str:
+        return os.path.join(self.archive_dir, selected_date)
+
+    def _final_path(self, selected_date: str, fetched_at: datetime, digest: str,
+                    partial: bool = False) -> Optional[str]:
+        """Percorso definitivo dell'archivio, o None se lo stesso contenuto è già presente."""
+        if glob.glob(os.path.join(self._date_dir(selected_date), f"*_{digest}*{ARCHIVE_SUFFIX}")):
+            return None
+        marca = PARTIAL_MARK if partial else ''
+        return os.path.join(self._date_dir(selected_date),
+                            f"{fetched_at:%Y%m%dT%H%M%S}_{digest}{marca}{ARCHIVE_SUFFIX}")
+
+    def save(self, selected_date: str, body: bytes, fetched_at: Optional[datetime] = None,
+             partial: bool = False) -> Optional[str]:
+        """Archivia il corpo di una risposta già scaricata; restituisce il file scritto."""
+        fetched_at = fetched_at or datetime.now()
+        path = self._final_path(selected_date, fetched_at, hashlib.sha256(body).hexdigest(), partial)
+        if path is None:
+            logger.info(f"Risposta del {selected_date} già archiviata, non riscritta")
+            return None
+        os.makedirs(self._date_dir(selected_date), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        logger.info(f"Risposta archiviata: {path} ({len(body)} byte)")
+        return path
+
+    def save_items(self, selected_date: str, items: List[Dict[str, Any]], partial: bool = False) -> Optional[str]:
+        """Archivia come un'unica risposta le stazioni di un'interrogazione (es. più variabili unite)."""
+        corpo = json.dumps({'_items': items}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return self.save(selected_date, corpo, partial=partial)
+
+    def tee(self, selected_date: str, stream: BinaryIO, partial: bool = False) -> 'ArchiveTee':
+        """Avvolge uno stream di risposta: ciò che viene letto viene anche archiviato."""
+        os.makedirs(self._date_dir(selected_date), exist_ok=True)
+        return ArchiveTee(self, selected_date, stream, partial)
+
+    def writer(self, selected_date: str, partial: bool = False) -> 'ArchiveItemsWriter':
+        """Archivio in cui aggiungere le stazioni di una query paginata man mano che arrivano."""
+        os.makedirs(self._date_dir(selected_date), exist_ok=True)
+        return ArchiveItemsWriter(self, selected_date, partial)
+
+    def list_archives(self, selected_date: str, complete_only: bool = False) -> List[str]:
+        """Archivi della data in ordine di download (con complete_only, esclusi quelli parziali)."""
+        percorsi = sorted(glob.glob(os.path.join(self._date_dir(selected_date), f"*{ARCHIVE_SUFFIX}")))
+        if complete_only:
+            percorsi = [p for p in percorsi if not p.endswith(PARTIAL_MARK + ARCHIVE_SUFFIX)]
+        return percorsi
+
+    def iter_items(self, path: str) -> Iterator[Dict[str, Any]]:
+        """Restituisce una alla volta le stazioni (_items) di un archivio."""
+        with gzip.open(path, 'rb') as f:
+            if ijson is not None:
+                yield from ijson.items(f, '_items.item', use_float=True)
+            else:
+                yield from json.load(f).get('_items', [])
+
+class _PendingArchive:
+    """Archivio gzip temporaneo scritto a pezzi.
+
+    close() lo rende definitivo (se l'interrogazione è stata letta tutta),
+    discard() lo elimina, ad esempio dopo un errore di rete.
+    """
+
+    def __init__(self, archive: ResponseArchive, selected_date: str, partial: bool = False):
+        self.archive = archive
+        self.selected_date = selected_date
+        self.partial = partial
+        self.fetched_at = datetime.now()
+        self.bytes_read = 0
+        self._hash = hashlib.sha256()
+        self._tmp_path = os.path.join(
+            archive._date_dir(selected_date), f".{self.fetched_at:%Y%m%dT%H%M%S}_{os.getpid()}_{id(self)}.tmp"
+        )
+        self._file = gzip.open(self._tmp_path, 'wb')
+
+    def _write(self, data: bytes) -> None:
+        self._hash.update(data)
+        self._file.write(data)
+        self.bytes_read += len(data)
+
+    def close(self) -> Optional[str]:
+        self._file.close()
+        path = self.archive._final_path(self.selected_date, self.fetched_at, self._hash.hexdigest(), self.partial)
+        if path is None:
+            os.remove(self._tmp_path)
+            logger.info(f"Risposta del {self.selected_date} già archiviata, non riscritta")
+            return None
+        os.replace(self._tmp_path, path)
+        logger.info(f"Risposta archiviata: {path} ({self.bytes_read} byte)")
+        return path
+
+    def discard(self) -> None:
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+class ArchiveTee(_PendingArchive):
+    """Stream in lettura che copia i byte letti in un archivio gzip temporaneo."""
+
+    def __init__(self, archive: ResponseArchive, selected_date: str, stream: BinaryIO, partial: bool = False):
+        super().__init__(archive, selected_date, partial)
+        self.stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        if data:
+            self._write(data)
+        return data
+
+class ArchiveItemsWriter(_PendingArchive):
+    """Archivio di un'unica risposta {"_items": [...]} composto dalle pagine di una query."""
+
+    def __init__(self, archive: ResponseArchive, selected_date: str, partial: bool = False):
+        super().__init__(archive, selected_date, partial)
+        self._items = 0
+        self._write(b'{"_items":[')
+
+    def add(self, items: List[Dict[str, Any]]) -> None:
+        for item in items:
+            if self._items:
+                self._write(b',')
+            self._write(json.dumps(item, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            self._items += 1
+
+    def close(self) -> Optional[str]:
+        self._write(b']}')
+        return super().close()
@@ -0,0 +1,231 @@
+"""Interrogazioni concorrenti all'API ARPAE per più variabili, più date e più pagine.
+
+Ogni coppia (data, variabile) è una query ARPAE distinta; fetch_merged le
+esegue insieme in un event loop asyncio, limitate da un semaforo, così il
+costo complessivo è vicino alla latenza di una sola richiesta. Le richieste
+passano dal client condiviso (ritentativi e circuit breaker) in un thread
+del pool di asyncio. Le stazioni restituite da più query vengono unite in un
+solo item per data prima di arrivare al database.
+
+Con page_size le query vengono paginate (parametri page/max_results dell'API,
+sempre con un ordinamento stabile per _id):
+iter_paged_items scarica le pagine in parallelo e restituisce le stazioni man
+mano che le pagine arrivano, con al massimo concurrency pagine in memoria.
+Tutte le funzioni accettano filters, condizioni aggiunte alla where di ogni
+query (es. le stazioni di un solo shard dell'importazione parallela).
+"""
+import asyncio
+import json
+import logging
+import math
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from archive import ResponseArchive
+from metrics import METRICS, IngestMetrics
+from upstream import ARPAE_API_URL, DEFAULT_VARIABLE, UpstreamClient, arpae_params, upstream_client
+
+logger = logging.getLogger(__name__)
+
+def download_page(client: UpstreamClient, selected_date: str, variable: str, page: Optional[int],
+                  page_size: Optional[int], metrics: IngestMetrics, slots: Optional[List[str]] = None,
+                  filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Scarica e decodifica una pagina (o, senza page, l'intera risposta)."""
+    params = arpae_params(selected_date, variable, max_results=page_size, page=page, slots=slots,
+                          filters=filters) if page_size \
+        else arpae_params(selected_date, variable, slots=slots, filters=filters)
+    with metrics.time('http'):
+        response = client.get(ARPAE_API_URL, params)
+        corpo = response.content
+    metrics.inc('bytes_downloaded_total', len(corpo))
+    with metrics.time('json'):
+        risposta = json.loads(corpo)
+    metrics.inc('items_parsed_total', len(risposta.get('_items', [])))
+    return risposta
+
+def page_count(risposta: Dict[str, Any], page_size: int) -> Optional[int]:
+    """Numero di pagine secondo _meta.total della prima pagina, se indicato."""
+    totale = (risposta.get('_meta') or {}).get('total')
+    if totale is None:
+        return None
+    return max(1, math.ceil(totale / page_size))
+
+def iter_paged_items(selected_date: str, variable: str = DEFAULT_VARIABLE, page_size: int = 1000,
+                     concurrency: int = 4, client: Optional[UpstreamClient] = None,
+                     archive: Optional[ResponseArchive] = None, metrics: Optional[IngestMetrics] = None,
+                     slots: Optional[List[str]] = None,
+                     filters: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """Restituisce le stazioni di una query paginata man mano che le pagine arrivano.
+
+    Le pagine vengono aggiunte a un solo archivio, reso definitivo solo se la
+    query è stata consumata per intero.
+    """
+    archivio = archive.writer(selected_date, partial=bool(slots or filters)) if archive is not None else None
+    try:
+        for items in _iter_pages(selected_date, variable, page_size, concurrency, client or upstream_client(),
+                                 metrics or METRICS, slots, filters):
+            if archivio is not None:
+                archivio.add(items)
+            yield from items
+    except BaseException:
+        if archivio is not None:
+            archivio.discard()
+        raise
+    if archivio is not None:
+        archivio.close()
+
+def _iter_pages(selected_date: str, variable: str, page_size: int, concurrency: int, client: UpstreamClient,
+                metrics: IngestMetrics, slots: Optional[List[str]],
+                filters: Optional[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+    """Restituisce le stazioni di ogni pagina, nell'ordine di arrivo.
+
+    La prima pagina indica il totale; le successive vengono scaricate in
+    parallelo con una finestra di concurrency pagine, che si sposta solo
+    quando il chiamante ha consumato le stazioni già ricevute. Senza _meta.total
+    le pagine vengono seguite in sequenza finché una non risulta incompleta.
+    """
+    prima = download_page(client, selected_date, variable, 1, page_size, metrics, slots, filters)
+    pagine = page_count(prima, page_size)
+    if pagine is None:
+        logger.warning(f"Risposta ARPAE senza _meta.total: pagine del {selected_date} scaricate in sequenza")
+        risposta, pagina = prima, 1
+        while True:
+            items = risposta.get('_items', [])
+            yield items
+            if len(items) < page_size:
+                return
+            pagina += 1
+            risposta = download_page(client, selected_date, variable, pagina, page_size, metrics, slots, filters)
+
+    logger.info(f"Query {variable} del {selected_date}: {prima['_meta']['total']} stazioni in {pagine} pagine")
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='arpae-page') as pool:
+        prossima = 2
+        in_corso = set()
+
+        def riempi() -> None:
+            nonlocal prossima
+            while prossima <= pagine and len(in_corso) < concurrency:
+                in_corso.add(pool.submit(download_page, client, selected_date, variable, prossima,
+                                         page_size, metrics, slots, filters))
+                prossima += 1
+
+        # Le pagine successive partono prima di restituire la prima
+        riempi()
+        yield prima.get('_items', [])
+        while in_corso:
+            completate, in_corso = wait(in_corso, return_when=FIRST_COMPLETED)
+            for future in completate:
+                items = future.result().get('_items', [])
+                riempi()
+                yield items
+
+def merge_items(item_lists: Iterable[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Unisce per stazione (_id) gli item di più risposte, nell'ordine in cui compaiono.
+
+    L'anagrafica è quella del primo item; le misurazioni vengono unite per
+    data e per ora, quindi una stazione multifunzione restituita dalle query
+    di più variabili produce un solo item con tutti i suoi valori.
+    """
+    unite: Dict[str, Dict[str, Any]] = {}
+    for items in item_lists:
+        for item in items:
+            chiave = str(item['_id']) if isinstance(item, dict) and '_id' in item else None
+            if chiave is None:
+                # Gli item malformati passano così come sono e finiranno negli scarti
+                unite[f"#{len(unite)}"] = item
+                continue
+            try:
+                esistente = unite.get(chiave)
+                if esistente is None:
+                    unite[chiave] = dict(item, dati={
+                        data: {ora: dict(valori) for ora, valori in giornata.items()}
+                        for data, giornata in (item.get('dati') or {}).items()
+                    })
+                    continue
+                for data, giornata in (item.get('dati') or {}).items():
+                    destinazione = esistente['dati'].setdefault(data, {})
+                    for ora, valori in giornata.items():
+                        destinazione.setdefault(ora, {}).update(valori)
+            except (AttributeError, TypeError, ValueError):
+                # dati non strutturati come {data: {HHMM: {variabile: valore}}}
+                unite[f"#{len(unite)}"] = item
+    return list(unite.values())
+
+async def _fetch_page(client: UpstreamClient, semaforo: asyncio.Semaphore, selected_date: str, variable: str,
+                      page: Optional[int], page_size: Optional[int], metrics: IngestMetrics,
+                      slots: Optional[List[str]], filters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    async with semaforo:
+        return await asyncio.to_thread(download_page, client, selected_date, variable, page, page_size,
+                                       metrics, slots, filters)
+
+async def _fetch_one(client: UpstreamClient, semaforo: asyncio.Semaphore, selected_date: str, variable: str,
+                     page_size: Optional[int], metrics: IngestMetrics,
+                     slots: Optional[List[str]], filters: Optional[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+    if not page_size:
+        risposta = await _fetch_page(client, semaforo, selected_date, variable, None, None, metrics,
+                                     slots, filters)
+        items = risposta.get('_items', [])
+    else:
+        prima = await _fetch_page(client, semaforo, selected_date, variable, 1, page_size, metrics,
+                                  slots, filters)
+        items = list(prima.get('_items', []))
+        pagine = page_count(prima, page_size)
+        if pagine is None:
+            # Senza totale si seguono le pagine finché una non risulta incompleta
+            pagina, ultima = 1, prima
+            while len(ultima.get('_items', [])) == page_size:
+                pagina += 1
+                ultima = await _fetch_page(client, semaforo, selected_date, variable, pagina, page_size,
+                                           metrics, slots, filters)
+                items.extend(ultima.get('_items', []))
+        else:
+            for risposta in await asyncio.gather(*(
+                _fetch_page(client, semaforo, selected_date, variable, p, page_size, metrics, slots, filters)
+                for p in range(2, pagine + 1)
+            )):
+                items.extend(risposta.get('_items', []))
+    logger.info(f"Query {variable} del {selected_date}: {len(items)} stazioni")
+    return selected_date, items
+
+async def fetch_merged_async(dates: List[str], variables: List[str], concurrency: int = 4,
+                             client: Optional[UpstreamClient] = None, archive: Optional[ResponseArchive] = None,
+                             metrics: Optional[IngestMetrics] = None, page_size: Optional[int] = None,
+                             slots: Optional[Dict[str, List[str]]] = None,
+                             filters: Optional[Dict[str, Any]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """Esegue in parallelo le query di tutte le date e variabili; restituisce gli item uniti per data.
+
+    Con page_size ogni query viene scaricata a pagine, anch'esse in parallelo;
+    slots indica per alcune date le sole chiavi HHMM da proiettare. Con archive
+    ogni data viene archiviata una volta, a query completate e unite.
+
+    Se una query fallisce l'errore viene propagato e nessuna data viene
+    restituita: una data con una variabile mancante non va scritta come completa.
+    """
+    client = client or upstream_client()
+    metrics = metrics or METRICS
+    slots = slots or {}
+    semaforo = asyncio.Semaphore(concurrency)
+    risultati = await asyncio.gather(*(
+        _fetch_one(client, semaforo, d, v, page_size, metrics, slots.get(d), filters)
+        for d in dates for v in variables
+    ))
+
+    per_data: Dict[str, List[List[Dict[str, Any]]]] = {d: [] for d in dates}
+    for selected_date, items in risultati:
+        per_data[selected_date].append(items)
+    unite = {d: merge_items(liste) for d, liste in per_data.items()}
+    if archive is not None:
+        # Un archivio per data con le variabili già unite, come le riceve il loader
+        for selected_date, items in unite.items():
+            archive.save_items(selected_date, items, partial=bool(slots.get(selected_date) or filters))
+    return unite
+
+def fetch_merged(dates: List[str], variables: List[str], concurrency: int = 4,
+                 client: Optional[UpstreamClient] = None, archive: Optional[ResponseArchive] = None,
+                 metrics: Optional[IngestMetrics] = None, page_size: Optional[int] = None,
+                 slots: Optional[Dict[str, List[str]]] = None,
+                 filters: Optional[Dict[str, Any]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """Versione sincrona di fetch_merged_async, da chiamare fuori da un event loop."""
+    return asyncio.run(fetch_merged_async(dates, variables, concurrency=concurrency, client=client,
+                                          archive=archive, metrics=metrics, page_size=page_size, slots=slots,
+                                          filters=filters))
@@ -0,0 +1,94 @@
+"""Benchmark della scrittura delle misurazioni: upsert multi-riga contro bulk_upsert.
+
+Scrive un blocco di misurazioni sintetiche (stazioni 'bench-*') nella tabella
+misurazioni del backend configurato, prima con storage.upsert a batch di
+--batch-size righe e poi con storage.bulk_upsert in una sola chiamata; ogni
+strategia esegue un inserimento e un aggiornamento degli stessi valori. Le
+righe di prova vengono cancellate alla fine. Su MySQL bulk_upsert usa LOAD
+DATA LOCAL INFILE (richiede local_infile=ON sul server); sugli altri backend
+coincide con upsert. Con lo schema compatto le righe usano gli id di
+tipi_misurazione, registrando i tipi di prova se mancano.
+
+Uso (dalla cartella del progetto):
+    python benchmarks/bench_bulk.py [--backend mysql] [--stazioni 200] [--giorni 7] [--batch-size 1000]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+from database import (COMPACT_MEASUREMENT_COLUMNS, COMPACT_MEASUREMENT_KEY_COLUMNS, HHMM_SLOTS,
+                      MEASUREMENT_COLUMNS, MEASUREMENT_KEY_COLUMNS)
+from storage import STORAGE_BACKENDS, create_storage
+
+INIZIO = datetime(2024, 1, 1)
+TIPI = ('livello_idro', 'temperatura_istantanea_2m')
+
+def synthetic_rows(stazioni: int, giorni: int, scarto: float = 0.0, tipo_ids=None):
+    """Righe nel formato di MEASUREMENT_COLUMNS, o di COMPACT_MEASUREMENT_COLUMNS se tipo_ids è dato."""
+    righe = []
+    for s in range(stazioni):
+        for g in range(giorni):
+            giorno = INIZIO + timedelta(days=g)
+            for i, hhmm in enumerate(HHMM_SLOTS):
+                ts = giorno.replace(hour=int(hhmm[:2]), minute=int(hhmm[2:]))
+                for tipo in TIPI:
+                    valore = round(1.0 + s / 1000 + i / 100 + scarto, 2)
+                    if tipo_ids:
+                        righe.append((f"bench-{s}", ts, tipo_ids[tipo], valore))
+                    else:
+                        righe.append((f"bench-{s}", ts, ts.date(), f"{hhmm[:2]}:{hhmm[2:]}:00", tipo, valore))
+    return righe
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=STORAGE_BACKENDS, help="Database di prova (default: DB_BACKEND)")
+    parser.add_argument('--db-path', help="File del database per i backend sqlite e duckdb")
+    parser.add_argument('--stazioni', type=int, default=200)
+    parser.add_argument('--giorni', type=int, default=7)
+    parser.add_argument('--batch-size', type=int, default=1000, help="Righe per upsert multi-riga")
+    args = parser.parse_args()
+
+    load_dotenv()
+    storage = create_storage(args.backend, args.db_path)
+    storage.ensure_schema()
+    colonne, chiave, tipo_ids = MEASUREMENT_COLUMNS, MEASUREMENT_KEY_COLUMNS, None
+    if storage.compact_measurements:
+        colonne, chiave = COMPACT_MEASUREMENT_COLUMNS, COMPACT_MEASUREMENT_KEY_COLUMNS
+        tipo_ids = {tipo: storage.measurement_type_id(tipo) for tipo in TIPI}
+        storage.commit()
+
+    def pulisci():
+        storage.execute("DELETE FROM misurazioni WHERE stazione_id LIKE %s", ('bench-%',))
+        storage.commit()
+
+    def righe_a_batch(righe):
+        for i in range(0, len(righe), args.batch_size):
+            storage.upsert('misurazioni', colonne, chiave, righe[i:i + args.batch_size])
+
+    def bulk(righe):
+        storage.bulk_upsert('misurazioni', colonne, chiave, righe)
+
+    blocchi = (synthetic_rows(args.stazioni, args.giorni, tipo_ids=tipo_ids),
+               synthetic_rows(args.stazioni, args.giorni, 0.5, tipo_ids=tipo_ids))
+    n = len(blocchi[0])
+    try:
+        pulisci()
+        for nome, scrivi in ((f'upsert x{args.batch_size}', righe_a_batch), ('bulk_upsert', bulk)):
+            for fase, righe in zip(('inserimento', 'aggiornamento'), blocchi):
+                inizio = time.perf_counter()
+                scrivi(righe)
+                storage.commit()
+                durata = time.perf_counter() - inizio
+                print(f"{nome:>16} {fase:>13}: {durata:7.2f}s  ({n / durata:,.0f} righe/s)")
+            pulisci()
+    finally:
+        storage.close()
+
+if __name__ == '__main__':
+    main()
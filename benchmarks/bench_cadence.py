@@ -0,0 +1,76 @@
+"""Simulazione della cadenza di interrogazione: griglia fissa contro PublicationModel.
+
+Gli slot semiorari vengono pubblicati con un ritardo casuale (media e
+deviazione configurabili); per ogni strategia si contano le richieste
+all'API e la freschezza dei dati, cioè il tempo tra la pubblicazione di uno
+slot e il ciclo che lo vede.
+
+Uso (dalla cartella del progetto):
+    python benchmarks/bench_cadence.py [--giorni 7] [--ritardo 1500] [--jitter 180]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cadence import SLOT_MINUTES, PublicationModel
+
+INIZIO = datetime(2024, 10, 30)
+
+def publication_times(giorni: int, ritardo: float, jitter: float, seed: int = 1):
+    """Coppie (slot, istante di pubblicazione) per il periodo simulato."""
+    rnd = random.Random(seed)
+    slot = INIZIO
+    pubblicazioni = []
+    while slot < INIZIO + timedelta(days=giorni):
+        pubblicazioni.append((slot, slot + timedelta(seconds=max(0.0, rnd.gauss(ritardo, jitter)))))
+        slot += timedelta(minutes=SLOT_MINUTES)
+    return pubblicazioni
+
+def simulate(pubblicazioni, next_delay):
+    """Esegue le interrogazioni; next_delay(adesso, ultimo_slot) restituisce l'attesa in secondi."""
+    adesso = INIZIO
+    fine = pubblicazioni[-1][1]
+    richieste = 0
+    visti = 0
+    freschezza = []
+    while adesso <= fine:
+        richieste += 1
+        while visti < len(pubblicazioni) and pubblicazioni[visti][1] <= adesso:
+            freschezza.append((adesso - pubblicazioni[visti][1]).total_seconds())
+            visti += 1
+        ultimo = pubblicazioni[visti - 1][0] if visti else None
+        adesso += timedelta(seconds=next_delay(adesso, ultimo))
+    return richieste, freschezza
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--giorni', type=int, default=7)
+    parser.add_argument('--ritardo', type=float, default=1500, help="Ritardo medio di pubblicazione (s)")
+    parser.add_argument('--jitter', type=float, default=180, help="Deviazione standard del ritardo (s)")
+    args = parser.parse_args()
+
+    pubblicazioni = publication_times(args.giorni, args.ritardo, args.jitter)
+    strategie = {
+        'fissa 30 min': lambda adesso, ultimo: 1800,
+        'fissa 5 min': lambda adesso, ultimo: 300,
+    }
+    modello = PublicationModel(default_lag=1200, dense_interval=60, dense_window=900, min_wait=30, max_wait=1800)
+
+    def adattiva(adesso, ultimo):
+        modello.observe(ultimo, adesso)
+        return modello.next_delay(adesso)
+    strategie['adattiva'] = adattiva
+
+    for nome, strategia in strategie.items():
+        richieste, freschezza = simulate(pubblicazioni, strategia)
+        print(f"{nome:>14}: {richieste / args.giorni:6.0f} richieste/giorno, "
+              f"freschezza mediana {statistics.median(freschezza):6.0f}s, "
+              f"p95 {sorted(freschezza)[int(len(freschezza) * 0.95)]:6.0f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Micro-benchmark della decodifica dei timestamp delle misurazioni ARPAE.
+
+Confronta la decodifica originale di insert_measurements (tre strptime per ogni
+chiave HHMM) con decode_day_block su una giornata sintetica di 1000 stazioni.
+
+Uso (dalla cartella del progetto):
+    python benchmarks/bench_decode.py [--stazioni 1000] [--ripetizioni 5]
+"""
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import HHMM_SLOTS, decode_day_block
+
+DATE_STR = '20241030'
+TIPI = ('livello_idro', 'temperatura_istantanea_2m')
+
+def synthetic_day(stazioni: int):
+    """Blocchi giornalieri {HHMM: {tipo: valore}} per il numero di stazioni richiesto."""
+    return [
+        {hhmm: {tipo: round(1.0 + s / 1000 + i / 100, 2) for tipo in TIPI} for i, hhmm in enumerate(HHMM_SLOTS)}
+        for s in range(stazioni)
+    ]
+
+def legacy_decode(date_str, day_block):
+    """Decodifica come faceva insert_measurements prima dello stadio precalcolato."""
+    righe = []
+    data_formattata_singola = datetime.strptime(date_str, '%Y%m%d').date()
+    for ora, misurazioni in day_block.items():
+        ora_formattata_singola = f"{ora[:2]}:{ora[2:]}:00"
+        ora_formattata = f"{ora[:2]}:{ora[2:]}:00"
+        data_formattata = datetime.strptime(f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:]}", '%Y-%m-%d').date()
+        data_ora_rilevazione = datetime.combine(data_formattata, datetime.strptime(ora_formattata, '%H:%M:%S').time())
+        for tipo_mis, valore in misurazioni.items():
+            righe.append((data_ora_rilevazione, data_formattata_singola, ora_formattata_singola, tipo_mis, valore))
+    return righe
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stazioni', type=int, default=1000)
+    parser.add_argument('--ripetizioni', type=int, default=5)
+    args = parser.parse_args()
+
+    giornata = synthetic_day(args.stazioni)
+
+    # Verifica che le due decodifiche producano le stesse righe
+    for blocco in giornata[:10]:
+        decodificata = decode_day_block(DATE_STR, blocco)
+        nuove = [
+            (ts, decodificata.data, ora, tipo, valore)
+            for ts, ora, tipo, valore in zip(decodificata.timestamps, decodificata.ore,
+                                             decodificata.tipi, decodificata.valori)
+        ]
+        assert nuove == legacy_decode(DATE_STR, blocco)
+
+    misurazioni = args.stazioni * len(HHMM_SLOTS) * len(TIPI)
+    risultati = {}
+    for nome, decode in (('strptime', legacy_decode), ('decode_day_block', decode_day_block)):
+        tempi = timeit.repeat(lambda: [decode(DATE_STR, blocco) for blocco in giornata],
+                              number=1, repeat=args.ripetizioni)
+        risultati[nome] = min(tempi)
+        print(f"{nome:>18}: {risultati[nome] * 1000:8.1f} ms  ({misurazioni / risultati[nome]:,.0f} misurazioni/s)")
+
+    print(f"{'speed-up':>18}: {risultati['strptime'] / risultati['decode_day_block']:.1f}x "
+          f"su {args.stazioni} stazioni, {misurazioni} misurazioni")
+
+if __name__ == '__main__':
+    main()
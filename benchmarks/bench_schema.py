@@ -0,0 +1,77 @@
+"""Benchmark dell'occupazione su disco: misurazioni legacy contro schema compatto.
+
+Scrive le stesse misurazioni sintetiche di bench_bulk in due database embedded
+separati, uno con la tabella misurazioni nello schema precedente
+(tipo_misurazione testuale, data e ora salvate) e uno nuovo con lo schema
+compatto, e ne confronta la dimensione dopo VACUUM/CHECKPOINT. DuckDB non
+restituisce lo spazio delle tabelle eliminate, per questo non si misura lo
+stesso file prima e dopo migrate_measurements.
+
+Uso (dalla cartella del progetto):
+    python benchmarks/bench_schema.py [--backend sqlite] [--stazioni 200] [--giorni 30]
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_bulk import TIPI, synthetic_rows
+from database import (COMPACT_MEASUREMENT_COLUMNS, COMPACT_MEASUREMENT_KEY_COLUMNS, HHMM_SLOTS, MEASUREMENT_COLUMNS,
+                      MEASUREMENT_KEY_COLUMNS)
+from storage import create_storage
+
+LEGACY_MEASUREMENTS_SQL = """
+CREATE TABLE misurazioni (
+    stazione_id VARCHAR(32) NOT NULL,
+    data_ora_rilevazione TIMESTAMP NOT NULL,
+    data_rilevazione DATE,
+    ora_rilevazione TIME,
+    tipo_misurazione VARCHAR(64) NOT NULL,
+    valore DOUBLE,
+    PRIMARY KEY (stazione_id, data_ora_rilevazione, tipo_misurazione)
+)
+"""
+
+def database_size(backend: str, path: str, stazioni: int, giorni: int, compatto: bool) -> int:
+    """Dimensione del file dopo la scrittura delle misurazioni sintetiche."""
+    storage = create_storage(backend, path)
+    try:
+        if compatto:
+            storage.ensure_schema()
+            tipo_ids = {tipo: storage.measurement_type_id(tipo) for tipo in TIPI}
+            righe = synthetic_rows(stazioni, giorni, tipo_ids=tipo_ids)
+            storage.upsert('misurazioni', COMPACT_MEASUREMENT_COLUMNS, COMPACT_MEASUREMENT_KEY_COLUMNS, righe)
+        else:
+            storage.execute(LEGACY_MEASUREMENTS_SQL)
+            storage.ensure_schema()
+            righe = synthetic_rows(stazioni, giorni)
+            storage.upsert('misurazioni', MEASUREMENT_COLUMNS, MEASUREMENT_KEY_COLUMNS, righe)
+        storage.commit()
+        storage.execute('VACUUM' if backend == 'sqlite' else 'CHECKPOINT')
+    finally:
+        storage.close()
+    return os.path.getsize(path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=('sqlite', 'duckdb'), default='sqlite')
+    parser.add_argument('--stazioni', type=int, default=200)
+    parser.add_argument('--giorni', type=int, default=30)
+    args = parser.parse_args()
+
+    cartella = tempfile.mkdtemp(prefix='bench-schema-')
+    n = args.stazioni * args.giorni * len(HHMM_SLOTS) * len(TIPI)
+    dimensioni = {}
+    for nome, compatto in (('legacy', False), ('compatto', True)):
+        path = os.path.join(cartella, f'{nome}.{args.backend}')
+        dimensioni[nome] = database_size(args.backend, path, args.stazioni, args.giorni, compatto)
+        os.remove(path)
+    print(f"{n:,} misurazioni su {args.backend}")
+    for nome, dimensione in dimensioni.items():
+        print(f"  {nome:>8}: {dimensione / 2**20:8.2f} MiB ({dimensione / n:.1f} byte/riga)")
+    print(f"  risparmio: {1 - dimensioni['compatto'] / dimensioni['legacy']:.0%}")
+
+if __name__ == '__main__':
+    main()
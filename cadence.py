@@ -0,0 +1,148 @@
+"""Cadenza di interrogazione adattiva: tempi di pubblicazione osservati e bacini in piena.
+
+ARPAE pubblica uno slot ogni mezz'ora, ma con un ritardo variabile rispetto
+all'ora della misurazione. PublicationModel registra, per ogni nuovo slot
+comparso nei dati, il ritardo con cui è stato visto e ne stima un quantile
+basso: il demone attende fino al momento previsto per il prossimo slot, poi
+interroga fitto finché lo slot non compare (ogni dense_interval, o più di
+rado se i ritardi sono molto dispersi) e si allarga di nuovo se la
+pubblicazione tarda oltre dense_window.
+
+FloodWatch segnala i bacini con idrometri vicini a soglia2/soglia3: per
+quei bacini il demone esegue cicli ravvicinati con una query ristretta.
+"""
+import os
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Set, Tuple
+
+SLOT_MINUTES = 30
+
+# Ritardi oltre questa soglia (es. dopo un fermo del demone) non descrivono la pubblicazione
+MAX_PLAUSIBLE_LAG = 6 * 3600
+
+class PublicationModel:
+    """Stima l'istante di pubblicazione del prossimo slot dai ritardi degli ultimi window slot.
+
+    I parametri non indicati vengono letti dall'ambiente: POLL_DEFAULT_LAG
+    (ritardo ipotizzato finché non ci sono osservazioni, 1200 s), POLL_DENSE_INTERVAL
+    (60 s), POLL_DENSE_WINDOW (900 s), POLL_MIN_WAIT (30 s) e POLL_MAX_WAIT (1800 s).
+    """
+
+    def __init__(self, window: int = 48, quantile: float = 0.25, default_lag: Optional[float] = None,
+                 dense_interval: Optional[float] = None, dense_window: Optional[float] = None,
+                 min_wait: Optional[float] = None, max_wait: Optional[float] = None):
+        self.quantile = quantile
+        self.default_lag = default_lag or float(os.getenv('POLL_DEFAULT_LAG', '1200'))
+        self.dense_interval = dense_interval or float(os.getenv('POLL_DENSE_INTERVAL', '60'))
+        self.dense_window = dense_window or float(os.getenv('POLL_DENSE_WINDOW', '900'))
+        self.min_wait = min_wait or float(os.getenv('POLL_MIN_WAIT', '30'))
+        self.max_wait = max_wait or float(os.getenv('POLL_MAX_WAIT', '1800'))
+        self._lags = deque(maxlen=window)
+        self._latest: Optional[datetime] = None
+        self._last_poll: Optional[datetime] = None
+
+    def observe(self, latest_slot: Optional[datetime], polled_at: datetime) -> bool:
+        """Registra l'esito di un'interrogazione; restituisce True se è comparso un nuovo slot.
+
+        Il ritardo di un nuovo slot è stimato a metà tra l'interrogazione
+        precedente (slot non ancora visibile) e questa (slot visibile).
+        """
+        nuovo = latest_slot is not None and (self._latest is None or latest_slot > self._latest)
+        if nuovo and self._latest is not None and self._last_poll is not None:
+            visto = self._last_poll + (polled_at - self._last_poll) / 2
+            ritardo = (visto - latest_slot).total_seconds()
+            if 0 <= ritardo <= MAX_PLAUSIBLE_LAG and (polled_at - self._last_poll).total_seconds() <= self.max_wait:
+                self._lags.append(ritardo)
+        if nuovo:
+            self._latest = latest_slot
+        self._last_poll = polled_at
+        return nuovo
+
+    def _lag_quantile(self, q: float) -> float:
+        ordinati = sorted(self._lags)
+        return ordinati[min(len(ordinati) - 1, int(len(ordinati) * q))]
+
+    def expected_lag(self) -> float:
+        """Quantile basso dei ritardi osservati: meglio arrivare un po' prima che dopo."""
+        if not self._lags:
+            return self.default_lag
+        return self._lag_quantile(self.quantile)
+
+    def dense_step(self) -> float:
+        """Passo delle interrogazioni fitte: un terzo della dispersione dei ritardi, almeno dense_interval.
+
+        Con pubblicazioni regolari si interroga ogni dense_interval; se i ritardi
+        sono molto variabili il passo si allarga, per non moltiplicare le richieste.
+        """
+        if len(self._lags) < 4:
+            return self.dense_interval
+        dispersione = self._lag_quantile(0.75) - self._lag_quantile(0.25)
+        return min(self.max_wait / 4, max(self.dense_interval, dispersione / 3))
+
+    def next_publication(self) -> Optional[datetime]:
+        if self._latest is None:
+            return None
+        return self._latest + timedelta(minutes=SLOT_MINUTES, seconds=self.expected_lag())
+
+    def next_delay(self, now: datetime) -> float:
+        """Secondi da attendere prima della prossima interrogazione."""
+        atteso = self.next_publication()
+        if atteso is None:
+            return self.dense_interval
+        if now < atteso:
+            return min(self.max_wait, max(self.min_wait, (atteso - now).total_seconds()))
+        ritardo = (now - atteso).total_seconds()
+        passo = self.dense_step()
+        if ritardo <= max(self.dense_window, 3 * passo):
+            return passo
+        # Pubblicazione in ritardo oltre la finestra fitta: ci si allarga gradualmente
+        return min(self.max_wait, max(passo, ritardo / 2))
+
+class FloodWatch:
+    """Individua i bacini in cui un idrometro si avvicina alle soglie di attenzione.
+
+    Un bacino (bacino, sottobacino) è in allerta se l'ultimo livello_idro di una
+    sua stazione è entro margin dalla soglia2 o dalla soglia3 del sensore (o le
+    supera). Si considerano solo i valori recenti, cioè entro max_age secondi
+    dallo slot più recente visto, così un vecchio picco non tiene acceso il
+    regime ravvicinato. Default da BURST_MARGIN (0.5 m), BURST_INTERVAL (120 s)
+    e BURST_MAX_AGE (10800 s).
+    """
+
+    def __init__(self, margin: Optional[float] = None, burst_interval: Optional[float] = None,
+                 max_age: Optional[float] = None, variable: str = 'livello_idro'):
+        self.margin = margin if margin is not None else float(os.getenv('BURST_MARGIN', '0.5'))
+        self.burst_interval = burst_interval or float(os.getenv('BURST_INTERVAL', '120'))
+        self.max_age = max_age or float(os.getenv('BURST_MAX_AGE', '10800'))
+        self.variable = variable
+
+    def near_threshold(self, valore: Any, soglie: Tuple[Any, ...]) -> bool:
+        try:
+            livello = float(valore)
+        except (TypeError, ValueError):
+            return False
+        for soglia in soglie[1:3]:
+            if soglia is not None and livello >= float(soglia) - self.margin:
+                return True
+        return False
+
+    def alert_basins(self, stations: Dict[str, Dict[str, Any]],
+                     latest_values: Dict[Tuple[str, str], Tuple[datetime, Any]]) -> Set[Tuple[str, Optional[str]]]:
+        """Bacini (bacino, sottobacino) con almeno una stazione vicina alle soglie."""
+        recenti = [ts for (_, tipo), (ts, _) in latest_values.items() if tipo == self.variable]
+        if not recenti:
+            return set()
+        limite = max(recenti) - timedelta(seconds=self.max_age)
+
+        bacini = set()
+        for (station_id, tipo), (ts, valore) in latest_values.items():
+            if tipo != self.variable or ts < limite:
+                continue
+            stazione = stations.get(station_id)
+            if stazione is None or not stazione.get('bacino'):
+                continue
+            soglie = stazione.get('soglie', {}).get(self.variable)
+            if soglie and self.near_threshold(valore, soglie):
+                bacini.add((stazione['bacino'], stazione.get('sottobacino')))
+        return bacini
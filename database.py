@@ -1,16 +1,39 @@
+import argparse
+import fcntl
+import hashlib
 import json
-import mysql.connector
-from datetime import datetime, date
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
+from datetime import datetime, date, timedelta, time as dt_time
+from functools import lru_cache
 import logging
+import multiprocessing
 import requests
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 import os
 from dotenv import load_dotenv
 import signal
 import sys
-import schedule
+import threading
 import time
 
+from archive import ResponseArchive
+from cadence import FloodWatch, PublicationModel
+from metrics import METRICS, IngestMetrics, MeteredReader, start_metrics_server
+from revisions import REVISION_COLUMNS, measurements_as_of
+from snapshots import ABSENT, SnapshotDiff
+from shards import SHARD_KEYS, RunJournal, assign_shards, list_partitions, shard_id
+from storage import STORAGE_BACKENDS, StorageBackend, create_storage
+from async_fetch import fetch_merged, iter_paged_items
+from writebehind import WriteBehindQueue
+from upstream import (ARPAE_API_URL, DEFAULT_VARIABLE, UpstreamClient, arpae_params, basin_filter, field_filter,
+                      upstream_client)
+
+try:
+    import ijson
+except ImportError:  # parsing incrementale opzionale (--stream)
+    ijson = None
+
 # Carica le variabili d'ambiente dal file .env
 load_dotenv()
 
@@ -25,297 +48,1174 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class ArpaeDataLoader:
-    def __init__(self):
-        """Inizializza la connessione al database usando le variabili d'ambiente."""
+# Colonne scritte dal loader e relative chiavi di upsert
+STATION_COLUMNS = (
+    'id', 'nome', 'altitudine', 'longitude', 'latitude', 'cod_istat',
+    'bacino', 'sottobacino', 'macroarea', 'proprietario', 'gestore',
+    'comune', 'provincia', 'regione', 'multifunzione'
+)
+SENSOR_COLUMNS = (
+    'stazione_id', 'tipo_variabile', 'soglia1', 'soglia2', 'soglia3',
+    'bacino', 'sottobacino', 'altitudine'
+)
+SENSOR_KEY_COLUMNS = ('stazione_id', 'tipo_variabile')
+MEASUREMENT_COLUMNS = (
+    'stazione_id', 'data_ora_rilevazione', 'data_rilevazione', 'ora_rilevazione', 'tipo_misurazione', 'valore'
+)
+MEASUREMENT_KEY_COLUMNS = ('stazione_id', 'data_ora_rilevazione', 'tipo_misurazione')
+# Schema compatto: tipo come id di tipi_misurazione, data e ora generate dal database
+COMPACT_MEASUREMENT_COLUMNS = ('stazione_id', 'data_ora_rilevazione', 'tipo_id', 'valore')
+COMPACT_MEASUREMENT_KEY_COLUMNS = ('stazione_id', 'data_ora_rilevazione', 'tipo_id')
+STATION_HASH_COLUMNS = ('stazione_id', 'hash_anagrafica', 'hash_sensori', 'aggiornato_il')
+FINGERPRINT_COLUMNS = ('stazione_id', 'data_rilevazione', 'valori', 'aggiornato_il')
+FINGERPRINT_KEY_COLUMNS = ('stazione_id', 'data_rilevazione')
+
+# Errori dovuti a item malformati (campi mancanti, soglie incomplete, chiavi HHMM non valide)
+ITEM_ERRORS = (KeyError, IndexError, TypeError, ValueError, AttributeError)
+
+# Serializza le scritture sul file degli scarti condiviso dai worker del backfill
+_DEAD_LETTER_LOCK = threading.Lock()
+
+
+# Politiche di commit: una transazione per esecuzione, ogni N righe o ogni N millisecondi
+COMMIT_POLICIES = ('run', 'rows', 'ms')
+
+# Giorni (oltre a oggi) di cui si tengono le impronte dei valori salvati, in memoria e nel database
+WATERMARK_CACHE_DAYS = 1
+
+# Slot di mezz'ora già salvati che il fetch delta riscarica per i valori arrivati in ritardo
+DELTA_OVERLAP_SLOTS = 2
+
+# Date scaricate insieme (per tutte le variabili) dal comando fetch
+FETCH_CHUNK_DAYS = 7
+
+# Attesa prima di rielaborare un batch annullato: raddoppia a ogni tentativo fino al massimo
+REPLAY_BACKOFF_SECONDS = 0.25
+REPLAY_BACKOFF_MAX_SECONDS = 2.0
+
+# Le 48 fasce semiorarie ARPAE (chiavi HHMM) con l'ora del giorno e la stringa "HH:MM:00"
+HHMM_SLOTS: Dict[str, Tuple[dt_time, str]] = {
+    f"{ora:02d}{minuti:02d}": (dt_time(ora, minuti), f"{ora:02d}:{minuti:02d}:00")
+    for ora in range(24) for minuti in (0, 30)
+}
+
+class DecodedDay(NamedTuple):
+    """Blocco giornaliero ARPAE decodificato in colonne parallele, una voce per misurazione."""
+    data: date
+    timestamps: List[datetime]
+    ore: List[str]
+    tipi: List[str]
+    valori: List[Any]
+
+@lru_cache(maxsize=64)
+def _day_slots(date_str: str) -> Tuple[date, Dict[str, Tuple[datetime, str]]]:
+    """Tabella HHMM -> (data_ora_rilevazione, "HH:MM:00") per una data, calcolata una volta sola."""
+    giorno = datetime.strptime(date_str, '%Y%m%d').date()
+    return giorno, {hhmm: (datetime.combine(giorno, ora), ora_str) for hhmm, (ora, ora_str) in HHMM_SLOTS.items()}
+
+def decode_day_block(date_str: str, day_block: Dict[str, Dict[str, Any]]) -> DecodedDay:
+    """Decodifica in un solo passaggio un blocco {HHMM: {tipo_misurazione: valore}} della data."""
+    giorno, slots = _day_slots(date_str)
+    timestamps: List[datetime] = []
+    ore: List[str] = []
+    tipi: List[str] = []
+    valori: List[Any] = []
+
+    for hhmm, misurazioni in day_block.items():
+        slot = slots.get(hhmm)
+        if slot is None:
+            # Chiave fuori dalle fasce semiorarie: decodifica esplicita (solleva ValueError se non valida)
+            ora = dt_time(int(hhmm[:2]), int(hhmm[2:]))
+            slot = (datetime.combine(giorno, ora), ora.strftime('%H:%M:%S'))
+        data_ora_rilevazione, ora_formattata = slot
+        for tipo_mis, valore in misurazioni.items():
+            timestamps.append(data_ora_rilevazione)
+            ore.append(ora_formattata)
+            tipi.append(tipo_mis)
+            valori.append(valore)
+
+    return DecodedDay(giorno, timestamps, ore, tipi, valori)
+
+def check_values(giornata: DecodedDay) -> None:
+    """Solleva ValueError se un valore non è numerico (es. 'n/d'), prima che lo rifiuti il database."""
+    for tipo_mis, valore in zip(giornata.tipi, giornata.valori):
+        if valore is None:
+            continue
         try:
-            self.connection = mysql.connector.connect(
-                host=os.getenv('DB_HOST', '127.0.0.1'),      # Usa IP invece di localhost
-                port=int(os.getenv('DB_PORT', '3306')),      # Porta esplicita
-                user=os.getenv('DB_USER', 'root'),
-                password=os.getenv('DB_PASSWORD', 'root'),
-                database=os.getenv('DB_NAME', 'fiumesicuro'),
-                charset='utf8mb4',
-                collation='utf8mb4_unicode_ci',
-                connect_timeout=30  # Timeout di connessione aumentato
-            )
-            self.cursor = self.connection.cursor(dictionary=True)
-            logger.info("Connessione al database stabilita con successo")
-        except mysql.connector.Error as err:
-            logger.error(f"Errore di connessione al database: {err}")
-            raise
-        
-    def fetch_data_from_api(self, selected_date: str) -> Dict[str, Any]:
-        """Recupera i dati dall'API ARPAE."""
-        base_url = "https://apps.arpae.it/REST/meteo_osservati"
-        
-        # Costruzione della query
-        where_clause = {"anagrafica.variabili": "livello_idro"}
-        projection_clause = {
-            f"dati.{selected_date}": 1,
-            "anagrafica": 1
+            float(valore)
+        except (TypeError, ValueError):
+            raise ValueError(f"Valore non numerico per {tipo_mis}: {valore!r}") from None
+
+def station_row(station_data: Dict[str, Any]) -> tuple:
+    """Riga della tabella stazioni (colonne STATION_COLUMNS) per un item dell'API."""
+    ana = station_data['anagrafica']
+
+    # flag for multi-variable stations.
+    multifunzione = 1 if len(ana['variabili']) > 1 else 0
+
+    return (
+        station_data['_id'],
+        ana['nome'],
+        ana['altitudine'],
+        ana['geometry']['coordinates'][0],
+        ana['geometry']['coordinates'][1],
+        ana['cod_istat'],
+        ana['bacino'],
+        ana['sottobacino'],
+        ana['macroarea'],
+        ana['proprietario'],
+        ana['gestore'],
+        ana['comune'],
+        ana['provincia'],
+        ana['regione'],
+        multifunzione
+    )
+
+def sensor_rows(station_id: str, sensors_data: Dict[str, Any]) -> List[tuple]:
+    """Righe della tabella sensori (colonne SENSOR_COLUMNS) per i sensori di una stazione."""
+    righe = []
+    for tipo_variabile, sensor in sensors_data.items():
+        righe.append((
+            station_id,
+            tipo_variabile,
+            sensor['soglie'][0],
+            sensor['soglie'][1],
+            sensor['soglie'][2],
+            sensor['bacino'],
+            sensor['sottobacino'],
+            sensor['altitudine']
+        ))
+    return righe
+
+def _normalize_value(valore: Any) -> Any:
+    """Rende confrontabili i valori letti dal database (Decimal) e quelli dell'API (float)."""
+    try:
+        return float(valore)
+    except (TypeError, ValueError):
+        return valore
+
+def _as_datetime(valore: Any) -> datetime:
+    """Converte in datetime i timestamp letti dal database (SQLite li restituisce come testo)."""
+    return valore if isinstance(valore, datetime) else datetime.fromisoformat(str(valore))
+
+def _content_hash(data: Any) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def station_hashes(anagrafica: Dict[str, Any]) -> Tuple[str, str]:
+    """Calcola le impronte di anagrafica (sensori esclusi) e sensori di una stazione."""
+    return (
+        _content_hash({k: v for k, v in anagrafica.items() if k != 'sensori'}),
+        _content_hash(anagrafica.get('sensori', {}))
+    )
+
+class StationRegistry:
+    """Dati per stazione (multifunzione, bacino, soglie dei sensori) serviti dalla memoria.
+
+    Viene caricato una volta dal database e tenuto allineato da insert_station e
+    insert_sensors; invalidate() forza una nuova lettura al caricamento successivo.
+    """
+
+    def __init__(self):
+        self._stations: Dict[str, Dict[str, Any]] = {}
+        self._stale_all = True
+        self._stale_ids: set = set()
+
+    def load(self, storage: StorageBackend) -> None:
+        """Ricarica dal database tutte le stazioni o solo quelle invalidate."""
+        filtro_stazioni = filtro_sensori = ""
+        params: tuple = ()
+        if not self._stale_all:
+            if not self._stale_ids:
+                return
+            params = tuple(sorted(self._stale_ids))
+            segnaposti = ', '.join(['%s'] * len(params))
+            filtro_stazioni = f" WHERE id IN ({segnaposti})"
+            filtro_sensori = f" WHERE stazione_id IN ({segnaposti})"
+
+        righe = storage.query(
+            "SELECT id, nome, multifunzione, bacino, sottobacino, macroarea FROM stazioni" + filtro_stazioni + ";", params
+        )
+        stazioni = {
+            str(row['id']): {
+                'nome': row['nome'],
+                'multifunzione': row['multifunzione'],
+                'bacino': row['bacino'],
+                'sottobacino': row['sottobacino'],
+                'macroarea': row['macroarea'],
+                'soglie': {}
+            }
+            for row in righe
         }
-        
-        # Parametri della query
-        params = {
-            "where": json.dumps(where_clause),
-            "projection": json.dumps(projection_clause),
-            "max_results": 100000
+
+        righe = storage.query(
+            "SELECT stazione_id, tipo_variabile, soglia1, soglia2, soglia3 FROM sensori" + filtro_sensori + ";", params
+        )
+        for row in righe:
+            stazione = stazioni.get(str(row['stazione_id']))
+            if stazione is not None:
+                stazione['soglie'][row['tipo_variabile']] = (row['soglia1'], row['soglia2'], row['soglia3'])
+
+        if self._stale_all:
+            self._stations = stazioni
+        else:
+            for station_id in self._stale_ids:
+                self._stations.pop(station_id, None)
+            self._stations.update(stazioni)
+        self._stale_all = False
+        self._stale_ids.clear()
+        logger.info(f"Registro stazioni caricato: {len(stazioni)} stazioni")
+
+    def is_stale(self) -> bool:
+        return self._stale_all or bool(self._stale_ids)
+
+    def invalidate(self, station_id: Optional[str] = None) -> None:
+        if station_id is None:
+            self._stale_all = True
+        else:
+            self._stale_ids.add(str(station_id))
+
+    def get(self, station_id: str) -> Optional[Dict[str, Any]]:
+        return self._stations.get(str(station_id))
+
+    def stations(self) -> Dict[str, Dict[str, Any]]:
+        return self._stations
+
+    def update_station(self, station_id: str, **dati: Any) -> None:
+        stazione = self._stations.setdefault(str(station_id), {'soglie': {}})
+        stazione.update(dati)
+
+    def update_sensor(self, station_id: str, tipo_variabile: str, soglie: Tuple[Any, ...]) -> None:
+        stazione = self._stations.setdefault(str(station_id), {'soglie': {}})
+        stazione['soglie'][tipo_variabile] = soglie
+
+@dataclass
+class LoaderConfig:
+    """Impostazioni di ArpaeDataLoader; from_env le legge una volta dall'ambiente (variabili a fianco)."""
+    batch_size: int = 1000                   # BATCH_SIZE (BULK_BATCH_SIZE, 100000, con bulk)
+    commit_policy: str = 'rows'              # COMMIT_POLICY: 'run', 'rows' o 'ms' ('run' con bulk)
+    commit_every: int = 5000                 # COMMIT_EVERY: righe o millisecondi tra due commit
+    max_batch_retries: int = 3
+    max_batch_items: int = 1000              # MAX_BATCH_ITEMS: stazioni dopo cui il commit è comunque anticipato
+    stream: bool = False                     # STREAM_JSON: risposta letta in modo incrementale (ijson)
+    incremental: bool = True                 # INCREMENTAL: solo misurazioni nuove o cambiate
+    archive_dir: Optional[str] = None        # ARCHIVE_DIR: archivio compresso delle risposte grezze
+    metrics_file: Optional[str] = None       # METRICS_FILE: metriche Prometheus dopo ogni esecuzione
+    dead_letter_file: Optional[str] = None   # DEAD_LETTER_FILE: scarti in JSON Lines invece che nella tabella
+    variables: List[str] = field(default_factory=lambda: [DEFAULT_VARIABLE])  # ARPAE_VARIABLES, separate da virgola
+    fetch_concurrency: int = 4               # FETCH_CONCURRENCY: query o pagine scaricate in parallelo
+    page_size: int = 1000                    # PAGE_SIZE: stazioni per pagina (0: una sola richiesta; 0 con stream)
+    delta_fetch: bool = False                # DELTA_FETCH: solo gli slot successivi al watermark
+    reconcile_interval: float = 10800        # RECONCILE_INTERVAL: secondi tra due fetch completi in modalità delta
+    bulk: bool = False                       # BULK_LOAD: bulk_upsert per le importazioni storiche
+    write_behind: bool = False               # WRITE_BEHIND: misurazioni scritte da un thread dedicato
+    flush_interval: float = 1.0              # WRITE_BEHIND_FLUSH_INTERVAL
+    max_queued_rows: int = 4000              # WRITE_BEHIND_MAX_ROWS (default: quattro batch)
+    revision_log: bool = True                # REVISION_LOG: correzioni ARPAE in revisioni_misurazioni
+
+    def __post_init__(self):
+        if self.commit_policy not in COMMIT_POLICIES:
+            raise ValueError(f"commit_policy non valida: {self.commit_policy} (ammesse: {', '.join(COMMIT_POLICIES)})")
+        if self.stream and self.page_size and len(self.variables) == 1:
+            # Lo streaming legge una sola risposta: con le pagine verrebbe ignorato
+            raise ValueError("stream e page_size si escludono: usare page_size=0 (PAGE_SIZE=0) con lo streaming")
+
+    @classmethod
+    def from_env(cls, **overrides: Any) -> 'LoaderConfig':
+        """Legge le impostazioni dall'ambiente; gli argomenti diversi da None hanno la precedenza."""
+        indicati = {chiave: valore for chiave, valore in overrides.items() if valore is not None}
+        bulk = indicati.get('bulk', os.getenv('BULK_LOAD', '0') == '1')
+        stream = indicati.get('stream', os.getenv('STREAM_JSON', '0') == '1')
+        batch_size = indicati.get('batch_size') or (
+            int(os.getenv('BULK_BATCH_SIZE', '100000')) if bulk else int(os.getenv('BATCH_SIZE', '1000'))
+        )
+        valori = dict(
+            batch_size=batch_size,
+            commit_policy='run' if bulk else os.getenv('COMMIT_POLICY', 'rows'),
+            commit_every=int(os.getenv('COMMIT_EVERY', '5000')),
+            max_batch_items=int(os.getenv('MAX_BATCH_ITEMS', '1000')),
+            stream=stream,
+            incremental=os.getenv('INCREMENTAL', '1') == '1',
+            archive_dir=os.getenv('ARCHIVE_DIR'),
+            metrics_file=os.getenv('METRICS_FILE'),
+            dead_letter_file=os.getenv('DEAD_LETTER_FILE'),
+            variables=[v.strip() for v in os.getenv('ARPAE_VARIABLES', DEFAULT_VARIABLE).split(',') if v.strip()],
+            fetch_concurrency=int(os.getenv('FETCH_CONCURRENCY', '4')),
+            page_size=int(os.getenv('PAGE_SIZE', '0' if stream else '1000')),
+            delta_fetch=os.getenv('DELTA_FETCH', '0') == '1',
+            reconcile_interval=float(os.getenv('RECONCILE_INTERVAL', '10800')),
+            bulk=bulk,
+            write_behind=os.getenv('WRITE_BEHIND', '0') == '1',
+            flush_interval=float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', '1')),
+            max_queued_rows=int(os.getenv('WRITE_BEHIND_MAX_ROWS', str(4 * batch_size))),
+            revision_log=os.getenv('REVISION_LOG', '1') == '1',
+        )
+        valori.update(indicati)
+        return cls(**valori)
+
+class ArpaeDataLoader:
+    def __init__(self, config: Optional[LoaderConfig] = None, storage: Optional[StorageBackend] = None,
+                 metrics: Optional[IngestMetrics] = None, client: Optional[UpstreamClient] = None,
+                 stop_event: Optional[threading.Event] = None):
+        """Prepara il loader con config (default: dall'ambiente) sul backend storage (default: DB_BACKEND).
+
+        Quando stop_event viene impostato, process_data si ferma dopo il primo
+        batch confermato (usato dal demone per l'arresto su SIGTERM).
+        """
+        self.config = config = config or LoaderConfig.from_env()
+        if config.stream and ijson is None:
+            raise ImportError("La modalità stream richiede il pacchetto ijson (pip install ijson)")
+        self.bulk = config.bulk
+        self.stream = config.stream
+        self.commit_policy = config.commit_policy
+        self.commit_every = config.commit_every
+        self.max_batch_retries = config.max_batch_retries
+        # Gli item del batch non confermato restano in memoria per rielaborarlo: il limite vale con ogni politica
+        self.max_batch_items = config.max_batch_items
+        self._pending_rows = 0
+        self._batch_started = time.perf_counter()
+
+        self.batch_size = config.batch_size
+        self._measurement_buffer: List[tuple] = []
+        # Serializza l'uso della connessione tra il loader e il thread di scrittura differita
+        self._storage_lock = threading.Lock()
+        self.write_behind = config.write_behind
+        self._writer: Optional[WriteBehindQueue] = None
+        # Misurazioni confermate; quelle della transazione corrente si sommano solo al commit
+        self.rows_written = 0
+        self._rows_in_transaction = 0
+        # Righe scritte per tabella nella transazione corrente, per rows_written_total al commit
+        self._rows_by_table: Dict[str, int] = {}
+        self.rows_skipped = 0
+        self.write_seconds = 0.0
+
+        # Watermark: ultima data_ora_rilevazione salvata per (stazione, tipo_misurazione)
+        self.incremental = config.incremental
+        self._watermarks: Dict[Tuple[str, str], datetime] = {}
+        # Impronte dei valori salvati per (stazione, giorno), dal giorno di _known_since in poi
+        self.snapshots = SnapshotDiff()
+        self._known_since = datetime.combine(date.today() - timedelta(days=WATERMARK_CACHE_DAYS), datetime.min.time())
+        # Valori accodati nella transazione corrente, resi noti solo al commit
+        self._pending_values: Dict[Tuple[str, str, datetime], Any] = {}
+        # Correzioni dei valori salvati, scritte nel log delle revisioni al commit
+        self.revision_log = config.revision_log
+        self._revision_buffer: List[tuple] = []
+        # Valori salvati per stazione della data fuori dalla finestra in elaborazione, letti con una sola query
+        self._stored_day: Optional[date] = None
+        self._stored_values: Dict[str, Dict[Tuple[datetime, str], Any]] = {}
+        # Ultimo valore noto per (stazione, tipo), con il suo istante: serve al controllo delle soglie
+        self._latest_values: Dict[Tuple[str, str], Tuple[datetime, Any]] = {}
+
+        # Impronte (anagrafica, sensori) per stazione, e quelle cambiate nella transazione corrente
+        self._station_hashes: Dict[str, Tuple[str, str]] = {}
+        self._pending_hashes: Dict[str, Tuple[str, str]] = {}
+        self.stations_skipped = 0
+
+        self.metrics = metrics or METRICS
+        self.metrics_file = config.metrics_file
+        self.dead_letter_file = config.dead_letter_file
+        self.client = client or upstream_client()
+        self.variables = config.variables
+        self.fetch_concurrency = config.fetch_concurrency
+        self.page_size = config.page_size
+        self.delta_fetch = config.delta_fetch
+        self.reconcile_interval = config.reconcile_interval
+        # Istante (monotonic) dell'ultimo fetch completo per data
+        self._last_full_fetch: Dict[str, float] = {}
+        self.stop_event = stop_event
+        self.items_dead_lettered = 0
+        # Scarti per dead_letter_file, aggiunti al file solo dopo il commit del batch, e chiavi già nel file
+        self._dead_letter_lines: List[Tuple[Tuple[str, Optional[str], str], str]] = []
+        self._dead_letter_keys: Optional[set] = None
+
+        self.archive = ResponseArchive(config.archive_dir) if config.archive_dir else None
+
+        self.storage = storage or create_storage()
+        self.ensure_schema()
+        if self.write_behind:
+            self._writer = WriteBehindQueue(self._write_measurements, self.batch_size, config.flush_interval,
+                                            config.max_queued_rows, self.metrics)
+        # Colonne delle righe di misurazioni, secondo lo schema rilevato da ensure_schema
+        if self.storage.compact_measurements:
+            self._measurement_columns = COMPACT_MEASUREMENT_COLUMNS
+            self._measurement_key_columns = COMPACT_MEASUREMENT_KEY_COLUMNS
+        else:
+            self._measurement_columns = MEASUREMENT_COLUMNS
+            self._measurement_key_columns = MEASUREMENT_KEY_COLUMNS
+        self._type_ids: Dict[str, int] = {}
+        # Tipi registrati nella transazione corrente, resi definitivi al commit
+        self._pending_type_ids: Dict[str, int] = {}
+        # Servono allo schema compatto e al log delle revisioni
+        self.load_measurement_types()
+        self.registry = StationRegistry()
+        self.registry.load(self.storage)
+        self.load_station_hashes()
+        if self.incremental:
+            self.load_watermarks()
+
+    def ensure_schema(self) -> None:
+        """Crea le tabelle di supporto del loader (e, in MySQL, la chiave univoca delle misurazioni)."""
+        self.storage.ensure_schema()
+
+    def load_measurement_types(self) -> None:
+        """Carica il dizionario dei tipi di misurazione (schema compatto e log delle revisioni)."""
+        self._type_ids = {row['nome']: row['id'] for row in self.storage.query("SELECT id, nome FROM tipi_misurazione")}
+        logger.info(f"Tipi di misurazione caricati: {len(self._type_ids)}")
+
+    def measurement_type_id(self, nome: str) -> int:
+        """Id del tipo di misurazione, registrandolo in tipi_misurazione se è nuovo.
+
+        L'id lo assegna il database e un nome già registrato da un altro loader
+        viene lasciato invariato, quindi i loader concorrenti non si contendono
+        lo stesso id; la registrazione è definitiva solo al commit.
+        """
+        tipo_id = self._type_ids.get(nome) or self._pending_type_ids.get(nome)
+        if tipo_id is not None:
+            return tipo_id
+        with self._storage_lock:
+            tipo_id = self.storage.measurement_type_id(nome)
+        logger.info(f"Tipo di misurazione {nome} registrato con id {tipo_id}")
+        self._pending_type_ids[nome] = tipo_id
+        return tipo_id
+
+    def load_station_hashes(self) -> None:
+        """Carica le impronte di anagrafica e sensori salvate per ogni stazione."""
+        righe = self.storage.query("SELECT stazione_id, hash_anagrafica, hash_sensori FROM impronte_stazioni;")
+        self._station_hashes = {
+            row['stazione_id']: (row['hash_anagrafica'], row['hash_sensori']) for row in righe
         }
-        
+        logger.info(f"Impronte delle stazioni caricate: {len(self._station_hashes)}")
+
+    def save_station_hash(self, station_id: str, hash_anagrafica: str, hash_sensori: str) -> None:
+        """Salva l'impronta della stazione; in memoria diventa effettiva solo al commit."""
+        self._upsert(
+            'impronte_stazioni', STATION_HASH_COLUMNS, ('stazione_id',),
+            [(station_id, hash_anagrafica, hash_sensori, datetime.now())]
+        )
+        self._pending_rows += 1
+        self._pending_hashes[station_id] = (hash_anagrafica, hash_sensori)
+
+    def load_watermarks(self) -> None:
+        """Carica i watermark per stazione e tipo e le impronte dei valori salvati degli ultimi giorni.
+
+        I watermark servono solo per i giorni recenti (latest_slot, controllo
+        delle soglie), quindi si leggono dalle misurazioni da _known_since in
+        poi invece di aggregare tutto lo storico. Le impronte arrivano da
+        impronte_giornaliere (quelle più vecchie della finestra vengono
+        cancellate); se la tabella è vuota, ad esempio al primo avvio, vengono
+        ricostruite dalle misurazioni della finestra.
+        """
+        sql = """
+        SELECT stazione_id, tipo_misurazione, MAX(data_ora_rilevazione) AS ultima
+        FROM misurazioni_estese
+        WHERE data_ora_rilevazione >= %s
+        GROUP BY stazione_id, tipo_misurazione;
+        """
+        self._watermarks = {
+            (str(row['stazione_id']), row['tipo_misurazione']): _as_datetime(row['ultima'])
+            for row in self.storage.query(sql, (self._known_since,))
+        }
+
+        self.snapshots = SnapshotDiff()
+        self.storage.execute("DELETE FROM impronte_giornaliere WHERE data_rilevazione < %s", (self._known_since.date(),))
+        self.storage.commit()
+        self.snapshots.load(self.storage.query(
+            "SELECT stazione_id, data_rilevazione, valori FROM impronte_giornaliere WHERE data_rilevazione >= %s",
+            (self._known_since.date(),)
+        ))
+        if not len(self.snapshots):
+            sql = """
+            SELECT stazione_id, tipo_misurazione, data_ora_rilevazione, valore
+            FROM misurazioni_estese
+            WHERE data_ora_rilevazione >= %s;
+            """
+            for row in self.storage.query(sql, (self._known_since,)):
+                self.snapshots.seed(str(row['stazione_id']), row['tipo_misurazione'],
+                                    _as_datetime(row['data_ora_rilevazione']), row['valore'])
+
+        self._latest_values = {
+            chiave: (data_ora_rilevazione, valore)
+            for chiave, (data_ora_rilevazione, valore) in self.snapshots.latest_values().items()
+            if self._watermarks.get(chiave) == data_ora_rilevazione
+        }
+        logger.info(f"Watermark caricati: {len(self._watermarks)} serie, "
+                    f"impronte di {len(self.snapshots)} giornate recenti")
+
+    def _advance_watermarks(self) -> None:
+        """Rende definitivi watermark e impronte dopo un commit riuscito."""
+        self.snapshots.commit()
+        for (station_id, tipo_mis, data_ora_rilevazione), valore in self._pending_values.items():
+            watermark = self._watermarks.get((station_id, tipo_mis))
+            if watermark is None or data_ora_rilevazione >= watermark:
+                self._watermarks[(station_id, tipo_mis)] = data_ora_rilevazione
+                self._latest_values[(station_id, tipo_mis)] = (data_ora_rilevazione, valore)
+        self._pending_values.clear()
+
+        # Scarta le impronte uscite dalla finestra, così la memoria non cresce tra un ciclo e l'altro
+        limite = datetime.combine(date.today() - timedelta(days=WATERMARK_CACHE_DAYS), datetime.min.time())
+        if limite > self._known_since:
+            self._known_since = limite
+            self.snapshots.evict(limite.date())
+
+    def _api_params(self, selected_date: str, slots: Optional[List[str]] = None,
+                    filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Costruisce i parametri della query all'API ARPAE."""
+        return arpae_params(selected_date, self.variables[0], slots=slots, filters=filters)
+
+    def latest_values(self) -> Dict[Tuple[str, str], Tuple[datetime, Any]]:
+        """Ultimo valore salvato per (stazione, tipo), con il suo istante."""
+        return self._latest_values
+
+    def latest_slot(self, selected_date: str) -> Optional[datetime]:
+        """Slot più recente già salvato per la data, tra tutte le stazioni (dai watermark)."""
+        inizio_giorno = datetime.strptime(selected_date, '%Y%m%d')
+        fine_giorno = inizio_giorno + timedelta(days=1)
+        return max((wm for wm in self._watermarks.values() if inizio_giorno <= wm < fine_giorno), default=None)
+
+    def delta_slots(self, selected_date: str) -> Optional[List[str]]:
+        """Chiavi HHMM da scaricare in modalità delta, o None se serve la giornata intera.
+
+        Si parte dall'ultimo slot già salvato per la data (il watermark più
+        recente tra tutte le stazioni) meno DELTA_OVERLAP_SLOTS, per raccogliere
+        i valori arrivati in ritardo. La giornata intera viene riscaricata alla
+        prima esecuzione per la data e poi ogni reconcile_interval secondi.
+        """
+        if not self.delta_fetch:
+            return None
+        ultima_completa = self._last_full_fetch.get(selected_date)
+        if ultima_completa is None or time.monotonic() - ultima_completa >= self.reconcile_interval:
+            return None
+
+        ultimo = self.latest_slot(selected_date)
+        if ultimo is None:
+            return None
+        indice = ultimo.hour * 2 + ultimo.minute // 30
+        return list(HHMM_SLOTS)[max(0, indice - DELTA_OVERLAP_SLOTS):]
+
+    def fetch_data_from_api(self, selected_date: str, slots: Optional[List[str]] = None,
+                            filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Recupera i dati dall'API ARPAE (con slots, solo quelle chiavi HHMM; filters restringe la where)."""
         try:
-            response = requests.get(base_url, params=params)
-            response.raise_for_status()  # Solleva un'eccezione per risposte non 2xx
-            return response.json()
+            with self.metrics.time('http'):
+                # Solleva un'eccezione per risposte non 2xx, dopo gli eventuali ritentativi
+                response = self.client.get(ARPAE_API_URL, params=self._api_params(selected_date, slots, filters))
+                corpo = response.content
+            self.metrics.inc('bytes_downloaded_total', len(corpo))
+            if self.archive is not None:
+                self.archive.save(selected_date, corpo, partial=bool(slots or filters))
+            with self.metrics.time('json'):
+                json_data = response.json()
+            self.metrics.inc('items_parsed_total', len(json_data.get('_items', [])))
+            totale = (json_data.get('_meta') or {}).get('total')
+            if totale is not None and totale > len(json_data.get('_items', [])):
+                logger.warning(f"Risposta troncata: {len(json_data.get('_items', []))} stazioni su {totale}, "
+                               f"usare la paginazione (PAGE_SIZE)")
+            return json_data
             
         except requests.RequestException as e:
             logger.error(f"Errore durante il recupero dei dati dall'API: {str(e)}")
             raise
 
-    def insert_station(self, station_data: Dict[str, Any]) -> None:
-        """Inserisce o aggiorna i dati della stazione."""
-        sql = """
-        INSERT INTO stazioni (
-            id, nome, altitudine, longitude, latitude, cod_istat,
-            bacino, sottobacino, macroarea, proprietario, gestore,
-            comune, provincia, regione, multifunzione
-        ) VALUES (
-            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-        ) ON DUPLICATE KEY UPDATE
-            nome = VALUES(nome),
-            altitudine = VALUES(altitudine),
-            longitude = VALUES(longitude),
-            latitude = VALUES(latitude),
-            cod_istat = VALUES(cod_istat),
-            bacino = VALUES(bacino),
-            sottobacino = VALUES(sottobacino),
-            macroarea = VALUES(macroarea),
-            proprietario = VALUES(proprietario),
-            gestore = VALUES(gestore),
-            comune = VALUES(comune),
-            provincia = VALUES(provincia),
-            regione = VALUES(regione),
-            multifunzione = VALUES(multifunzione)
+    def fetch_variables(self, selected_date: str, slots: Optional[List[str]] = None,
+                        filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Recupera in parallelo le query di tutte le variabili e unisce le stazioni."""
+        return fetch_merged([selected_date], self.variables, concurrency=self.fetch_concurrency,
+                            client=self.client, archive=self.archive, metrics=self.metrics,
+                            page_size=self.page_size,
+                            slots={selected_date: slots} if slots else None, filters=filters)[selected_date]
+
+    def iter_pages_from_api(self, selected_date: str, slots: Optional[List[str]] = None,
+                            filters: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        """Recupera i dati dall'API a pagine scaricate in parallelo, una stazione alla volta."""
+        try:
+            yield from iter_paged_items(selected_date, self.variables[0], page_size=self.page_size,
+                                        concurrency=self.fetch_concurrency, client=self.client,
+                                        archive=self.archive, metrics=self.metrics, slots=slots,
+                                        filters=filters)
+        except requests.RequestException as e:
+            logger.error(f"Errore durante il recupero dei dati dall'API: {str(e)}")
+            raise
+
+    def iter_items_from_api(self, selected_date: str, slots: Optional[List[str]] = None,
+                            filters: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        """Recupera i dati dall'API ARPAE restituendo una stazione alla volta.
+
+        Il corpo della risposta viene analizzato mentre arriva, quindi in memoria
+        resta solo l'item corrente e la scrittura procede durante il download.
         """
-        ana = station_data['anagrafica']
+        try:
+            inizio = time.perf_counter()
+            with self.client.get(ARPAE_API_URL, params=self._api_params(selected_date, slots, filters),
+                                 stream=True) as response:
+                self.metrics.observe('phase_seconds', time.perf_counter() - inizio, phase='http')
+                # Decomprime gzip/deflate in lettura, come farebbe response.json()
+                response.raw.decode_content = True
+                sorgente = MeteredReader(response.raw, self.metrics)
 
-        # flag for multi-variable stations.
-        multifunzione = 1 if len(ana['variabili']) > 1 else 0
+                # Copia nell'archivio i byte letti; l'archivio è valido solo se la risposta è completa
+                archivio = self.archive.tee(selected_date, sorgente, partial=bool(slots or filters)) \
+                    if self.archive is not None else None
+                try:
+                    yield from self._metered_items(sorgente, ijson.items(archivio or sorgente, '_items.item', use_float=True))
+                    if archivio is not None:
+                        while archivio.read(65536):
+                            pass
+                except BaseException:
+                    if archivio is not None:
+                        archivio.discard()
+                    raise
+                if archivio is not None:
+                    archivio.close()
+
+        except requests.RequestException as e:
+            logger.error(f"Errore durante il recupero dei dati dall'API: {str(e)}")
+            raise
 
-        values = (
+    def _metered_items(self, sorgente: MeteredReader, items: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Misura il tempo di decodifica JSON degli item, escluso quello di attesa della rete."""
+        while True:
+            inizio = time.perf_counter()
+            attesa = sorgente.read_seconds
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.metrics.observe(
+                    'phase_seconds', time.perf_counter() - inizio - (sorgente.read_seconds - attesa), phase='json'
+                )
+            self.metrics.inc('items_parsed_total')
+            yield item
+
+    def _upsert(self, table: str, columns: Tuple[str, ...], key_columns: Tuple[str, ...], rows: List[tuple],
+                bulk: bool = False) -> None:
+        """Scrive le righe tramite il backend, misurando il tempo SQL e contando le righe per tabella."""
+        with self._storage_lock, self.metrics.time('sql'):
+            if bulk:
+                self.storage.bulk_upsert(table, columns, key_columns, rows)
+            else:
+                self.storage.upsert(table, columns, key_columns, rows)
+            self._rows_by_table[table] = self._rows_by_table.get(table, 0) + len(rows)
+
+    def insert_station(self, station_data: Dict[str, Any], values: Optional[tuple] = None) -> None:
+        """Inserisce o aggiorna i dati della stazione (values: riga già calcolata da station_row)."""
+        ana = station_data['anagrafica']
+        values = values or station_row(station_data)
+        multifunzione = values[-1]
+
+        self._upsert('stazioni', STATION_COLUMNS, ('id',), [values])
+        self._pending_rows += 1
+        self.registry.update_station(
             station_data['_id'],
-            ana['nome'],
-            ana['altitudine'],
-            ana['geometry']['coordinates'][0],
-            ana['geometry']['coordinates'][1],
-            ana['cod_istat'],
-            ana['bacino'],
-            ana['sottobacino'],
-            ana['macroarea'],
-            ana['proprietario'],
-            ana['gestore'],
-            ana['comune'],
-            ana['provincia'],
-            ana['regione'],
-            multifunzione
+            nome=ana['nome'],
+            multifunzione=multifunzione,
+            bacino=ana['bacino'],
+            sottobacino=ana['sottobacino'],
+            macroarea=ana['macroarea']
         )
-        
-        self.cursor.execute(sql, values)
-        self.connection.commit()
         logger.info(f"> Stazione: {ana['nome']} (ID: {station_data['_id']}) inserita/aggiornata")
 
-    def insert_sensors(self, station_id: str, sensors_data: Dict[str, Any]) -> None:
-        """Inserisce o aggiorna i dati dei sensori."""
-        for tipo_variabile, sensor in sensors_data.items():
-            sql = """
-            INSERT INTO sensori (
-                stazione_id, tipo_variabile, soglia1, soglia2, soglia3,
-                bacino, sottobacino, altitudine
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s
-            ) ON DUPLICATE KEY UPDATE
-                soglia1 = VALUES(soglia1),
-                soglia2 = VALUES(soglia2),
-                soglia3 = VALUES(soglia3),
-                bacino = VALUES(bacino),
-                sottobacino = VALUES(sottobacino),
-                altitudine = VALUES(altitudine)
-            """
-            values = (
-                station_id,
-                tipo_variabile,
-                sensor['soglie'][0],
-                sensor['soglie'][1],
-                sensor['soglie'][2],
-                sensor['bacino'],
-                sensor['sottobacino'],
-                sensor['altitudine']
-            )
-            
-            self.cursor.execute(sql, values)
-            self.connection.commit()
-            logger.info(f">>> Sensore: {tipo_variabile} per stazione {station_id} inserito/aggiornato")
+    def insert_sensors(self, station_id: str, sensors_data: Dict[str, Any],
+                       righe: Optional[List[tuple]] = None) -> None:
+        """Inserisce o aggiorna i dati dei sensori (righe: già calcolate da sensor_rows)."""
+        righe = righe if righe is not None else sensor_rows(station_id, sensors_data)
+        self._upsert('sensori', SENSOR_COLUMNS, SENSOR_KEY_COLUMNS, righe)
+        self._pending_rows += len(righe)
+        for riga in righe:
+            self.registry.update_sensor(station_id, riga[1], riga[2:5])
+            logger.info(f">>> Sensore: {riga[1]} per stazione {station_id} inserito/aggiornato")
 
-    def insert_measurements(self, station_id: str, measurements_data: Dict[str, Any], date_str: str) -> None:
-        
-        # Controlla se la stazione ha multifunzione impostato a 1
-        sql_multifunzione_check = """
-        SELECT multifunzione 
-        FROM stazioni 
-        WHERE id = %s;
+    def insert_measurements(self, station_id: str, measurements_data: Dict[str, Any], date_str: str,
+                            giornata: Optional[DecodedDay] = None) -> int:
+        """Accoda le misurazioni della stazione nel buffer di scrittura massiva.
+
+        Le righe vengono scritte da flush_measurements quando il buffer raggiunge
+        batch_size righe e comunque al termine di process_data; con la scrittura
+        differita passano subito alla coda del writer. giornata è il blocco
+        della data già decodificato, se disponibile.
         """
-        self.cursor.execute(sql_multifunzione_check, (station_id,))
-        result = self.cursor.fetchone()
-        
-        # Procede solo se la stazione ha multifunzione = 1
-        # if result is None or result['multifunzione'] != 1:
-        #     logger.warning(f"La stazione {station_id} non è multifunzione!")
-        #     logger.info("-" * 25)
-        #     return
-        
         # Controlla se measurements_data contiene 'livello_idro' e 'temperatura_istantanea_2m'
         # if not all(key in measurements_data.get(date_str, {}).get(next(iter(measurements_data[date_str])), {}) for key in ['livello_idro', 'temperatura_istantanea_2m']):
         #     logger.warning(f"Misurazioni mancanti: 'livello_idro' e/o 'temperatura_istantanea_2m' per la data {date_str} nella stazione {station_id}.")
         #     logger.info("-" * 25)
         #     return
 
-        # controllo su aggiornamento
-        update = False
-        
         if date_str not in measurements_data:
             logger.warning(f"Nessun dato disponibile per la data {date_str} nella stazione {station_id}")
-            return
+            return 0
 
-        data_formattata_singola = datetime.strptime(date_str, '%Y%m%d').date()
-
-        for ora, misurazioni in measurements_data[date_str].items():
-            ora_formattata_singola = f"{ora[:2]}:{ora[2:]}:00"
-            ora_formattata = f"{ora[:2]}:{ora[2:]}:00"
-            data_formattata = datetime.strptime(f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:]}", '%Y-%m-%d').date()
-            data_ora_rilevazione = datetime.combine(data_formattata, datetime.strptime(ora_formattata, '%H:%M:%S').time())
-
-            for tipo_mis, valore in misurazioni.items():
-                sql = """
-                SELECT COUNT(*) AS conteggio
-                FROM misurazioni
-                WHERE stazione_id = %s AND data_ora_rilevazione = %s AND tipo_misurazione = %s;
-                """
-                self.cursor.execute(sql, (station_id, data_ora_rilevazione, tipo_mis))
-
-                result = self.cursor.fetchone()
-
-                # Verifica se result non è None
-                if result is not None:
-                    count = result['conteggio']  # Estrai il conteggio
-                    if count > 0:
-                        # logger.info(f"Record già presente per la stazione {station_id} con data/ora {data_ora_rilevazione} e tipo {tipo_mis}.")
-                        sql = """
-                        UPDATE misurazioni
-                        SET valore = %s
-                        WHERE stazione_id = %s AND data_ora_rilevazione = %s AND tipo_misurazione = %s;
-                        """
-                        self.cursor.execute(sql, (valore, station_id, data_ora_rilevazione, tipo_mis))
-                        update = True
-                    else:
-                        # logger.info(f"Nuova misurazione da inserire per la stazione {station_id}.")
-                        sql = """
-                        INSERT INTO misurazioni (
-                            stazione_id, data_ora_rilevazione, data_rilevazione, ora_rilevazione, tipo_misurazione, valore
-                        ) VALUES (%s, %s, %s, %s, %s, %s)
-                        """
-                        values = (
-                            station_id,
-                            data_ora_rilevazione,
-                            data_formattata_singola,
-                            ora_formattata_singola,
-                            tipo_mis,
-                            valore
-                        )
-                        self.cursor.execute(sql, values)
-                        update = False
-                else:
-                    logger.warning("Nessun risultato dalla query COUNT.")
-
-        self.connection.commit()
-        if update:
-            logger.info(f">>>>>>>>>> Misurazioni per stazione {station_id} del {date_str} aggiornate")
+        if giornata is None:
+            with self.metrics.time('decode'):
+                giornata = decode_day_block(date_str, measurements_data[date_str])
+        # Solo le misurazioni nuove o cambiate rispetto all'impronta del giorno (nella finestra recente)
+        if self.incremental and giornata.data >= self._known_since.date():
+            cambiate = self.snapshots.diff(str(station_id), giornata.data, giornata.timestamps,
+                                           giornata.tipi, giornata.valori)
+            indici = [i for i, _ in cambiate]
         else:
-            logger.info(f">>>>>>>>>> Misurazioni per stazione {station_id} del {date_str} inserite")
+            indici = range(len(giornata.valori))
+            cambiate = self._stored_changes(station_id, giornata) if self.revision_log else []
+        if self.revision_log:
+            visto_il = datetime.now()
+            self._revision_buffer.extend(
+                (str(station_id), giornata.timestamps[i], self.measurement_type_id(giornata.tipi[i]), vecchio,
+                 giornata.valori[i], visto_il)
+                for i, vecchio in cambiate if vecchio is not ABSENT
+            )
+
+        for i in indici:
+            data_ora_rilevazione, tipo_mis, valore = giornata.timestamps[i], giornata.tipi[i], giornata.valori[i]
+            if self.incremental:
+                self._pending_values[(str(station_id), tipo_mis, data_ora_rilevazione)] = _normalize_value(valore)
+
+            if self.storage.compact_measurements:
+                self._measurement_buffer.append((
+                    station_id,
+                    data_ora_rilevazione,
+                    self.measurement_type_id(tipo_mis),
+                    valore
+                ))
+            else:
+                self._measurement_buffer.append((
+                    station_id,
+                    data_ora_rilevazione,
+                    giornata.data,
+                    giornata.ore[i],
+                    tipo_mis,
+                    valore
+                ))
+        accodate = len(indici)
+        saltate = len(giornata.valori) - accodate
+
+        self._pending_rows += accodate
+        self.rows_skipped += saltate
+        self.metrics.inc('rows_skipped_total', saltate)
+        if self._writer is not None or len(self._measurement_buffer) >= self.batch_size:
+            self.flush_measurements()
+
+        logger.info(
+            f">>>>>>>>>> {accodate} misurazioni per stazione {station_id} del {date_str} accodate"
+            f" ({saltate} invariate saltate)"
+        )
         logger.info("-" * 25)
+        return accodate
 
-    def insert_measurements_OLD(self, station_id: str, measurements_data: Dict[str, Any], date_str: str) -> None:
-        """Inserisce le misurazioni."""
-        if date_str not in measurements_data:
-            logger.warning(f"Nessun dato disponibile per la data {date_str} nella stazione {station_id}")
-            return
+    def _load_stored_day(self, giorno: date) -> None:
+        """Legge con una sola query i valori già salvati del giorno, per tutte le stazioni."""
+        inizio = datetime.combine(giorno, datetime.min.time())
+        with self._storage_lock:
+            righe = self.storage.query(
+                "SELECT stazione_id, data_ora_rilevazione, tipo_misurazione, valore FROM misurazioni_estese"
+                " WHERE data_ora_rilevazione >= %s AND data_ora_rilevazione < %s",
+                (inizio, inizio + timedelta(days=1))
+            )
+        self._stored_values = {}
+        for row in righe:
+            self._stored_values.setdefault(str(row['stazione_id']), {})[
+                (_as_datetime(row['data_ora_rilevazione']), row['tipo_misurazione'])
+            ] = _normalize_value(row['valore'])
+        self._stored_day = giorno
 
-        sql = """
-        INSERT INTO misurazioni (
-            stazione_id, data_ora_rilevazione, data_rilevazione, ora_rilevazione, tipo_misurazione, valore
-        ) VALUES (%s, %s, %s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE valore = VALUES(valore)
+    def _stored_changes(self, station_id: str, giornata: DecodedDay) -> List[Tuple[int, Any]]:
+        """(indice, valore salvato) delle misurazioni del giorno già salvate con un valore diverso.
+
+        Serve per i giorni fuori dalla finestra delle impronte: i valori salvati
+        vengono letti una volta per data (_load_stored_day), all'inizio di ogni
+        process_data, prima di essere sovrascritti.
         """
+        if self._stored_day != giornata.data:
+            self._load_stored_day(giornata.data)
+        salvati = self._stored_values.get(str(station_id))
+        if not salvati:
+            return []
+        cambiate = []
+        for i, chiave in enumerate(zip(giornata.timestamps, giornata.tipi)):
+            if chiave in salvati and salvati[chiave] != _normalize_value(giornata.valori[i]):
+                cambiate.append((i, salvati[chiave]))
+        return cambiate
 
-        data_formattata_singola = datetime.strptime(date_str, '%Y%m%d').date()
+    def flush_measurements(self) -> int:
+        """Scrive il buffer delle misurazioni con upsert massivi da batch_size righe.
 
-        for ora, misurazioni in measurements_data[date_str].items():
-            ora_formattata_singola = f"{ora[:2]}:{ora[2:]}:00"
-            ora_formattata = f"{ora[:2]}:{ora[2:]}:00"
-            data_formattata = datetime.strptime(f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:]}", '%Y-%m-%d').date()
-            data_ora_rilevazione = datetime.combine(data_formattata, datetime.strptime(ora_formattata, '%H:%M:%S').time())
+        Con la scrittura differita il buffer viene solo passato alla coda del
+        writer (attendendo se è piena); restituisce le righe scritte o accodate.
+        """
+        if not self._measurement_buffer:
+            return 0
 
-            for tipo_mis, valore in misurazioni.items():
-                values = (
-                    station_id,
-                    data_ora_rilevazione,
-                    data_formattata_singola,
-                    ora_formattata_singola,
-                    tipo_mis,
-                    valore
+        righe = len(self._measurement_buffer)
+        if self._writer is not None:
+            self._writer.put(self._measurement_buffer)
+            self._measurement_buffer = []
+            return righe
+
+        for i in range(0, righe, self.batch_size):
+            self._write_measurements(self._measurement_buffer[i:i + self.batch_size])
+        self._measurement_buffer.clear()
+        return righe
+
+    def _write_measurements(self, batch: List[tuple]) -> None:
+        """Scrive un blocco di misurazioni (dal loader o dal thread di scrittura differita)."""
+        inizio = time.perf_counter()
+        self._upsert('misurazioni', self._measurement_columns, self._measurement_key_columns, batch, bulk=self.bulk)
+        durata = time.perf_counter() - inizio
+        self._rows_in_transaction += len(batch)
+        self.write_seconds += durata
+        logger.info(f"Scritte {len(batch)} misurazioni in {durata:.2f}s ({len(batch) / max(durata, 1e-9):.0f} righe/s)")
+
+    def commit(self) -> None:
+        """Scrive il buffer delle misurazioni e chiude la transazione corrente."""
+        impronte = self.snapshots.pending_rows(datetime.now())
+        if impronte:
+            self._upsert('impronte_giornaliere', FINGERPRINT_COLUMNS, FINGERPRINT_KEY_COLUMNS, impronte)
+        if self._revision_buffer:
+            # Registro in sola aggiunta: INSERT semplici, mai aggiornamenti di righe esistenti
+            sql = (f"INSERT INTO revisioni_misurazioni ({', '.join(REVISION_COLUMNS)})"
+                   f" VALUES ({', '.join(['%s'] * len(REVISION_COLUMNS))})")
+            with self._storage_lock, self.metrics.time('sql'):
+                for riga in self._revision_buffer:
+                    self.storage.execute(sql, riga)
+                self._rows_by_table['revisioni_misurazioni'] = (
+                    self._rows_by_table.get('revisioni_misurazioni', 0) + len(self._revision_buffer)
                 )
+            logger.info(f"Registrate {len(self._revision_buffer)} correzioni di valori già salvati")
+            self._revision_buffer = []
+        self.flush_measurements()
+        if self._writer is not None:
+            self._writer.drain()
+        inizio = time.perf_counter()
+        with self._storage_lock:
+            self.storage.commit()
+            righe_per_tabella, self._rows_by_table = self._rows_by_table, {}
+        durata = time.perf_counter() - inizio
+        # Le righe si contano solo quando sono confermate: un batch rielaborato vale una volta
+        for tabella, righe in righe_per_tabella.items():
+            self.metrics.inc('rows_written_total', righe, table=tabella)
+        if righe_per_tabella.get('revisioni_misurazioni'):
+            self.metrics.inc('revisions_logged_total', righe_per_tabella['revisioni_misurazioni'])
+        if self._dead_letter_lines:
+            self._write_dead_letter_file()
+        self.metrics.observe('commit_seconds', durata)
+        self.metrics.observe('phase_seconds', durata, phase='commit')
+        self.rows_written += self._rows_in_transaction
+        self._rows_in_transaction = 0
+        self._advance_watermarks()
+        self._station_hashes.update(self._pending_hashes)
+        self._pending_hashes.clear()
+        self._type_ids.update(self._pending_type_ids)
+        self._pending_type_ids.clear()
+        logger.info(f"Commit di {self._pending_rows} righe in {durata * 1000:.1f} ms")
+        self._pending_rows = 0
+        self._batch_started = time.perf_counter()
+
+    def rollback(self) -> None:
+        """Annulla la transazione corrente e lo stato accodato in memoria."""
+        if self._writer is not None:
+            self._writer.discard()
+        self._measurement_buffer.clear()
+        self._rows_in_transaction = 0
+        self._pending_values.clear()
+        self._revision_buffer = []
+        self._dead_letter_lines = []
+        self._pending_type_ids.clear()
+        self.snapshots.rollback()
+        self._pending_hashes.clear()
+        self._pending_rows = 0
+        self._batch_started = time.perf_counter()
+        with self._storage_lock:
+            self._rows_by_table = {}
+            self.storage.rollback()
 
-                self.cursor.execute(sql, values)
+    def invalidate_station(self, station_id: Optional[str] = None) -> None:
+        """Invalida il registro delle stazioni (tutto o una stazione): verrà ricaricato al prossimo ciclo."""
+        self.registry.invalidate(station_id)
 
-        self.connection.commit()
-        logger.info(f">>>>> Misurazioni per stazione {station_id} del {date_str} inserite/aggiornate")
-        logger.info("-" * 25)  # Linea separatrice dopo l'elaborazione
+    def _commit_due(self) -> bool:
+        """Indica se la politica di commit richiede di chiudere il batch corrente."""
+        if self.commit_policy == 'rows':
+            return self._pending_rows >= self.commit_every
+        if self.commit_policy == 'ms':
+            return (time.perf_counter() - self._batch_started) * 1000 >= self.commit_every
+        return False
 
-    def process_data(self, selected_date: str) -> None:
-        """Elabora i dati dall'API e li inserisce nel database."""
+    def _process_item(self, item: Dict[str, Any], selected_date: str) -> None:
+        """Scrive stazione, sensori e misurazioni di un singolo item dell'API.
+
+        Anagrafica e sensori vengono riscritti solo se la loro impronta è cambiata.
+        Tutte le righe vengono calcolate prima di scrivere: un item malformato
+        finisce negli scarti senza lasciare scritture parziali nel batch.
+        """
         try:
-            # Recupera i dati dall'API
-            json_data = self.fetch_data_from_api(selected_date)
-            
-            # ATTENZIONE: Processa solo la prima stazione
-            # if json_data['_items']:
-            #     item = json_data['_items'][0]
-
-            # ATTENZIONE: Processa ogni stazione
-            if json_data['_items']:
-              for item in json_data['_items']:
-
-                # Inserisce i dati della stazione
-                self.insert_station(item)
-                
-                # Inserisce i dati dei sensori
-                if 'sensori' in item['anagrafica']:
-                    self.insert_sensors(item['_id'], item['anagrafica']['sensori'])
-                
-                # Inserisce le misurazioni
-                if 'dati' in item:
-                    self.insert_measurements(item['_id'], item['dati'], selected_date)
-                    
+            station_id = str(item['_id'])
+            ana = item['anagrafica']
+            hash_anagrafica, hash_sensori = station_hashes(ana)
+            precedenti = self._pending_hashes.get(station_id) or self._station_hashes.get(station_id)
+
+            riga_stazione = None
+            if precedenti is None or precedenti[0] != hash_anagrafica:
+                riga_stazione = station_row(item)
+
+            righe_sensori = None
+            if 'sensori' in ana and (precedenti is None or precedenti[1] != hash_sensori):
+                righe_sensori = sensor_rows(item['_id'], ana['sensori'])
+
+            giornata = None
+            if 'dati' in item and selected_date in item['dati']:
+                with self.metrics.time('decode'):
+                    giornata = decode_day_block(selected_date, item['dati'][selected_date])
+                check_values(giornata)
+        except ITEM_ERRORS as e:
+            self.dead_letter(item, selected_date, e)
+            return
+
+        # Inserisce i dati della stazione
+        if riga_stazione is not None:
+            self.insert_station(item, riga_stazione)
+
+        # Inserisce i dati dei sensori
+        if righe_sensori is not None:
+            self.insert_sensors(item['_id'], ana['sensori'], righe_sensori)
+
+        if precedenti == (hash_anagrafica, hash_sensori):
+            self.stations_skipped += 1
+        else:
+            self.save_station_hash(station_id, hash_anagrafica, hash_sensori)
+
+        # Inserisce le misurazioni
+        if 'dati' in item:
+            self.insert_measurements(item['_id'], item['dati'], selected_date, giornata)
+
+    def dead_letter(self, item: Any, selected_date: str, errore: Exception) -> None:
+        """Mette da parte un item malformato, con il JSON originale e l'errore, senza fermare il batch.
+
+        Gli scarti vanno nella tabella scarti (nella stessa transazione del batch)
+        oppure, se è configurato dead_letter_file, in un file JSON Lines dopo il
+        commit del batch. Una stazione che resta malformata viene registrata una
+        volta sola per (data_richiesta, stazione_id, errore).
+        """
+        station_id = str(item.get('_id')) if isinstance(item, dict) else None
+        descrizione = f"{type(errore).__name__}: {errore}"
+        logger.warning(f"Stazione {station_id} del {selected_date} scartata ({descrizione})")
+        self.items_dead_lettered += 1
+        self.metrics.inc('items_dead_lettered_total')
+
+        if self.dead_letter_file:
+            riga = json.dumps({
+                'data_richiesta': selected_date,
+                'stazione_id': station_id,
+                'errore': descrizione,
+                'registrato_il': datetime.now().isoformat(),
+                'item': item
+            }, default=str, ensure_ascii=False)
+            self._dead_letter_lines.append(((selected_date, station_id, descrizione), riga))
+            self._pending_rows += 1
+            return
+
+        with self._storage_lock:
+            presente = self.storage.query(
+                "SELECT 1 AS presente FROM scarti"
+                " WHERE data_richiesta = %s AND COALESCE(stazione_id, '') = %s AND errore = %s",
+                (selected_date, station_id or '', descrizione)
+            )
+            if presente:
+                return
+            self.storage.execute(
+                "INSERT INTO scarti (data_richiesta, stazione_id, errore, item_json, registrato_il)"
+                " VALUES (%s, %s, %s, %s, %s)",
+                (selected_date, station_id, descrizione, json.dumps(item, default=str, ensure_ascii=False),
+                 datetime.now())
+            )
+        self._pending_rows += 1
+
+    def _write_dead_letter_file(self) -> None:
+        """Aggiunge a dead_letter_file gli scarti del batch appena confermato non ancora presenti."""
+        with _DEAD_LETTER_LOCK:
+            if self._dead_letter_keys is None:
+                self._dead_letter_keys = set()
+                if os.path.exists(self.dead_letter_file):
+                    with open(self.dead_letter_file, encoding='utf-8') as f:
+                        for riga in f:
+                            scarto = json.loads(riga)
+                            self._dead_letter_keys.add((scarto['data_richiesta'], scarto['stazione_id'], scarto['errore']))
+            with open(self.dead_letter_file, 'a', encoding='utf-8') as f:
+                for chiave, riga in self._dead_letter_lines:
+                    if chiave not in self._dead_letter_keys:
+                        self._dead_letter_keys.add(chiave)
+                        f.write(riga + '\n')
+        self._dead_letter_lines = []
+
+    def _replay_batch(self, batch: List[Dict[str, Any]], selected_date: str,
+                      err: Exception, commit: bool) -> bool:
+        """Annulla il batch fallito e lo rielabora da capo, senza toccare quelli già confermati.
+
+        Se tutti i tentativi falliscono con lo stesso errore del primo, il
+        database sta rifiutando un valore (es. testo troppo lungo): il batch
+        viene ripreso una stazione alla volta e solo quelle rifiutate finiscono
+        negli scarti. Restituisce True se il batch è già stato confermato.
+        L'attesa tra i tentativi è breve e si interrompe con stop_event: in
+        quel caso il batch resta annullato e l'errore risale.
+        """
+        primo = err
+        for tentativo in range(1, self.max_batch_retries + 1):
+            logger.warning(
+                f"Batch di {len(batch)} stazioni annullato ({err}): "
+                f"nuovo tentativo {tentativo}/{self.max_batch_retries}"
+            )
+            self.rollback()
+            attesa = min(REPLAY_BACKOFF_SECONDS * 2 ** (tentativo - 1), REPLAY_BACKOFF_MAX_SECONDS)
+            if self.stop_event is None:
+                time.sleep(attesa)
+            elif self.stop_event.wait(attesa):
+                logger.warning(f"Arresto richiesto: batch di {len(batch)} stazioni non rielaborato")
+                raise err
+            try:
+                for item in batch:
+                    self._process_item(item, selected_date)
+                if commit:
+                    self.commit()
+                return commit
+            except self.storage.errors as e:
+                err = e
+        if type(err) is type(primo) and str(err) == str(primo):
+            self._isolate_items(batch, selected_date, err)
+            return True
+        raise err
+
+    def _isolate_items(self, batch: List[Dict[str, Any]], selected_date: str, err: Exception) -> None:
+        """Riprende il batch una stazione per transazione, scartando quelle che il database rifiuta."""
+        logger.warning(f"Batch di {len(batch)} stazioni rifiutato dal database ({err}): ripresa per singola stazione")
+        self.rollback()
+        for item in batch:
+            try:
+                self._process_item(item, selected_date)
+                self.commit()
+            except self.storage.errors as e:
+                self.rollback()
+                self.dead_letter(item, selected_date, e)
+                # Se il database non risponde, anche lo scarto fallisce e l'errore risale
+                self.commit()
+
+    def process_data(self, selected_date: str, items: Optional[Iterable[Dict[str, Any]]] = None,
+                     filters: Optional[Dict[str, Any]] = None) -> int:
+        """Elabora i dati dall'API e li inserisce nel database.
+
+        Le stazioni vengono scritte in transazioni delimitate dalla politica di
+        commit: se un batch fallisce viene annullato e ripreso solo quel batch.
+        Se items è indicato (es. da un archivio) l'API non viene interrogata;
+        filters restringe la query alle stazioni indicate (es. uno shard).
+        Restituisce il numero di misurazioni scritte e confermate (le righe
+        di un batch annullato e rielaborato si contano una volta sola).
+        """
+        inizio_esecuzione = time.perf_counter()
+        try:
+            # In modalità delta si scaricano solo gli slot successivi al watermark
+            completa = False
+            inizio_fetch = time.monotonic()
+            if items is None:
+                slots = self.delta_slots(selected_date)
+                # Una query filtrata non riconcilia l'intera giornata
+                completa = slots is None and not filters
+                if slots is not None:
+                    logger.info(f"Fetch delta del {selected_date}: {len(slots)} slot da {slots[0]}")
+                elif self.delta_fetch:
+                    logger.info(f"Fetch completo del {selected_date} (riconciliazione)")
+
+            # Recupera i dati dall'API (a pagine o in streaming, una stazione alla volta)
+            if items is None and len(self.variables) > 1:
+                items = self.fetch_variables(selected_date, slots, filters)
+            elif items is None and self.page_size:
+                items = self.iter_pages_from_api(selected_date, slots, filters)
+            elif items is None and self.stream:
+                items = self.iter_items_from_api(selected_date, slots, filters)
+            elif items is None:
+                items = self.fetch_data_from_api(selected_date, slots, filters)['_items']
+            inizio = time.perf_counter()
+            righe_iniziali = self.rows_written
+            # Il registro si ricarica solo qui, mai durante la scrittura delle stazioni
+            if self.registry.is_stale():
+                self.registry.load(self.storage)
+            # I valori salvati letti da un'esecuzione precedente non sono più attuali
+            self._stored_day = None
+            self._stored_values = {}
+            saltate_iniziali = self.rows_skipped
+            stazioni_iniziali = self.stations_skipped
+            scarti_iniziali = self.items_dead_lettered
+            self._pending_rows = 0
+            self._batch_started = time.perf_counter()
+
+            # Item del batch non ancora confermato, da rielaborare in caso di errore
+            batch: List[Dict[str, Any]] = []
+            interrotta = False
+
+            for item in items:
+                batch.append(item)
+                try:
+                    self._process_item(item, selected_date)
+                except self.storage.errors as err:
+                    if self._replay_batch(batch, selected_date, err, commit=False):
+                        batch = []
+
+                if self._commit_due() or len(batch) >= self.max_batch_items:
+                    try:
+                        self.commit()
+                    except self.storage.errors as err:
+                        self._replay_batch(batch, selected_date, err, commit=True)
+                    batch = []
+
+                    # Con l'arresto richiesto ci si ferma al confine del batch appena confermato
+                    if self.stop_event is not None and self.stop_event.is_set():
+                        interrotta = True
+                        break
+
+            if interrotta:
+                logger.warning(f"Arresto richiesto: elaborazione del {selected_date} interrotta dopo l'ultimo batch")
+                if hasattr(items, 'close'):
+                    items.close()
+
+            # Conferma l'ultimo batch e le misurazioni rimaste nel buffer
+            try:
+                self.commit()
+            except self.storage.errors as err:
+                self._replay_batch(batch, selected_date, err, commit=True)
+
+            righe = self.rows_written - righe_iniziali
+            durata = time.perf_counter() - inizio
+            logger.info(
+                f"Misurazioni scritte: {righe} in {durata:.2f}s ({righe / max(durata, 1e-9):.0f} righe/s), "
+                f"invariate saltate: {self.rows_skipped - saltate_iniziali}, "
+                f"stazioni con anagrafica invariata: {self.stations_skipped - stazioni_iniziali}, "
+                f"stazioni scartate: {self.items_dead_lettered - scarti_iniziali}"
+            )
             logger.info(f"Elaborazione dei dati per la data {selected_date} completata con successo")
-            
+            if completa and not interrotta:
+                self._last_full_fetch[selected_date] = inizio_fetch
+            self.metrics.inc('runs_total', status='ok')
+            self.metrics.set('last_run_timestamp_seconds', time.time())
+            self.metrics.set('last_run_duration_seconds', time.perf_counter() - inizio_esecuzione)
+            return righe
+
         except Exception as e:
             logger.error(f"Errore durante l'elaborazione dei dati: {str(e)}")
-            self.connection.rollback()
+            self.metrics.inc('runs_total', status='error')
+            self.rollback()
             raise
 
+        finally:
+            if self.metrics_file:
+                self.metrics.write_textfile(self.metrics_file)
+
     def close(self):
-        """Chiude la connessione al database."""
-        self.cursor.close()
-        self.connection.close()
+        """Conferma le righe ancora nel buffer o nella coda di scrittura differita e chiude la connessione."""
+        try:
+            if self._pending_rows:
+                # commit svuota buffer e coda e scrive anche impronte e revisioni della transazione
+                self.commit()
+        except Exception as e:
+            logger.error(f"Righe non confermate alla chiusura, perse: {self._pending_rows} ({str(e)})")
+            self.rollback()
+        finally:
+            if self._writer is not None:
+                self._writer.close()
+            self.storage.close()
         logger.info("Connessione al database chiusa")
 
 def main():
@@ -353,30 +1253,587 @@ def main():
         if 'loader' in locals():
             loader.close()
 
-def scheduled_data_import():
-    while True:
-        main()
-        logger.info("Elaborazione dei dati completata. Attendo 30 minuti per il prossimo ciclo.")
-        logger.info("")  # Riga vuota alla fine
-        # time.sleep(1800)  # Attesa di 30 minuti
-        time.sleep(5)  # Attesa di 5 minuti
+def date_range(start: str, end: str) -> List[str]:
+    """Elenca le date YYYYMMDD da start a end inclusi."""
+    inizio = datetime.strptime(start, '%Y%m%d').date()
+    fine = datetime.strptime(end, '%Y%m%d').date()
+    if fine < inizio:
+        raise ValueError(f"Intervallo di date non valido: {start} > {end}")
+    return [(inizio + timedelta(days=i)).strftime('%Y%m%d') for i in range((fine - inizio).days + 1)]
+
+class BackfillCheckpoint:
+    """Registro su file delle date già importate, per riprendere un backfill interrotto."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._completate = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._completate = set(json.load(f).get('completate', []))
 
-def signal_handler(sig, frame):
-    logger.info("Interruzione rilevata. Chiusura in corso...")
-    sys.exit(0)
+    def is_done(self, selected_date: str) -> bool:
+        return selected_date in self._completate
+
+    def mark_done(self, selected_date: str) -> None:
+        """Registra la data e riscrive il file in modo atomico."""
+        with self._lock:
+            self._completate.add(selected_date)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'completate': sorted(self._completate)}, f)
+            os.replace(tmp_path, self.path)
+
+def backfill(start: str, end: str, workers: int = 4, checkpoint_path: Optional[str] = None,
+             backend: Optional[str] = None, db_path: Optional[str] = None, **loader_options: Any) -> bool:
+    """Importa in parallelo tutte le date dell'intervallo non ancora presenti nel checkpoint.
+
+    Ogni thread del pool usa un proprio ArpaeDataLoader (e quindi una propria
+    connessione al backend indicato). Restituisce False se almeno una data non
+    è stata importata.
+    """
+    backend = backend or os.getenv('DB_BACKEND', 'mysql')
+    config = LoaderConfig.from_env(**loader_options)
+    if backend == 'duckdb':
+        # Le connessioni DuckDB dei thread vanno in conflitto sugli upsert di stazioni e sensori
+        raise ValueError("Il backfill parallelo richiede un backend con più connessioni in scrittura (mysql o sqlite)")
+    checkpoint = BackfillCheckpoint(checkpoint_path or f"logs/backfill_{start}_{end}.json")
+    date_da_importare = [d for d in date_range(start, end) if not checkpoint.is_done(d)]
+    logger.info(
+        f"Backfill {start}-{end}: {len(date_da_importare)} date da importare "
+        f"con {workers} worker (checkpoint: {checkpoint.path})"
+    )
+
+    locale = threading.local()
+    loaders: List[ArpaeDataLoader] = []
+    loaders_lock = threading.Lock()
+
+    def importa(selected_date: str) -> int:
+        loader = getattr(locale, 'loader', None)
+        if loader is None:
+            loader = locale.loader = ArpaeDataLoader(config, storage=create_storage(backend, db_path))
+            with loaders_lock:
+                loaders.append(loader)
+        righe = loader.process_data(selected_date)
+        checkpoint.mark_done(selected_date)
+        return righe
+
+    fallite = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(importa, d): d for d in date_da_importare}
+            for completate, future in enumerate(as_completed(futures), 1):
+                selected_date = futures[future]
+                try:
+                    righe = future.result()
+                    logger.info(f"[{completate}/{len(futures)}] Data {selected_date} importata: {righe} misurazioni")
+                except Exception as e:
+                    fallite.append(selected_date)
+                    logger.error(f"[{completate}/{len(futures)}] Data {selected_date} non importata: {str(e)}")
+    finally:
+        for loader in loaders:
+            loader.close()
+
+    if fallite:
+        logger.error(f"Backfill incompleto, date da ripetere: {', '.join(sorted(fallite))}")
+    else:
+        logger.info(f"Backfill {start}-{end} completato")
+    return not fallite
+
+def replay(start: str, end: str, archive_dir: str, latest_only: bool = False,
+           backend: Optional[str] = None, db_path: Optional[str] = None, **loader_options: Any) -> bool:
+    """Rigioca nel database gli archivi delle risposte ARPAE dell'intervallo, senza accedere alla rete.
+
+    Con latest_only viene rigiocato solo l'ultimo archivio completo di ogni data
+    (non un fetch delta o filtrato; es. per reimportare dopo una modifica dello
+    schema). Gli archivi di query paginate o di più variabili contengono gli
+    item riserializzati, non i byte ricevuti (vedi archive.py): il rigioco
+    riproduce i valori, non la risposta originale. Restituisce False se almeno
+    un archivio non è stato importato.
+    """
+    archivio = ResponseArchive(archive_dir)
+    loader = ArpaeDataLoader(LoaderConfig.from_env(**loader_options), storage=create_storage(backend, db_path))
+    inizio = time.perf_counter()
+    righe = 0
+    falliti = []
+    try:
+        for selected_date in date_range(start, end):
+            percorsi = archivio.list_archives(selected_date, complete_only=latest_only)
+            if latest_only:
+                percorsi = percorsi[-1:]
+            for percorso in percorsi:
+                try:
+                    righe += loader.process_data(selected_date, items=archivio.iter_items(percorso))
+                    logger.info(f"Archivio rigiocato: {percorso}")
+                except Exception as e:
+                    falliti.append(percorso)
+                    logger.error(f"Archivio {percorso} non rigiocato: {str(e)}")
+    finally:
+        loader.close()
+
+    durata = time.perf_counter() - inizio
+    logger.info(f"Replay {start}-{end}: {righe} misurazioni in {durata:.2f}s ({righe / max(durata, 1e-9):.0f} righe/s)")
+    return not falliti
+
+def fetch_range(start: str, end: str, chunk_days: int = FETCH_CHUNK_DAYS,
+                backend: Optional[str] = None, db_path: Optional[str] = None, **loader_options: Any) -> bool:
+    """Importa l'intervallo scaricando insieme tutte le variabili di chunk_days date alla volta.
+
+    Le query (data, variabile) di ogni blocco partono in parallelo; le date del
+    blocco vengono poi scritte in ordine con le stazioni già unite. Restituisce
+    False se almeno una data non è stata importata.
+    """
+    loader = ArpaeDataLoader(LoaderConfig.from_env(**loader_options), storage=create_storage(backend, db_path))
+    date = date_range(start, end)
+    fallite = []
+    try:
+        for i in range(0, len(date), chunk_days):
+            blocco = date[i:i + chunk_days]
+            try:
+                per_data = fetch_merged(blocco, loader.variables, concurrency=loader.fetch_concurrency,
+                                        client=loader.client, archive=loader.archive, metrics=loader.metrics,
+                                        page_size=loader.page_size)
+            except Exception as e:
+                fallite.extend(blocco)
+                logger.error(f"Date {blocco[0]}-{blocco[-1]} non scaricate: {str(e)}")
+                continue
+            for selected_date in blocco:
+                try:
+                    righe = loader.process_data(selected_date, items=per_data.pop(selected_date))
+                    logger.info(f"Data {selected_date} importata ({', '.join(loader.variables)}): {righe} misurazioni")
+                except Exception as e:
+                    fallite.append(selected_date)
+                    logger.error(f"Data {selected_date} non importata: {str(e)}")
+    finally:
+        loader.close()
+
+    if fallite:
+        logger.error(f"Importazione incompleta, date da ripetere: {', '.join(fallite)}")
+    return not fallite
+
+def _ingest_shard(selected_date: str, key: str, values: List[Any], backend: Optional[str],
+                  db_path: Optional[str], config: LoaderConfig) -> Tuple[int, float, int]:
+    """Importa le stazioni di uno shard in un processo worker, con una propria connessione.
+
+    Restituisce (misurazioni scritte, durata in secondi, pid del worker).
+    """
+    inizio = time.perf_counter()
+    loader = ArpaeDataLoader(config, storage=create_storage(backend, db_path))
+    try:
+        righe = loader.process_data(selected_date, filters=field_filter(key, values))
+    finally:
+        loader.close()
+    return righe, time.perf_counter() - inizio, os.getpid()
+
+def sharded_ingest(start: str, end: str, key: str = 'macroarea', shards: Optional[int] = None,
+                   journal_path: Optional[str] = None, backend: Optional[str] = None,
+                   db_path: Optional[str] = None, **loader_options: Any) -> bool:
+    """Importa l'intervallo suddividendo le stazioni per macroarea o bacino tra più processi.
+
+    Le stazioni vengono divise in shards gruppi (default: SHARDS, altrimenti il
+    numero di CPU) bilanciati per numero di stazioni; ogni coppia (data, shard)
+    viene importata da un processo worker con un proprio ArpaeDataLoader e una
+    propria connessione, interrogando ARPAE solo per le stazioni dello shard.
+    Il coordinatore annota avvio ed esito di ogni shard nel run journal
+    (journal_path, default logs/shards_<key>.jsonl) e salta quelli già
+    completati. Restituisce False se almeno uno shard non è stato importato.
+    """
+    backend = backend or os.getenv('DB_BACKEND', 'mysql')
+    if backend == 'duckdb':
+        # Un file DuckDB accetta scritture da un solo processo alla volta
+        raise ValueError("L'importazione a shard richiede un backend con più connessioni in scrittura (mysql o sqlite)")
+    shards = shards or int(os.getenv('SHARDS', str(os.cpu_count() or 1)))
+    journal = RunJournal(journal_path or f"logs/shards_{key}.jsonl")
+    run_id = f"{datetime.now():%Y%m%d%H%M%S}-{os.getpid()}"
+    # Le metriche e il file di metriche sono del coordinatore, non dei worker
+    config = LoaderConfig.from_env(**loader_options)
+    metrics_file = config.metrics_file
+    config = replace(config, metrics_file=None)
+
+    partizioni = list_partitions(key, config.variables)
+    gruppi = assign_shards(partizioni, shards)
+    lavori = [
+        (d, valori) for d in date_range(start, end) for valori in gruppi
+        if not journal.is_done(d, shard_id(key, valori))
+    ]
+    logger.info(
+        f"Importazione a shard {start}-{end}: {sum(partizioni.values())} stazioni in {len(partizioni)} "
+        f"valori di {key}, {len(gruppi)} shard, {len(lavori)} coppie (data, shard) da importare "
+        f"(journal: {journal.path})"
+    )
+    if not lavori:
+        return True
+
+    inizio = time.perf_counter()
+    righe_totali = 0
+    falliti = []
+    # spawn: i worker non ereditano connessioni, sessioni HTTP e lock del coordinatore
+    contesto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=len(gruppi), mp_context=contesto) as pool:
+        futures = {}
+        for selected_date, valori in lavori:
+            shard = shard_id(key, valori)
+            journal.record(run_id, selected_date, shard, 'avviato')
+            futures[pool.submit(_ingest_shard, selected_date, key, valori, backend, db_path,
+                                config)] = (selected_date, shard)
+        for completati, future in enumerate(as_completed(futures), 1):
+            selected_date, shard = futures[future]
+            try:
+                righe, durata, pid = future.result()
+            except Exception as e:
+                falliti.append((selected_date, shard))
+                journal.record(run_id, selected_date, shard, 'fallito', errore=str(e))
+                METRICS.inc('shard_runs_total', status='error')
+                logger.error(f"[{completati}/{len(futures)}] Shard {shard} del {selected_date} non importato: {str(e)}")
+                continue
+            righe_totali += righe
+            journal.record(run_id, selected_date, shard, 'completato', righe=righe,
+                           durata=round(durata, 3), pid=pid)
+            METRICS.inc('shard_runs_total', status='ok')
+            logger.info(f"[{completati}/{len(futures)}] Shard {shard} del {selected_date} importato "
+                        f"dal processo {pid}: {righe} misurazioni in {durata:.2f}s")
+
+    durata = time.perf_counter() - inizio
+    logger.info(f"Importazione a shard {start}-{end}: {righe_totali} misurazioni in {durata:.2f}s "
+                f"({righe_totali / max(durata, 1e-9):.0f} righe/s)")
+    if metrics_file:
+        METRICS.write_textfile(metrics_file)
+    if falliti:
+        logger.error(f"Importazione a shard incompleta, da ripetere: "
+                     f"{', '.join(f'{d} {s}' for d, s in sorted(falliti))}")
+    return not falliti
+
+class IngestDaemon:
+    """Importazione periodica e non interattiva della data odierna.
+
+    Le esecuzioni seguono una griglia fissa (avvio + k * interval), quindi la
+    durata di un ciclo non sposta i successivi; un ciclo più lungo
+    dell'intervallo fa saltare i turni persi invece di accavallare due
+    esecuzioni. Un lock file impedisce di avviare due demoni sullo stesso
+    database. SIGTERM e SIGINT fermano il demone dopo il batch in corso.
+
+    Con adaptive (default: ADAPTIVE_POLLING=1) la griglia fissa è sostituita
+    da PublicationModel: attesa lunga fino alla pubblicazione prevista del
+    prossimo slot, interrogazioni fitte subito dopo.
+    Con burst (default: BURST_POLLING=1), tra un ciclo e l'altro i bacini con
+    idrometri vicini alle soglie (FloodWatch) vengono interrogati ogni
+    burst_interval secondi con una query ristretta alle loro stazioni.
+    """
+
+    def __init__(self, interval: Optional[float] = None, lock_path: Optional[str] = None,
+                 backend: Optional[str] = None, db_path: Optional[str] = None,
+                 adaptive: Optional[bool] = None, burst: Optional[bool] = None, **loader_options: Any):
+        self.interval = interval or float(os.getenv('INGEST_INTERVAL', '1800'))
+        self.adaptive = adaptive if adaptive is not None else os.getenv('ADAPTIVE_POLLING', '0') == '1'
+        self.model = PublicationModel(max_wait=self.interval) if self.adaptive else None
+        burst = burst if burst is not None else os.getenv('BURST_POLLING', '0') == '1'
+        self.flood_watch = FloodWatch() if burst else None
+        self._alert_basins: set = set()
+        self.lock_path = lock_path or os.getenv('DAEMON_LOCK_FILE', 'logs/arpae_daemon.lock')
+        self.backend = backend
+        self.db_path = db_path
+        self.config = LoaderConfig.from_env(**loader_options)
+        self.stop_event = threading.Event()
+        self.loader: Optional[ArpaeDataLoader] = None
+        self._lock_file = None
+        self._ultima_data: Optional[str] = None
+
+    def request_stop(self, signum=None, frame=None) -> None:
+        logger.info(f"Segnale {signum} ricevuto: arresto dopo il batch in corso")
+        self.stop_event.set()
+
+    def _acquire_lock(self) -> None:
+        self._lock_file = open(self.lock_path, 'a+')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"Un'altra importazione è già in esecuzione (lock: {self.lock_path})")
+        self._lock_file.seek(0)
+        self._lock_file.truncate()
+        self._lock_file.write(f"{os.getpid()}\n")
+        self._lock_file.flush()
+
+    def _release_lock(self) -> None:
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def run_once(self) -> None:
+        """Importa la data odierna; al cambio di giorno riprende anche la data precedente."""
+        oggi = date.today().strftime('%Y%m%d')
+        date_da_importare = [oggi]
+        if self._ultima_data is not None and self._ultima_data != oggi:
+            # Gli ultimi slot del giorno prima possono arrivare dopo la mezzanotte
+            date_da_importare.insert(0, self._ultima_data)
+        for selected_date in date_da_importare:
+            if self.stop_event.is_set():
+                break
+            try:
+                self.loader.process_data(selected_date)
+            except Exception as e:
+                # L'errore è già registrato da process_data: il demone resta attivo
+                logger.error(f"Ciclo del {selected_date} non completato: {str(e)}")
+        self._ultima_data = oggi
+
+    def _update_alerts(self) -> set:
+        """Ricalcola i bacini in allerta e registra quelli che entrano o escono dal regime ravvicinato."""
+        bacini = self.flood_watch.alert_basins(self.loader.registry.stations(), self.loader.latest_values())
+        for bacino in sorted(bacini - self._alert_basins, key=str):
+            logger.warning(f"Bacino {bacino[0]}/{bacino[1]} vicino alle soglie: interrogazioni ravvicinate")
+        for bacino in sorted(self._alert_basins - bacini, key=str):
+            logger.info(f"Bacino {bacino[0]}/{bacino[1]} rientrato: cadenza normale")
+        self._alert_basins = bacini
+        self.loader.metrics.set('basins_in_alert', len(bacini))
+        return bacini
+
+    def run_burst(self, bacini: set) -> None:
+        """Ciclo ravvicinato sulle sole stazioni dei bacini in allerta."""
+        oggi = date.today().strftime('%Y%m%d')
+        try:
+            items = self.loader.fetch_data_from_api(oggi, self.loader.delta_slots(oggi), basin_filter(bacini))['_items']
+            self.loader.process_data(oggi, items=items)
+            self.loader.metrics.inc('burst_runs_total')
+        except Exception as e:
+            logger.error(f"Ciclo ravvicinato del {oggi} non completato: {str(e)}")
+
+    def _sleep_until(self, scadenza: float) -> None:
+        """Attende fino a scadenza (monotonic), eseguendo nel frattempo i cicli ravvicinati."""
+        while not self.stop_event.is_set():
+            restante = scadenza - time.monotonic()
+            if restante <= 0:
+                return
+            bacini = self._update_alerts() if self.flood_watch is not None else set()
+            if not bacini:
+                self.stop_event.wait(restante)
+                return
+            if self.stop_event.wait(min(restante, self.flood_watch.burst_interval)):
+                return
+            if time.monotonic() < scadenza:
+                self.run_burst(bacini)
+
+    def _adaptive_delay(self) -> float:
+        """Aggiorna il modello con l'ultimo slot salvato e calcola l'attesa fino al prossimo ciclo."""
+        adesso = datetime.now()
+        ieri = (date.today() - timedelta(days=1)).strftime('%Y%m%d')
+        ultimi = [self.loader.latest_slot(d) for d in (ieri, self._ultima_data)]
+        ultimo = max((u for u in ultimi if u is not None), default=None)
+        if self.model.observe(ultimo, adesso):
+            logger.info(f"Nuovo slot {ultimo:%Y-%m-%d %H:%M} visto alle {adesso:%H:%M:%S}")
+        ritardo = self.model.expected_lag()
+        attesa = self.model.next_delay(adesso)
+        self.loader.metrics.set('publication_lag_seconds', ritardo)
+        self.loader.metrics.set('next_poll_seconds', attesa)
+        if ultimo is not None:
+            self.loader.metrics.set('data_freshness_seconds', (adesso - ultimo).total_seconds())
+        logger.info(f"Ritardo di pubblicazione stimato {ritardo:.0f}s, prossima interrogazione tra {attesa:.0f}s")
+        return attesa
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        self._acquire_lock()
+        try:
+            self.loader = ArpaeDataLoader(self.config, storage=create_storage(self.backend, self.db_path),
+                                          stop_event=self.stop_event)
+            logger.info(f"Demone avviato: importazione ogni {self.interval:.0f}s (pid {os.getpid()})")
+            prossima = time.monotonic()
+            while not self.stop_event.is_set():
+                self.run_once()
+                if self.stop_event.is_set():
+                    break
+
+                if self.model is not None:
+                    self._sleep_until(time.monotonic() + self._adaptive_delay())
+                    continue
+
+                prossima += self.interval
+                adesso = time.monotonic()
+                if adesso >= prossima:
+                    saltati = int((adesso - prossima) // self.interval) + 1
+                    prossima += saltati * self.interval
+                    self.loader.metrics.inc('daemon_ticks_skipped_total', saltati)
+                    logger.warning(f"Ciclo più lungo dell'intervallo: {saltati} esecuzioni saltate")
+                logger.info(f"Prossima importazione tra {prossima - adesso:.0f}s")
+                self._sleep_until(prossima)
+        finally:
+            if self.loader is not None:
+                self.loader.close()
+            self._release_lock()
+            logger.info("Demone arrestato")
+
+def _add_loader_arguments(parser: argparse.ArgumentParser) -> None:
+    """Opzioni di ArpaeDataLoader comuni a tutti i comandi."""
+    parser.add_argument('--batch-size', type=int, help="Misurazioni per INSERT multi-riga")
+    parser.add_argument('--commit-policy', choices=COMMIT_POLICIES, help="Quando chiudere le transazioni")
+    parser.add_argument('--commit-every', type=int, help="Righe o millisecondi tra due commit")
+    parser.add_argument('--max-batch-items', type=int,
+                        help="Stazioni dopo cui il commit viene comunque anticipato (default: MAX_BATCH_ITEMS o 1000)")
+    parser.add_argument('--stream', action='store_true', default=None, help="Legge la risposta in streaming")
+    parser.add_argument('--backend', choices=STORAGE_BACKENDS, help="Database di destinazione (default: DB_BACKEND)")
+    parser.add_argument('--db-path', help="File del database per i backend sqlite e duckdb")
+    parser.add_argument('--variables', type=lambda s: [v.strip() for v in s.split(',') if v.strip()],
+                        help="Variabili ARPAE separate da virgola (default: ARPAE_VARIABLES o livello_idro)")
+    parser.add_argument('--fetch-concurrency', type=int, help="Query o pagine ARPAE scaricate in parallelo")
+    parser.add_argument('--delta', dest='delta_fetch', action='store_true', default=None,
+                        help="Scarica solo gli slot successivi al watermark (riconciliazione periodica)")
+    parser.add_argument('--reconcile-interval', type=float, help="Secondi tra due fetch completi in modalità delta")
+    parser.add_argument('--page-size', type=int, help="Stazioni per pagina (0: una sola richiesta)")
+    parser.add_argument('--dead-letter-file', help="Scrive gli item malformati in questo file JSON Lines")
+    parser.add_argument('--write-behind', action='store_true', default=None,
+                        help="Scrive le misurazioni da un thread dedicato mentre prosegue il download")
+    parser.add_argument('--bulk', action='store_true', default=None,
+                        help="Caricamento massivo per importazioni storiche (LOAD DATA in MySQL)")
+    parser.add_argument('--metrics-file', help="Scrive le metriche Prometheus in questo file dopo ogni esecuzione")
+    parser.add_argument('--metrics-port', type=int, help="Espone le metriche Prometheus su http://0.0.0.0:PORT/metrics")
+
+def _loader_options(args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        'backend': args.backend,
+        'db_path': args.db_path,
+        'batch_size': args.batch_size,
+        'commit_policy': args.commit_policy,
+        'commit_every': args.commit_every,
+        'max_batch_items': args.max_batch_items,
+        'stream': args.stream,
+        'metrics_file': args.metrics_file,
+        'dead_letter_file': args.dead_letter_file,
+        'variables': args.variables,
+        'fetch_concurrency': args.fetch_concurrency,
+        'page_size': args.page_size,
+        'delta_fetch': args.delta_fetch,
+        'reconcile_interval': args.reconcile_interval,
+        'bulk': args.bulk,
+        'write_behind': args.write_behind,
+    }
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Importa i dati idrometrici ARPAE nel database.")
+    comandi = parser.add_subparsers(dest='comando')
+
+    parser_backfill = comandi.add_parser('backfill', help="Importa in parallelo un intervallo di date")
+    parser_backfill.add_argument('--start', required=True, help="Prima data da importare (YYYYMMDD)")
+    parser_backfill.add_argument('--end', required=True, help="Ultima data da importare (YYYYMMDD)")
+    parser_backfill.add_argument('--workers', type=int, default=4, help="Numero di date importate in parallelo")
+    parser_backfill.add_argument('--checkpoint', help="File di checkpoint per riprendere il backfill")
+    parser_backfill.add_argument('--archive-dir', help="Archivia le risposte grezze in questa cartella")
+    _add_loader_arguments(parser_backfill)
+
+    parser_replay = comandi.add_parser('replay', help="Rigioca gli archivi delle risposte senza accedere alla rete")
+    parser_replay.add_argument('--start', required=True, help="Prima data da rigiocare (YYYYMMDD)")
+    parser_replay.add_argument('--end', required=True, help="Ultima data da rigiocare (YYYYMMDD)")
+    parser_replay.add_argument('--archive-dir', required=True, help="Cartella degli archivi")
+    parser_replay.add_argument('--latest-only', action='store_true', help="Rigioca solo l'ultimo archivio di ogni data")
+    _add_loader_arguments(parser_replay)
+
+    parser_daemon = comandi.add_parser('daemon', help="Importa periodicamente la data odierna (default)")
+    parser_daemon.add_argument('--interval', type=float, help="Secondi tra due importazioni (default: INGEST_INTERVAL o 1800)")
+    parser_daemon.add_argument('--lock-file', help="Lock file contro le esecuzioni sovrapposte")
+    parser_daemon.add_argument('--adaptive', action='store_true', default=None,
+                               help="Adatta la cadenza ai tempi di pubblicazione osservati")
+    parser_daemon.add_argument('--burst', action='store_true', default=None,
+                               help="Interroga più spesso i bacini con idrometri vicini alle soglie")
+    parser_daemon.add_argument('--archive-dir', help="Archivia le risposte grezze in questa cartella")
+    _add_loader_arguments(parser_daemon)
+
+    comandi.add_parser('interactive', help="Chiede la data da importare ed esegue una sola importazione")
+
+    parser_fetch = comandi.add_parser('fetch', help="Importa più variabili e date con query parallele")
+    parser_fetch.add_argument('--start', required=True, help="Prima data da importare (YYYYMMDD)")
+    parser_fetch.add_argument('--end', required=True, help="Ultima data da importare (YYYYMMDD)")
+    parser_fetch.add_argument('--chunk-days', type=int, default=FETCH_CHUNK_DAYS, help="Date scaricate insieme")
+    parser_fetch.add_argument('--archive-dir', help="Archivia le risposte grezze in questa cartella")
+    _add_loader_arguments(parser_fetch)
+
+    parser_shard = comandi.add_parser('shard', help="Importa suddividendo le stazioni tra più processi")
+    parser_shard.add_argument('--start', default=date.today().strftime('%Y%m%d'),
+                              help="Prima data da importare (YYYYMMDD, default: oggi)")
+    parser_shard.add_argument('--end', help="Ultima data da importare (YYYYMMDD, default: --start)")
+    parser_shard.add_argument('--key', choices=SHARD_KEYS, default='macroarea', help="Campo di suddivisione")
+    parser_shard.add_argument('--shards', type=int, help="Numero di processi (default: SHARDS o numero di CPU)")
+    parser_shard.add_argument('--journal', help="Run journal degli shard (JSON Lines)")
+    parser_shard.add_argument('--archive-dir', help="Archivia le risposte grezze in questa cartella")
+    _add_loader_arguments(parser_shard)
+
+    parser_migrate = comandi.add_parser('migrate', help="Converte misurazioni allo schema compatto (tipo_id)")
+    parser_migrate.add_argument('--drop-legacy', action='store_true',
+                                help="Elimina la tabella precedente invece di lasciarla come misurazioni_legacy")
+    parser_migrate.add_argument('--backend', choices=STORAGE_BACKENDS, help="Database (default: DB_BACKEND)")
+    parser_migrate.add_argument('--db-path', help="File del database per i backend sqlite e duckdb")
+
+    parser_asof = comandi.add_parser('asof', help="Stampa le misurazioni di una stazione come erano note a un istante")
+    parser_asof.add_argument('--station', required=True, help="ID della stazione")
+    parser_asof.add_argument('--start', required=True, help="Prima data (YYYYMMDD)")
+    parser_asof.add_argument('--end', required=True, help="Ultima data inclusa (YYYYMMDD)")
+    parser_asof.add_argument('--as-of', required=True, type=datetime.fromisoformat,
+                             help="Istante di riferimento (YYYY-MM-DD HH:MM:SS)")
+    parser_asof.add_argument('--tipo', help="Solo questo tipo di misurazione")
+    parser_asof.add_argument('--backend', choices=STORAGE_BACKENDS, help="Database (default: DB_BACKEND)")
+    parser_asof.add_argument('--db-path', help="File del database per i backend sqlite e duckdb")
+
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
     # main()
 
-    # Configura il gestore di segnali per intercettare l'interruzione da tastiera
-    signal.signal(signal.SIGINT, signal_handler)
+    args = parse_args()
+    if getattr(args, 'metrics_port', None):
+        start_metrics_server(args.metrics_port)
+    if args.comando == 'backfill':
+        completato = backfill(
+            args.start, args.end, workers=args.workers, checkpoint_path=args.checkpoint,
+            archive_dir=args.archive_dir, **_loader_options(args)
+        )
+        sys.exit(0 if completato else 1)
+    if args.comando == 'replay':
+        completato = replay(args.start, args.end, args.archive_dir, latest_only=args.latest_only, **_loader_options(args))
+        sys.exit(0 if completato else 1)
+    if args.comando == 'fetch':
+        completato = fetch_range(args.start, args.end, chunk_days=args.chunk_days,
+                                 archive_dir=args.archive_dir, **_loader_options(args))
+        sys.exit(0 if completato else 1)
+
+    if args.comando == 'shard':
+        completato = sharded_ingest(args.start, args.end or args.start, key=args.key, shards=args.shards,
+                                    journal_path=args.journal, archive_dir=args.archive_dir, **_loader_options(args))
+        sys.exit(0 if completato else 1)
+
+    if args.comando == 'migrate':
+        storage = create_storage(args.backend, args.db_path)
+        try:
+            storage.ensure_schema()
+            storage.migrate_measurements(drop_legacy=args.drop_legacy)
+        finally:
+            storage.close()
+        sys.exit(0)
 
-    # Configura lo scheduler per eseguire la funzione scheduled_data_import ogni 30 minuti
-    schedule.every(1).seconds.do(scheduled_data_import)
+    if args.comando == 'asof':
+        storage = create_storage(args.backend, args.db_path)
+        try:
+            inizio = datetime.strptime(args.start, '%Y%m%d')
+            fine = datetime.strptime(args.end, '%Y%m%d') + timedelta(days=1)
+            for riga in measurements_as_of(storage, args.station, inizio, fine, args.as_of, args.tipo):
+                print(f"{riga['data_ora_rilevazione']}\t{riga['tipo_misurazione']}\t{riga['valore']}")
+        finally:
+            storage.close()
+        sys.exit(0)
+
+    if args.comando == 'interactive':
+        main()
+        sys.exit(0)
 
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    # Senza comando (o con 'daemon') parte l'importazione periodica, senza domande all'avvio
+    if args.comando == 'daemon':
+        demone = IngestDaemon(interval=args.interval, lock_path=args.lock_file, adaptive=args.adaptive, burst=args.burst,
+                              archive_dir=args.archive_dir, **_loader_options(args))
+    else:
+        demone = IngestDaemon()
+    try:
+        demone.run()
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
 
 # query di test:
 # INSERT INTO `misurazioni` (stazione_id, data_ora_rilevazione, data_rilevazione, ora_rilevazione, tipo_misurazione, valore) 
@@ -19,7 +19,6 @@ def export_misurazioni_to_csv():
         # Query SQL per estrarre i dati
         query = """
         SELECT 
-            m.id,
             m.stazione_id,
             m.data_ora_rilevazione,
             m.data_rilevazione,
@@ -33,7 +32,7 @@ def export_misurazioni_to_csv():
             s.comune,
             s.provincia,
             s.regione
-        FROM misurazioni m
+        FROM misurazioni_estese m
         INNER JOIN stazioni s ON m.stazione_id = s.id
         WHERE s.multifunzione = 1
         ORDER BY m.data_ora_rilevazione DESC
@@ -0,0 +1,159 @@
+"""Metriche dell'importazione ARPAE in formato testuale Prometheus.
+
+IngestMetrics raccoglie contatori, gauge e tempi per fase (http, json, decode,
+sql, commit) ed è condiviso da tutti i loader del processo tramite METRICS.
+Le metriche si espongono scrivendo un file per il textfile collector di
+node_exporter (write_textfile) o con un piccolo endpoint HTTP /metrics
+(start_metrics_server).
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = 'arpae_ingest'
+
+# Nome -> (tipo Prometheus, descrizione)
+METRIC_HELP = {
+    'phase_seconds': ('summary', "Tempo speso in ogni fase dell'importazione"),
+    'commit_seconds': ('summary', "Latenza dei commit sul database"),
+    'bytes_downloaded_total': ('counter', "Byte scaricati dall'API ARPAE"),
+    'items_parsed_total': ('counter', "Stazioni (_items) decodificate dalle risposte"),
+    'rows_written_total': ('counter', "Righe scritte per tabella"),
+    'rows_skipped_total': ('counter', "Misurazioni invariate non riscritte"),
+    'revisions_logged_total': ('counter', "Correzioni di valori già salvati registrate nel log delle revisioni"),
+    'items_dead_lettered_total': ('counter', "Stazioni malformate messe negli scarti"),
+    'write_queue_rows': ('gauge', "Misurazioni nella coda di scrittura differita"),
+    'runs_total': ('counter', "Esecuzioni di process_data per esito"),
+    'publication_lag_seconds': ('gauge', "Ritardo stimato di pubblicazione di un nuovo slot ARPAE"),
+    'next_poll_seconds': ('gauge', "Attesa prima della prossima interrogazione del demone"),
+    'data_freshness_seconds': ('gauge', "Età dell'ultimo slot salvato al termine del ciclo"),
+    'basins_in_alert': ('gauge', "Bacini con idrometri vicini a soglia2/soglia3"),
+    'burst_runs_total': ('counter', "Cicli ravvicinati sui bacini in allerta"),
+    'shard_runs_total': ('counter', "Importazioni (data, shard) dei worker per esito"),
+    'daemon_ticks_skipped_total': ('counter', "Esecuzioni del demone saltate perché il ciclo precedente era in corso"),
+    'upstream_requests_total': ('counter', "Richieste all'API ARPAE per esito"),
+    'upstream_retries_total': ('counter', "Ritentativi delle richieste all'API ARPAE"),
+    'upstream_circuit_state': ('gauge', "Stato del circuit breaker ARPAE (0 chiuso, 1 semiaperto, 2 aperto)"),
+    'last_run_timestamp_seconds': ('gauge', "Istante di fine dell'ultima esecuzione riuscita"),
+    'last_run_duration_seconds': ('gauge', "Durata dell'ultima esecuzione riuscita"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+class IngestMetrics:
+    """Registro thread-safe di contatori, gauge e riepiloghi (somma e conteggio)."""
+
+    def __init__(self, prefix: str = METRIC_PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._values: Dict[str, Dict[Labels, float]] = {}
+        self._summaries: Dict[str, Dict[Labels, Tuple[float, int]]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        chiave = _labels(labels)
+        with self._lock:
+            serie = self._values.setdefault(name, {})
+            serie[chiave] = serie.get(chiave, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        chiave = _labels(labels)
+        with self._lock:
+            serie = self._summaries.setdefault(name, {})
+            somma, conteggio = serie.get(chiave, (0.0, 0))
+            serie[chiave] = (somma + seconds, conteggio + 1)
+
+    @contextmanager
+    def time(self, phase: str) -> Iterator[None]:
+        """Misura il blocco come tempo della fase indicata."""
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('phase_seconds', time.perf_counter() - inizio, phase=phase)
+
+    def render(self) -> str:
+        """Metriche nel formato di esposizione testuale di Prometheus."""
+        righe = []
+        with self._lock:
+            nomi = sorted(set(self._values) | set(self._summaries))
+            for nome in nomi:
+                completo = f"{self.prefix}_{nome}"
+                tipo, descrizione = METRIC_HELP.get(nome, ('untyped', nome))
+                righe.append(f"# HELP {completo} {descrizione}")
+                righe.append(f"# TYPE {completo} {tipo}")
+                for etichette, valore in sorted(self._values.get(nome, {}).items()):
+                    righe.append(f"{completo}{_format_labels(etichette)} {valore}")
+                for etichette, (somma, conteggio) in sorted(self._summaries.get(nome, {}).items()):
+                    righe.append(f"{completo}_sum{_format_labels(etichette)} {somma}")
+                    righe.append(f"{completo}_count{_format_labels(etichette)} {conteggio}")
+        return '\n'.join(righe) + '\n'
+
+    def write_textfile(self, path: str) -> None:
+        """Scrive le metriche in modo atomico (textfile collector di node_exporter)."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+class MeteredReader:
+    """Stream in lettura che conta i byte scaricati e il tempo speso ad attenderli."""
+
+    def __init__(self, stream: BinaryIO, metrics: IngestMetrics):
+        self.stream = stream
+        self.metrics = metrics
+        self.read_seconds = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        inizio = time.perf_counter()
+        data = self.stream.read(size)
+        durata = time.perf_counter() - inizio
+        self.read_seconds += durata
+        self.metrics.observe('phase_seconds', durata, phase='http')
+        self.metrics.inc('bytes_downloaded_total', len(data))
+        return data
+
+# Registro condiviso da tutti i loader del processo
+METRICS = IngestMetrics()
+
+def start_metrics_server(port: int, metrics: Optional[IngestMetrics] = None,
+                         host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """Avvia in un thread daemon un endpoint HTTP che espone /metrics."""
+    registro = metrics or METRICS
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            corpo = registro.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Endpoint delle metriche attivo su http://{host}:{port}/metrics")
+    return server
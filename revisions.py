@@ -0,0 +1,64 @@
+"""Registro delle revisioni delle misurazioni e interrogazioni "as-of".
+
+Quando ARPAE corregge un valore già salvato, il loader aggiorna misurazioni e
+aggiunge una riga a revisioni_misurazioni con il valore precedente, quello
+nuovo e l'istante in cui la correzione è stata vista. Il registro è in sola
+aggiunta (semplici INSERT) e contiene solo i valori cambiati (le prime scritture non vi
+compaiono), quindi misurazioni resta snella per le letture correnti. Il tipo è
+salvato come id di tipi_misurazione (anche con lo schema originale di
+misurazioni) e il nome si risolve qui.
+
+measurements_as_of ricostruisce i valori come erano noti a un istante dato:
+per ogni misurazione corretta dopo quell'istante si usa il valore precedente
+della prima correzione successiva. Le misurazioni salvate per la prima volta
+dopo l'istante non sono distinguibili e compaiono con il loro valore.
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from storage import StorageBackend
+
+REVISION_COLUMNS = (
+    'stazione_id', 'data_ora_rilevazione', 'tipo_id', 'valore_precedente', 'valore_nuovo', 'visto_il'
+)
+
+def revision_history(storage: StorageBackend, station_id: str, data_ora_rilevazione: datetime,
+                     tipo_misurazione: str) -> List[Dict[str, Any]]:
+    """Correzioni di una misurazione, dalla più vecchia."""
+    return storage.query(
+        """
+        SELECT r.valore_precedente, r.valore_nuovo, r.visto_il
+        FROM revisioni_misurazioni r
+        JOIN tipi_misurazione t ON t.id = r.tipo_id
+        WHERE r.stazione_id = %s AND r.data_ora_rilevazione = %s AND t.nome = %s
+        ORDER BY r.visto_il
+        """,
+        (station_id, data_ora_rilevazione, tipo_misurazione)
+    )
+
+def measurements_as_of(storage: StorageBackend, station_id: str, start: datetime, end: datetime,
+                       as_of: datetime, tipo_misurazione: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Misurazioni della stazione in [start, end) con i valori noti all'istante as_of."""
+    filtro_tipo = "AND m.tipo_misurazione = %s" if tipo_misurazione else ""
+    correzione = """
+        FROM revisioni_misurazioni r
+        WHERE r.stazione_id = m.stazione_id
+          AND r.data_ora_rilevazione = m.data_ora_rilevazione
+          AND r.tipo_id = t.id
+          AND r.visto_il > %s
+    """
+    sql = f"""
+    SELECT m.stazione_id, m.data_ora_rilevazione, m.tipo_misurazione,
+           CASE WHEN EXISTS (SELECT 1 {correzione})
+                THEN (SELECT r.valore_precedente {correzione} ORDER BY r.visto_il LIMIT 1)
+                ELSE m.valore END AS valore
+    FROM misurazioni_estese m
+    LEFT JOIN tipi_misurazione t ON t.nome = m.tipo_misurazione
+    WHERE m.stazione_id = %s AND m.data_ora_rilevazione >= %s AND m.data_ora_rilevazione < %s
+    {filtro_tipo}
+    ORDER BY m.data_ora_rilevazione, m.tipo_misurazione
+    """
+    params: List[Any] = [as_of, as_of, station_id, start, end]
+    if tipo_misurazione:
+        params.append(tipo_misurazione)
+    return storage.query(sql, params)
@@ -0,0 +1,91 @@
+"""Suddivisione delle stazioni ARPAE in shard per l'importazione multi-processo.
+
+Le stazioni vengono raggruppate per un campo dell'anagrafica (macroarea o
+bacino): list_partitions conta le stazioni di ogni valore con una query che
+proietta solo quel campo, assign_shards distribuisce i valori su N shard
+bilanciando il numero di stazioni. Ogni shard viene poi importato da un
+processo separato con una query filtrata sui propri valori (field_filter).
+
+RunJournal è il registro, in JSON Lines, degli shard avviati, completati o
+falliti: lo scrive solo il processo coordinatore e, rileggendolo, una nuova
+esecuzione salta gli shard già completati per la stessa data.
+"""
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from upstream import ARPAE_API_URL, DEFAULT_VARIABLE, UpstreamClient, upstream_client
+
+logger = logging.getLogger(__name__)
+
+# Campi dell'anagrafica per cui si possono suddividere le stazioni
+SHARD_KEYS = ('macroarea', 'bacino')
+
+def list_partitions(key: str, variables: Sequence[str] = (DEFAULT_VARIABLE,),
+                    client: Optional[UpstreamClient] = None) -> Dict[Any, int]:
+    """Numero di stazioni per ogni valore di anagrafica.<key>, tra quelle che misurano variables."""
+    if key not in SHARD_KEYS:
+        raise ValueError(f"Campo di suddivisione non supportato: {key} (ammessi: {', '.join(SHARD_KEYS)})")
+    client = client or upstream_client()
+    where = {"anagrafica.variabili": variables[0]} if len(variables) == 1 \
+        else {"anagrafica.variabili": {"$in": list(variables)}}
+    params = {
+        "where": json.dumps(where),
+        "projection": json.dumps({f"anagrafica.{key}": 1}),
+        "max_results": 100000
+    }
+    risposta = client.get(ARPAE_API_URL, params=params).json()
+    items = risposta.get('_items', [])
+    totale = (risposta.get('_meta') or {}).get('total')
+    if totale is not None and totale > len(items):
+        logger.warning(f"Elenco delle stazioni troncato: {len(items)} su {totale}")
+    return dict(Counter((item.get('anagrafica') or {}).get(key) for item in items))
+
+def assign_shards(partitions: Dict[Any, int], shards: int) -> List[List[Any]]:
+    """Distribuisce i valori su al più shards gruppi, dal più numeroso al gruppo più leggero."""
+    gruppi: List[Tuple[int, List[Any]]] = [(0, []) for _ in range(max(1, min(shards, len(partitions))))]
+    for valore, stazioni in sorted(partitions.items(), key=lambda p: (-p[1], str(p[0]))):
+        indice = min(range(len(gruppi)), key=lambda i: gruppi[i][0])
+        carico, valori = gruppi[indice]
+        gruppi[indice] = (carico + stazioni, valori + [valore])
+    return [valori for _, valori in gruppi if valori]
+
+def shard_id(key: str, values: Sequence[Any]) -> str:
+    """Identificativo stabile di uno shard, indipendente dall'ordine dei valori."""
+    return f"{key}:" + '|'.join(sorted('' if v is None else str(v) for v in values))
+
+class RunJournal:
+    """Registro in JSON Lines delle esecuzioni degli shard, scritto dal solo coordinatore."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # Ultimo stato noto per (data, shard)
+        self._stati: Dict[Tuple[str, str], str] = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for riga in f:
+                    try:
+                        voce = json.loads(riga)
+                        self._stati[(voce['data'], voce['shard'])] = voce['stato']
+                    except (ValueError, KeyError):
+                        # Riga troncata da un'interruzione durante la scrittura
+                        continue
+
+    def is_done(self, selected_date: str, shard: str) -> bool:
+        return self._stati.get((selected_date, shard)) == 'completato'
+
+    def record(self, run_id: str, selected_date: str, shard: str, stato: str, **dettagli: Any) -> None:
+        """Aggiunge una voce (avviato, completato o fallito) al registro."""
+        voce = {'run': run_id, 'data': selected_date, 'shard': shard, 'stato': stato,
+                'istante': datetime.now().isoformat(timespec='seconds'), **dettagli}
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(voce, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._stati[(selected_date, shard)] = stato
@@ -0,0 +1,182 @@
+"""Confronto tra le risposte ARPAE e le ultime misurazioni salvate, per (stazione, giorno).
+
+ARPAE ripubblica l'intera giornata a ogni interrogazione, ma solo pochi valori
+sono nuovi o corretti. SnapshotDiff tiene per ogni (stazione, giorno)
+un'impronta compatta dei valori già salvati: per ogni tipo di misurazione un
+bytearray di 48 slot semiorari da 8 byte (il float64 del valore, oppure un
+NaN marcato per "assente" o "NULL"). diff confronta una nuova risposta con
+l'impronta e indica solo le misurazioni nuove o cambiate, con il valore
+precedente; le impronte aggiornate diventano effettive al commit e vengono
+salvate (compresse) nella tabella impronte_giornaliere, nella stessa
+transazione delle misurazioni, così restano valide dopo un riavvio.
+
+Una risposta parziale (es. fetch delta) aggiorna solo gli slot presenti: uno
+slot assente non cancella il valore già salvato.
+"""
+import struct
+import zlib
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+SLOTS_PER_DAY = 48
+SLOT_BYTES = 8
+
+# NaN con payload riservati: slot mai visto e valore NULL (diversi dal NaN di un float qualsiasi)
+ABSENT_BYTES = struct.pack('<Q', 0x7FF8000000000A11)
+NULL_BYTES = struct.pack('<Q', 0x7FF8000000000B22)
+_EMPTY_SERIES = ABSENT_BYTES * SLOTS_PER_DAY
+
+class _Absent:
+    """Valore precedente di una misurazione mai salvata."""
+
+    def __repr__(self) -> str:
+        return 'ABSENT'
+
+ABSENT = _Absent()
+
+DayKey = Tuple[str, date]
+Series = Dict[str, bytearray]
+
+def slot_index(ts: datetime) -> Optional[int]:
+    """Indice dello slot semiorario del timestamp, o None se fuori dalla griglia."""
+    if ts.minute % 30 or ts.second or ts.microsecond:
+        return None
+    return ts.hour * 2 + ts.minute // 30
+
+def pack_value(valore: Any) -> Optional[bytes]:
+    """Rappresentazione a 8 byte di un valore; None se il valore non è numerico."""
+    if valore is None:
+        return NULL_BYTES
+    try:
+        return struct.pack('<d', float(valore))
+    except (TypeError, ValueError):
+        return None
+
+def unpack_value(chunk: bytes) -> Any:
+    """Valore di uno slot: ABSENT, None (NULL) o float."""
+    if chunk == ABSENT_BYTES:
+        return ABSENT
+    if chunk == NULL_BYTES:
+        return None
+    return struct.unpack('<d', chunk)[0]
+
+def pack_fingerprint(serie: Series) -> bytes:
+    """Serializza le serie di un giorno: per ogni tipo lunghezza, nome e 48 slot; poi zlib."""
+    parti = []
+    for tipo in sorted(serie):
+        nome = tipo.encode('utf-8')
+        parti.append(bytes([len(nome)]) + nome + bytes(serie[tipo]))
+    return zlib.compress(b''.join(parti))
+
+def unpack_fingerprint(blob: bytes) -> Series:
+    dati = zlib.decompress(blob)
+    serie: Series = {}
+    pos = 0
+    while pos < len(dati):
+        lunghezza = dati[pos]
+        tipo = dati[pos + 1:pos + 1 + lunghezza].decode('utf-8')
+        pos += 1 + lunghezza
+        serie[tipo] = bytearray(dati[pos:pos + SLOTS_PER_DAY * SLOT_BYTES])
+        pos += SLOTS_PER_DAY * SLOT_BYTES
+    return serie
+
+class SnapshotDiff:
+    """Impronte dei valori salvati per (stazione, giorno), con le modifiche della transazione corrente."""
+
+    def __init__(self):
+        self._days: Dict[DayKey, Series] = {}
+        # Impronte modificate e non ancora confermate
+        self._pending: Dict[DayKey, Series] = {}
+
+    def __len__(self) -> int:
+        return len(self._days)
+
+    def load(self, righe: Iterable[Dict[str, Any]]) -> None:
+        """Carica le impronte salvate (stazione_id, data_rilevazione, valori)."""
+        for riga in righe:
+            giorno = riga['data_rilevazione']
+            if not isinstance(giorno, date):
+                giorno = date.fromisoformat(str(giorno))
+            self._days[(str(riga['stazione_id']), giorno)] = unpack_fingerprint(bytes(riga['valori']))
+
+    def seed(self, station_id: str, tipo: str, ts: datetime, valore: Any) -> None:
+        """Registra un valore già salvato (per costruire le impronte dalle misurazioni esistenti)."""
+        indice = slot_index(ts)
+        dato = pack_value(valore)
+        if indice is None or dato is None:
+            return
+        serie = self._days.setdefault((station_id, ts.date()), {})
+        slot = serie.setdefault(tipo, bytearray(_EMPTY_SERIES))
+        slot[indice * SLOT_BYTES:(indice + 1) * SLOT_BYTES] = dato
+
+    def _series(self, chiave: DayKey) -> Series:
+        """Impronta modificabile del giorno nella transazione corrente."""
+        serie = self._pending.get(chiave)
+        if serie is None:
+            serie = self._pending[chiave] = {
+                tipo: bytearray(valori) for tipo, valori in self._days.get(chiave, {}).items()
+            }
+        return serie
+
+    def diff(self, station_id: str, giorno: date, timestamps: List[datetime], tipi: List[str],
+             valori: List[Any]) -> List[Tuple[int, Any]]:
+        """Confronta le misurazioni di un giorno con l'impronta e la aggiorna.
+
+        Restituisce (indice, valore precedente) delle sole misurazioni nuove o
+        cambiate; il valore precedente è ABSENT per quelle mai salvate. Le
+        misurazioni fuori dalla griglia semioraria o non numeriche vengono
+        sempre restituite.
+        """
+        chiave = (station_id, giorno)
+        salvate = self._pending.get(chiave) or self._days.get(chiave)
+        serie: Optional[Series] = None
+        cambiate = []
+        for i, (ts, tipo, valore) in enumerate(zip(timestamps, tipi, valori)):
+            indice = slot_index(ts)
+            dato = pack_value(valore)
+            if indice is None or dato is None:
+                cambiate.append((i, ABSENT))
+                continue
+            inizio = indice * SLOT_BYTES
+            precedente = salvate.get(tipo) if salvate else None
+            vecchio = precedente[inizio:inizio + SLOT_BYTES] if precedente is not None else ABSENT_BYTES
+            if vecchio == dato:
+                continue
+            if serie is None:
+                serie = self._series(chiave)
+                salvate = serie
+            serie.setdefault(tipo, bytearray(_EMPTY_SERIES))[inizio:inizio + SLOT_BYTES] = dato
+            cambiate.append((i, unpack_value(vecchio)))
+        return cambiate
+
+    def pending_rows(self, aggiornato_il: datetime) -> List[tuple]:
+        """Righe (stazione_id, data_rilevazione, valori, aggiornato_il) delle impronte da salvare."""
+        return [(station_id, giorno, pack_fingerprint(serie), aggiornato_il)
+                for (station_id, giorno), serie in self._pending.items()]
+
+    def commit(self) -> None:
+        self._days.update(self._pending)
+        self._pending.clear()
+
+    def rollback(self) -> None:
+        self._pending.clear()
+
+    def evict(self, prima_di: date) -> None:
+        """Scarta dalla memoria le impronte dei giorni precedenti a prima_di."""
+        self._days = {k: v for k, v in self._days.items() if k[1] >= prima_di}
+
+    def latest_values(self) -> Dict[Tuple[str, str], Tuple[datetime, Any]]:
+        """Ultimo valore noto per (stazione, tipo), con il suo istante."""
+        ultimi: Dict[Tuple[str, str], Tuple[datetime, Any]] = {}
+        for (station_id, giorno), serie in self._days.items():
+            for tipo, valori in serie.items():
+                for indice in range(SLOTS_PER_DAY - 1, -1, -1):
+                    valore = unpack_value(bytes(valori[indice * SLOT_BYTES:(indice + 1) * SLOT_BYTES]))
+                    if valore is ABSENT:
+                        continue
+                    ts = datetime.combine(giorno, datetime.min.time()).replace(hour=indice // 2,
+                                                                               minute=30 * (indice % 2))
+                    if (station_id, tipo) not in ultimi or ts > ultimi[(station_id, tipo)][0]:
+                        ultimi[(station_id, tipo)] = (ts, valore)
+                    break
+        return ultimi
@@ -0,0 +1,662 @@
+"""Backend di archiviazione del loader ARPAE: MySQL, SQLite e DuckDB.
+
+ArpaeDataLoader scrive stazioni, sensori e misurazioni attraverso StorageBackend;
+ogni implementazione usa il proprio percorso di caricamento massivo (INSERT
+multi-riga per MySQL, executemany per SQLite, scansione di un DataFrame per
+DuckDB). Per le importazioni storiche bulk_upsert usa, in MySQL, LOAD DATA
+LOCAL INFILE in una tabella di appoggio. Le query del loader usano i
+placeholder %s, convertiti dove serve.
+
+Nello schema compatto di misurazioni il tipo è un intero piccolo (tipo_id,
+da tipi_misurazione) e data_rilevazione/ora_rilevazione sono colonne generate
+virtuali: i database embedded nuovi nascono così, quelli esistenti e MySQL
+si convertono con migrate_measurements. La vista misurazioni_estese espone in
+entrambi gli schemi le colonne originali, con tipo_misurazione come testo.
+"""
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+from datetime import date, datetime, time as dt_time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import mysql.connector
+    from mysql.connector import errorcode
+except ImportError:  # necessario solo per il backend MySQL
+    mysql = None
+
+try:
+    import duckdb
+except ImportError:  # necessario solo per il backend DuckDB
+    duckdb = None
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKENDS = ('mysql', 'sqlite', 'duckdb')
+
+# Limite dei placeholder per singola istruzione preparata in MySQL
+MAX_PLACEHOLDERS = 65535
+
+# Cartella dei file TSV di LOAD DATA LOCAL INFILE (l'unica da cui il client può leggerli)
+BULK_TMP_DIR = os.getenv('BULK_TMP_DIR', tempfile.gettempdir())
+
+# Chiave univoca richiesta dall'upsert delle misurazioni
+MEASUREMENT_UNIQUE_KEY = 'uq_misurazione'
+MEASUREMENT_KEY_COLUMNS = ('stazione_id', 'data_ora_rilevazione', 'tipo_misurazione')
+
+# Tabelle di supporto del loader, comuni a tutti i backend
+SUPPORT_TABLES_SQL = [
+    # Impronte di anagrafica e sensori per saltare gli upsert di stazioni invariate
+    """
+    CREATE TABLE IF NOT EXISTS impronte_stazioni (
+        stazione_id VARCHAR(32) NOT NULL PRIMARY KEY,
+        hash_anagrafica CHAR(64) NOT NULL,
+        hash_sensori CHAR(64) NOT NULL,
+        aggiornato_il DATETIME NOT NULL
+    )
+    """,
+    # Impronte compatte (snapshots.py) dei valori salvati per stazione e giorno
+    """
+    CREATE TABLE IF NOT EXISTS impronte_giornaliere (
+        stazione_id VARCHAR(32) NOT NULL,
+        data_rilevazione DATE NOT NULL,
+        valori BLOB NOT NULL,
+        aggiornato_il DATETIME NOT NULL,
+        PRIMARY KEY (stazione_id, data_rilevazione)
+    )
+    """,
+    # Correzioni ARPAE di valori già salvati (revisions.py), in sola aggiunta (visto_il al microsecondo);
+    # il tipo è l'id di tipi_misurazione, come nello schema compatto
+    """
+    CREATE TABLE IF NOT EXISTS revisioni_misurazioni (
+        stazione_id VARCHAR(32) NOT NULL,
+        data_ora_rilevazione DATETIME NOT NULL,
+        tipo_id SMALLINT NOT NULL,
+        valore_precedente DOUBLE,
+        valore_nuovo DOUBLE,
+        visto_il DATETIME(6) NOT NULL,
+        PRIMARY KEY (stazione_id, data_ora_rilevazione, tipo_id, visto_il)
+    )
+    """,
+    # Item malformati dell'API messi da parte con il JSON originale e l'errore
+    """
+    CREATE TABLE IF NOT EXISTS scarti (
+        data_richiesta CHAR(8) NOT NULL,
+        stazione_id VARCHAR(32),
+        errore TEXT NOT NULL,
+        item_json TEXT NOT NULL,
+        registrato_il DATETIME NOT NULL
+    )
+    """,
+]
+
+# Dizionario dei tipi di misurazione dello schema compatto; l'id lo assegna il database (type_id_column)
+MEASUREMENT_TYPES_SQL = """
+CREATE TABLE IF NOT EXISTS tipi_misurazione (
+    id {id_column},
+    nome VARCHAR(64) NOT NULL UNIQUE
+)
+"""
+
+# Tabelle principali per i database embedded (in MySQL esistono già)
+EMBEDDED_TABLES_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS stazioni (
+        id VARCHAR(32) NOT NULL PRIMARY KEY,
+        nome VARCHAR(255),
+        altitudine DOUBLE,
+        longitude DOUBLE,
+        latitude DOUBLE,
+        cod_istat VARCHAR(16),
+        bacino VARCHAR(255),
+        sottobacino VARCHAR(255),
+        macroarea VARCHAR(255),
+        proprietario VARCHAR(255),
+        gestore VARCHAR(255),
+        comune VARCHAR(255),
+        provincia VARCHAR(16),
+        regione VARCHAR(255),
+        multifunzione SMALLINT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sensori (
+        stazione_id VARCHAR(32) NOT NULL,
+        tipo_variabile VARCHAR(64) NOT NULL,
+        soglia1 DOUBLE,
+        soglia2 DOUBLE,
+        soglia3 DOUBLE,
+        bacino VARCHAR(255),
+        sottobacino VARCHAR(255),
+        altitudine DOUBLE,
+        PRIMARY KEY (stazione_id, tipo_variabile)
+    )
+    """,
+]
+
+# Schema compatto di misurazioni: tipo come intero, data e ora generate da data_ora_rilevazione
+COMPACT_MEASUREMENTS_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    stazione_id VARCHAR(32) NOT NULL,
+    data_ora_rilevazione {timestamp} NOT NULL,
+    tipo_id SMALLINT NOT NULL,
+    valore DOUBLE,
+    data_rilevazione DATE GENERATED ALWAYS AS ({data}) VIRTUAL,
+    ora_rilevazione TIME GENERATED ALWAYS AS ({ora}) VIRTUAL,
+    PRIMARY KEY (stazione_id, data_ora_rilevazione, tipo_id)
+)
+"""
+
+# Lunghezza massima di stazione_id nello schema compatto (come in COMPACT_MEASUREMENTS_SQL)
+COMPACT_STATION_ID_LENGTH = 32
+
+# Colonne originali di misurazioni, per i lettori, in entrambi gli schemi
+MEASUREMENTS_VIEW_SQL = {
+    False: """
+    SELECT stazione_id, data_ora_rilevazione, data_rilevazione, ora_rilevazione, tipo_misurazione, valore
+    FROM misurazioni
+    """,
+    True: """
+    SELECT m.stazione_id, m.data_ora_rilevazione, m.data_rilevazione, m.ora_rilevazione,
+           t.nome AS tipo_misurazione, m.valore
+    FROM misurazioni m
+    JOIN tipi_misurazione t ON t.id = m.tipo_id
+    """,
+}
+
+# Riferimento alla tabella misurazioni (anche quotato o qualificato) nella definizione di una vista
+MEASUREMENTS_REFERENCE = re.compile(r'([`"]?)\bmisurazioni\b\1')
+
+class StorageBackend:
+    """Interfaccia comune dei backend di archiviazione del loader.
+
+    errors è la tupla delle eccezioni del driver che annullano un batch e ne
+    provocano la ripetizione in ArpaeDataLoader.
+    """
+    name = ''
+    errors: Tuple[type, ...] = ()
+    # Espressioni delle colonne generate dello schema compatto e tipo del timestamp
+    date_expression = ''
+    time_expression = ''
+    timestamp_type = 'TIMESTAMP'
+    create_view = 'CREATE OR REPLACE VIEW'
+    # Colonna id di tipi_misurazione, assegnata dal database anche con più loader concorrenti
+    type_id_column = ''
+    # Registrazione di un tipo di misurazione che lascia invariato un nome già presente
+    insert_type_sql = "INSERT INTO tipi_misurazione (nome) VALUES (%s) ON CONFLICT (nome) DO NOTHING"
+    select_type_sql = "SELECT id FROM tipi_misurazione WHERE nome = %s"
+    # Impostato da ensure_schema: True se misurazioni usa lo schema compatto (tipo_id)
+    compact_measurements = False
+
+    def ensure_schema(self) -> None:
+        raise NotImplementedError
+
+    def table_columns(self, table: str) -> List[str]:
+        """Nomi delle colonne della tabella (vuoto se non esiste)."""
+        raise NotImplementedError
+
+    def list_views(self) -> Dict[str, str]:
+        """Viste del database: nome -> istruzione che le crea."""
+        raise NotImplementedError
+
+    def measurement_types_sql(self) -> str:
+        return MEASUREMENT_TYPES_SQL.format(id_column=self.type_id_column)
+
+    def measurement_type_id(self, nome: str) -> int:
+        """Id del tipo di misurazione, registrandolo (nella transazione corrente) se manca."""
+        self.execute(self.insert_type_sql, (nome,))
+        return self.query(self.select_type_sql, (nome,))[0]['id']
+
+    def compact_measurements_sql(self, table: str = 'misurazioni') -> str:
+        return COMPACT_MEASUREMENTS_SQL.format(table=table, timestamp=self.timestamp_type,
+                                               data=self.date_expression, ora=self.time_expression)
+
+    def _ensure_measurements_view(self) -> None:
+        """Rileva lo schema di misurazioni e crea la vista misurazioni_estese se manca o non corrisponde.
+
+        La vista cambia solo con lo schema: ricrearla a ogni avvio fa collidere
+        sul DDL i loader concorrenti (in DuckDB un conflitto write-write sul catalogo).
+        """
+        self.compact_measurements = 'tipo_id' in self.table_columns('misurazioni')
+        definizione = self.list_views().get('misurazioni_estese')
+        if definizione is not None and ('tipi_misurazione' in definizione) == self.compact_measurements:
+            return
+        if definizione is not None:
+            self.execute("DROP VIEW misurazioni_estese")
+        self.execute(f"{self.create_view} misurazioni_estese AS {MEASUREMENTS_VIEW_SQL[self.compact_measurements]}")
+
+    def replace_table(self, table: str, replacement: str, backup: str) -> None:
+        """Mette replacement al posto di table, che resta come backup."""
+        self.execute(f"ALTER TABLE {table} RENAME TO {backup}")
+        self.execute(f"ALTER TABLE {replacement} RENAME TO {table}")
+
+    def migrate_measurements(self, drop_legacy: bool = False) -> int:
+        """Converte misurazioni allo schema compatto; restituisce le righe copiate.
+
+        I tipi esistenti vengono registrati in tipi_misurazione, le righe copiate
+        in una nuova tabella che prende il posto di misurazioni; la vecchia
+        resta come misurazioni_legacy (o viene eliminata con drop_legacy).
+        Le viste che leggono misurazioni (es. vista_livello_temperatura, usata
+        dagli script di ai_test) vengono ricreate su misurazioni_estese, che ne
+        conserva le colonne, solo dopo lo scambio delle tabelle. In MySQL il DDL
+        conferma implicitamente: se la copia fallisce la tabella parziale viene
+        eliminata e misurazioni resta com'era. Un'eventuale colonna id non passa
+        allo schema compatto e stazione_id non può superare COMPACT_STATION_ID_LENGTH
+        caratteri.
+        """
+        if self.compact_measurements:
+            logger.info("misurazioni usa già lo schema compatto")
+            return 0
+
+        stazioni = self.query("SELECT DISTINCT stazione_id FROM misurazioni")
+        lunghezza = max((len(str(row['stazione_id'])) for row in stazioni), default=0)
+        if lunghezza > COMPACT_STATION_ID_LENGTH:
+            raise ValueError(f"stazione_id fino a {lunghezza} caratteri: lo schema compatto "
+                             f"ne ammette {COMPACT_STATION_ID_LENGTH}, misurazioni non convertita")
+        if 'id' in self.table_columns('misurazioni'):
+            logger.warning("La colonna id di misurazioni non passa allo schema compatto"
+                           + (" e viene eliminata" if drop_legacy else " (resta in misurazioni_legacy)"))
+
+        tipi = {row['nome']: row['id'] for row in self.query("SELECT id, nome FROM tipi_misurazione")}
+        nuovi = sorted(row['tipo_misurazione'] for row in self.query("SELECT DISTINCT tipo_misurazione FROM misurazioni")
+                       if row['tipo_misurazione'] not in tipi)
+        for nome in nuovi:
+            self.measurement_type_id(nome)
+        dipendenti = {nome: MEASUREMENTS_REFERENCE.sub(r'\1misurazioni_estese\1', sql)
+                      for nome, sql in self.list_views().items()
+                      if nome != 'misurazioni_estese' and MEASUREMENTS_REFERENCE.search(sql)}
+
+        # Avanzi di una migrazione interrotta
+        self.execute("DROP TABLE IF EXISTS misurazioni_compatta")
+        try:
+            self.execute(self.compact_measurements_sql('misurazioni_compatta'))
+            self.execute(
+                "INSERT INTO misurazioni_compatta (stazione_id, data_ora_rilevazione, tipo_id, valore) "
+                "SELECT m.stazione_id, m.data_ora_rilevazione, t.id, m.valore "
+                "FROM misurazioni m JOIN tipi_misurazione t ON t.nome = m.tipo_misurazione"
+            )
+            copiate = self.query("SELECT COUNT(*) AS n FROM misurazioni_compatta")[0]['n']
+            self.replace_table('misurazioni', 'misurazioni_compatta', 'misurazioni_legacy')
+        except Exception:
+            self.rollback()
+            # In MySQL CREATE TABLE è già confermata: la copia parziale va eliminata esplicitamente
+            self.execute("DROP TABLE IF EXISTS misurazioni_compatta")
+            self.commit()
+            raise
+
+        for nome in list(dipendenti) + ['misurazioni_estese']:
+            self.execute(f"DROP VIEW IF EXISTS {nome}")
+        self._ensure_measurements_view()
+        for nome, sql in dipendenti.items():
+            self.execute(sql)
+            logger.info(f"Vista {nome} ricreata su misurazioni_estese")
+        if drop_legacy:
+            self.execute("DROP TABLE misurazioni_legacy")
+        self.commit()
+        logger.info(f"misurazioni convertita allo schema compatto: {copiate} righe, {len(nuovi)} nuovi tipi"
+                    + ("" if drop_legacy else " (la tabella precedente resta come misurazioni_legacy)"))
+        return copiate
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> None:
+        raise NotImplementedError
+
+    def query(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def upsert(self, table: str, columns: Sequence[str], key_columns: Sequence[str],
+               rows: Sequence[Sequence[Any]]) -> None:
+        """Inserisce le righe, aggiornando le colonne non chiave di quelle già presenti."""
+        raise NotImplementedError
+
+    def bulk_upsert(self, table: str, columns: Sequence[str], key_columns: Sequence[str],
+                    rows: Sequence[Sequence[Any]]) -> None:
+        """Come upsert, ottimizzato per blocchi molto grandi; di default coincide con upsert."""
+        self.upsert(table, columns, key_columns, rows)
+
+    def commit(self) -> None:
+        raise NotImplementedError
+
+    def rollback(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+def _tsv_value(valore: Any) -> str:
+    """Campo di un file TSV per LOAD DATA (NULL come \\N, separatori con escape)."""
+    if valore is None:
+        return '\\N'
+    if isinstance(valore, datetime):
+        return valore.strftime('%Y-%m-%d %H:%M:%S')
+    testo = str(valore)
+    return testo.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+class MySQLStorage(StorageBackend):
+    """Backend MySQL/MariaDB: upsert con INSERT multi-riga ... ON DUPLICATE KEY UPDATE."""
+    name = 'mysql'
+    date_expression = 'DATE(data_ora_rilevazione)'
+    time_expression = 'TIME(data_ora_rilevazione)'
+    timestamp_type = 'DATETIME'
+    type_id_column = 'SMALLINT NOT NULL AUTO_INCREMENT PRIMARY KEY'
+    insert_type_sql = "INSERT IGNORE INTO tipi_misurazione (nome) VALUES (%s)"
+    # Lettura con lock: vede anche il tipo appena confermato da un altro loader, fuori dallo snapshot
+    select_type_sql = "SELECT id FROM tipi_misurazione WHERE nome = %s LOCK IN SHARE MODE"
+
+    def __init__(self):
+        if mysql is None:
+            raise ImportError("Il backend MySQL richiede il pacchetto mysql-connector-python")
+        self.errors = (mysql.connector.Error,)
+        try:
+            self.connection = mysql.connector.connect(
+                host=os.getenv('DB_HOST', '127.0.0.1'),      # Usa IP invece di localhost
+                port=int(os.getenv('DB_PORT', '3306')),      # Porta esplicita
+                user=os.getenv('DB_USER', 'root'),
+                password=os.getenv('DB_PASSWORD', 'root'),
+                database=os.getenv('DB_NAME', 'fiumesicuro'),
+                charset='utf8mb4',
+                collation='utf8mb4_unicode_ci',
+                connect_timeout=30,  # Timeout di connessione aumentato
+                allow_local_infile_in_path=BULK_TMP_DIR  # LOAD DATA LOCAL solo dai file di bulk_upsert
+            )
+            self.cursor = self.connection.cursor(dictionary=True)
+            self._staging_tables: set = set()
+            logger.info("Connessione al database stabilita con successo")
+        except mysql.connector.Error as err:
+            logger.error(f"Errore di connessione al database: {err}")
+            raise
+
+    def ensure_schema(self) -> None:
+        """Crea le tabelle di supporto del loader e, nello schema originale, la chiave univoca delle misurazioni."""
+        for sql in SUPPORT_TABLES_SQL + [self.measurement_types_sql()]:
+            self.cursor.execute(sql)
+        self._ensure_measurements_view()
+        if not self.compact_measurements:
+            self.ensure_measurement_unique_key()
+
+    def table_columns(self, table: str) -> List[str]:
+        self.cursor.execute(
+            "SELECT COLUMN_NAME AS colonna FROM information_schema.COLUMNS"
+            " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION",
+            (table,)
+        )
+        return [row['colonna'] for row in self.cursor.fetchall()]
+
+    def list_views(self) -> Dict[str, str]:
+        self.cursor.execute(
+            "SELECT TABLE_NAME AS nome, VIEW_DEFINITION AS definizione FROM information_schema.VIEWS"
+            " WHERE TABLE_SCHEMA = DATABASE()"
+        )
+        return {row['nome']: f"CREATE OR REPLACE VIEW {row['nome']} AS {row['definizione']}"
+                for row in self.cursor.fetchall()}
+
+    def replace_table(self, table: str, replacement: str, backup: str) -> None:
+        # Un solo RENAME TABLE scambia le due tabelle in modo atomico
+        self.execute(f"RENAME TABLE {table} TO {backup}, {replacement} TO {table}")
+
+    def ensure_measurement_unique_key(self) -> None:
+        """Crea la chiave univoca (stazione_id, data_ora_rilevazione, tipo_misurazione) se manca."""
+        sql = """
+        SELECT INDEX_NAME AS indice,
+               GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX) AS colonne
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'misurazioni' AND NON_UNIQUE = 0
+        GROUP BY INDEX_NAME;
+        """
+        self.cursor.execute(sql)
+        colonne_richieste = ",".join(MEASUREMENT_KEY_COLUMNS)
+        if any(row['colonne'] == colonne_richieste for row in self.cursor.fetchall()):
+            return
+
+        logger.info(f"Creazione della chiave univoca {MEASUREMENT_UNIQUE_KEY} su misurazioni({colonne_richieste})")
+        try:
+            self.cursor.execute(
+                f"ALTER TABLE misurazioni ADD UNIQUE KEY {MEASUREMENT_UNIQUE_KEY} ({', '.join(MEASUREMENT_KEY_COLUMNS)})"
+            )
+        except mysql.connector.Error as err:
+            if err.errno == errorcode.ER_DUP_KEYNAME:
+                # Creata nel frattempo da un altro loader (es. worker del backfill)
+                return
+            # Tipicamente righe duplicate già presenti: vanno rimosse prima di poter usare l'upsert
+            logger.error(f"Impossibile creare la chiave univoca su misurazioni: {err}")
+            raise
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> None:
+        self.cursor.execute(sql, tuple(params))
+
+    def query(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        self.cursor.execute(sql, tuple(params))
+        return self.cursor.fetchall()
+
+    def upsert(self, table: str, columns: Sequence[str], key_columns: Sequence[str],
+               rows: Sequence[Sequence[Any]]) -> None:
+        if not rows:
+            return
+        riga = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        aggiornamenti = ", ".join(f"{c} = VALUES({c})" for c in columns if c not in key_columns)
+        # Ogni istruzione resta sotto il limite dei placeholder di MySQL
+        righe_per_istruzione = MAX_PLACEHOLDERS // len(columns)
+        for i in range(0, len(rows), righe_per_istruzione):
+            blocco = rows[i:i + righe_per_istruzione]
+            sql = (
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([riga] * len(blocco))}"
+                f" ON DUPLICATE KEY UPDATE {aggiornamenti}"
+            )
+            self.cursor.execute(sql, [valore for r in blocco for valore in r])
+
+    def bulk_upsert(self, table: str, columns: Sequence[str], key_columns: Sequence[str],
+                    rows: Sequence[Sequence[Any]]) -> None:
+        """Carica le righe con LOAD DATA LOCAL INFILE in una tabella di appoggio e le unisce con un solo upsert.
+
+        La tabella di appoggio è temporanea (per connessione) e ha le stesse
+        chiavi della destinazione: REPLACE tiene l'ultima riga per chiave, poi
+        INSERT ... SELECT ... ON DUPLICATE KEY UPDATE la unisce in modo set-based.
+        Richiede local_infile=ON sul server. LOAD DATA LOCAL converte i valori
+        non validi (in 0 o troncandoli) con un semplice avviso: se ce ne sono il
+        blocco fallisce con DataError, come farebbe l'upsert riga per riga.
+        """
+        if not rows:
+            return
+        staging = f"{table}_staging"
+        if staging not in self._staging_tables:
+            self.cursor.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS {staging} LIKE {table}")
+            self._staging_tables.add(staging)
+        self.cursor.execute(f"DELETE FROM {staging}")
+
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', suffix='.tsv',
+                                         dir=BULK_TMP_DIR, delete=False) as f:
+            percorso = f.name
+            for riga in rows:
+                f.write('\t'.join(_tsv_value(v) for v in riga))
+                f.write('\n')
+        try:
+            self.cursor.execute(
+                f"LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE {staging} CHARACTER SET utf8mb4"
+                f" FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'"
+                f" ({', '.join(columns)})",
+                (percorso,)
+            )
+        finally:
+            os.remove(percorso)
+        avvisi = self.query("SHOW WARNINGS")
+        if avvisi:
+            dettaglio = '; '.join(f"{a['Code']} {a['Message']}" for a in avvisi[:5])
+            raise mysql.connector.errors.DataError(
+                msg=f"LOAD DATA in {staging}: {len(avvisi)} valori non validi ({dettaglio})"
+            )
+
+        elenco = ', '.join(columns)
+        aggiornamenti = ", ".join(f"{c} = VALUES({c})" for c in columns if c not in key_columns)
+        self.cursor.execute(
+            f"INSERT INTO {table} ({elenco}) SELECT {elenco} FROM {staging}"
+            f" ON DUPLICATE KEY UPDATE {aggiornamenti}"
+        )
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def rollback(self) -> None:
+        """Annulla la transazione corrente, riconnettendosi se la connessione è caduta."""
+        try:
+            self.connection.rollback()
+        except mysql.connector.Error as err:
+            logger.warning(f"Rollback non riuscito ({err}), riconnessione al database")
+            self.connection.reconnect(attempts=3, delay=2)
+            self.cursor = self.connection.cursor(dictionary=True)
+            # Le tabelle temporanee non sopravvivono alla riconnessione
+            self._staging_tables.clear()
+
+    def close(self) -> None:
+        self.cursor.close()
+        self.connection.close()
+
+class SQLiteStorage(StorageBackend):
+    """Backend SQLite: upsert con executemany ... ON CONFLICT DO UPDATE in un'unica transazione."""
+    name = 'sqlite'
+    errors = (sqlite3.Error,)
+    date_expression = 'date(data_ora_rilevazione)'
+    time_expression = 'time(data_ora_rilevazione)'
+    # SQLite non ha CREATE OR REPLACE VIEW: la vista si ricrea solo nella migrazione
+    create_view = 'CREATE VIEW IF NOT EXISTS'
+    # Alias del rowid: SQLite assegna il successivo
+    type_id_column = 'INTEGER PRIMARY KEY'
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv('DB_PATH', 'fiumesicuro.sqlite')
+        # Stesso formato testuale su tutte le versioni di Python (gli adattatori predefiniti sono deprecati)
+        sqlite3.register_adapter(datetime, lambda v: v.isoformat(' '))
+        sqlite3.register_adapter(date, lambda v: v.isoformat())
+        sqlite3.register_adapter(dt_time, lambda v: v.isoformat())
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        logger.info(f"Database SQLite aperto: {self.path}")
+
+    def ensure_schema(self) -> None:
+        for sql in EMBEDDED_TABLES_SQL + [self.compact_measurements_sql()] + SUPPORT_TABLES_SQL + [
+                self.measurement_types_sql()]:
+            self.connection.execute(sql)
+        self._ensure_measurements_view()
+        self.connection.commit()
+
+    def table_columns(self, table: str) -> List[str]:
+        # table_xinfo elenca anche le colonne generate
+        return [row['name'] for row in self.query(f"PRAGMA table_xinfo({table})")]
+
+    def list_views(self) -> Dict[str, str]:
+        return {row['name']: row['sql'] for row in self.query("SELECT name, sql FROM sqlite_master WHERE type = 'view'")}
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> None:
+        self.connection.execute(sql.replace('%s', '?'), tuple(params))
+
+    def query(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        return [dict(row) for row in self.connection.execute(sql.replace('%s', '?'), tuple(params))]
+
+    def upsert(self, table: str, columns: Sequence[str], key_columns: Sequence[str],
+               rows: Sequence[Sequence[Any]]) -> None:
+        if not rows:
+            return
+        aggiornamenti = ", ".join(f"{c} = excluded.{c}" for c in columns if c not in key_columns)
+        sql = (
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+            f" ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {aggiornamenti}"
+        )
+        self.connection.executemany(sql, rows)
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def rollback(self) -> None:
+        self.connection.rollback()
+
+    def close(self) -> None:
+        self.connection.close()
+
+class DuckDBStorage(StorageBackend):
+    """Backend DuckDB: upsert di blocco scansionando un DataFrame registrato nella connessione."""
+    name = 'duckdb'
+    date_expression = 'CAST(data_ora_rilevazione AS DATE)'
+    time_expression = 'CAST(data_ora_rilevazione AS TIME)'
+    type_id_column = "SMALLINT NOT NULL PRIMARY KEY DEFAULT nextval('tipi_misurazione_id')"
+
+    def __init__(self, path: Optional[str] = None):
+        if duckdb is None:
+            raise ImportError("Il backend DuckDB richiede il pacchetto duckdb")
+        self.errors = (duckdb.Error,)
+        self.path = path or os.getenv('DB_PATH', 'fiumesicuro.duckdb')
+        self.connection = duckdb.connect(self.path)
+        self.connection.begin()
+        logger.info(f"Database DuckDB aperto: {self.path}")
+
+    def ensure_schema(self) -> None:
+        sequenza = "CREATE SEQUENCE IF NOT EXISTS tipi_misurazione_id"
+        for sql in EMBEDDED_TABLES_SQL + [self.compact_measurements_sql()] + SUPPORT_TABLES_SQL + [
+                sequenza, self.measurement_types_sql()]:
+            self.connection.execute(sql)
+        self._ensure_measurements_view()
+        self.commit()
+
+    def table_columns(self, table: str) -> List[str]:
+        return [row['colonna'] for row in self.query(
+            "SELECT column_name AS colonna FROM information_schema.columns"
+            " WHERE table_name = %s ORDER BY ordinal_position", (table,)
+        )]
+
+    def list_views(self) -> Dict[str, str]:
+        return {row['view_name']: row['sql'] for row in self.query(
+            "SELECT view_name, sql FROM duckdb_views() WHERE NOT internal"
+        )}
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> None:
+        self.connection.execute(sql.replace('%s', '?'), list(params))
+
+    def query(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        risultato = self.connection.execute(sql.replace('%s', '?'), list(params))
+        colonne = [d[0] for d in risultato.description]
+        return [dict(zip(colonne, row)) for row in risultato.fetchall()]
+
+    def upsert(self, table: str, columns: Sequence[str], key_columns: Sequence[str],
+               rows: Sequence[Sequence[Any]]) -> None:
+        if not rows:
+            return
+        import pandas as pd
+
+        # DuckDB non aggiorna due volte la stessa riga in un'istruzione: vale l'ultima occorrenza
+        posizioni = [columns.index(c) for c in key_columns]
+        univoche = {tuple(r[p] for p in posizioni): r for r in rows}
+        righe = pd.DataFrame(list(univoche.values()), columns=list(columns))
+
+        aggiornamenti = ", ".join(f"{c} = excluded.{c}" for c in columns if c not in key_columns)
+        self.connection.register('_righe_upsert', righe)
+        try:
+            self.connection.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM _righe_upsert"
+                f" ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {aggiornamenti}"
+            )
+        finally:
+            self.connection.unregister('_righe_upsert')
+
+    def commit(self) -> None:
+        self.connection.commit()
+        self.connection.begin()
+
+    def rollback(self) -> None:
+        self.connection.rollback()
+        self.connection.begin()
+
+    def close(self) -> None:
+        self.connection.rollback()
+        self.connection.close()
+
+def create_storage(backend: Optional[str] = None, path: Optional[str] = None) -> StorageBackend:
+    """Crea il backend richiesto (default: variabile d'ambiente DB_BACKEND, altrimenti MySQL)."""
+    backend = backend or os.getenv('DB_BACKEND', 'mysql')
+    if backend == 'mysql':
+        return MySQLStorage()
+    if backend == 'sqlite':
+        return SQLiteStorage(path)
+    if backend == 'duckdb':
+        return DuckDBStorage(path)
+    raise ValueError(f"Backend non supportato: {backend} (ammessi: {', '.join(STORAGE_BACKENDS)})")
@@ -0,0 +1,100 @@
+"""Fixture comuni ai test: item ARPAE sintetici, un client HTTP finto e loader su SQLite."""
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# database.py apre il log in logs/ rispetto alla directory corrente: lo si importa da una directory temporanea
+_WORKDIR = tempfile.mkdtemp(prefix='arpae-test-')
+os.makedirs(os.path.join(_WORKDIR, 'logs'))
+_CWD = os.getcwd()
+os.chdir(_WORKDIR)
+try:
+    from database import ArpaeDataLoader, LoaderConfig  # noqa: E402
+finally:
+    os.chdir(_CWD)
+from metrics import IngestMetrics, _labels  # noqa: E402
+from storage import create_storage  # noqa: E402
+
+DATE = '20240105'
+
+SLOTS = [f"{h:02d}{m:02d}" for h in range(24) for m in (0, 30)]
+
+def make_items(n_stations, selected_date=DATE, value=1.0, variable='livello_idro'):
+    """n_stations stazioni con i 48 slot del giorno di una sola variabile."""
+    items = []
+    for s in range(n_stations):
+        items.append({
+            '_id': str(1000 + s),
+            'anagrafica': {
+                'nome': f"Stazione {s}", 'altitudine': 10, 'geometry': {'coordinates': [11.0, 44.0]},
+                'cod_istat': '037006', 'bacino': 'RENO' if s % 2 else 'PO', 'sottobacino': None,
+                'macroarea': 'A' if s % 3 else 'B', 'proprietario': 'ARPAE', 'gestore': 'ARPAE',
+                'comune': 'Bologna', 'provincia': 'BO', 'regione': 'Emilia-Romagna', 'variabili': [variable],
+                'sensori': {variable: {'soglie': [1.0, 2.0, 3.0], 'bacino': 'RENO', 'sottobacino': None,
+                                       'altitudine': 10}}
+            },
+            'dati': {selected_date: {slot: {variable: value + s * 0.01 + i * 0.001} for i, slot in enumerate(SLOTS)}}
+        })
+    return items
+
+class FakeResponse:
+    def __init__(self, body: bytes):
+        self.content = body
+        self.status_code = 200
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class FakeClient:
+    """Client con l'interfaccia di UpstreamClient che risponde con gli item indicati per data.
+
+    Con page restituisce la fetta richiesta; with_total=False omette _meta.total.
+    """
+
+    def __init__(self, items_by_date, with_total=True):
+        self.items_by_date = items_by_date
+        self.with_total = with_total
+        self.calls = []
+
+    def get(self, url, params=None, stream=False):
+        self.calls.append(params)
+        projection = json.loads(params['projection'])
+        selected_date = next(k.split('.')[1] for k in projection if k.startswith('dati.'))
+        items = self.items_by_date.get(selected_date, [])
+        risposta = {'_items': items}
+        if 'page' in params:
+            inizio = (params['page'] - 1) * params['max_results']
+            risposta['_items'] = items[inizio:inizio + params['max_results']]
+        if self.with_total:
+            risposta['_meta'] = {'total': len(items)}
+        return FakeResponse(json.dumps(risposta).encode('utf-8'))
+
+def metric(metrics, name, **labels):
+    """Valore corrente di una metrica di IngestMetrics (0 se mai incrementata)."""
+    return metrics._values.get(name, {}).get(_labels(labels), 0)
+
+def count(loader, table):
+    return loader.storage.query(f"SELECT COUNT(*) AS n FROM {table}")[0]['n']
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'arpae.db')
+
+@pytest.fixture
+def make_loader(db_path):
+    """Crea loader su un database SQLite temporaneo; le opzioni sono campi di LoaderConfig."""
+    def crea(client=None, storage=None, stop_event=None, **opzioni):
+        return ArpaeDataLoader(LoaderConfig(**opzioni), storage=storage or create_storage('sqlite', db_path),
+                               metrics=IngestMetrics(), client=client or FakeClient({}), stop_event=stop_event)
+    return crea
@@ -0,0 +1,45 @@
+from async_fetch import iter_paged_items, merge_items
+from metrics import IngestMetrics
+from upstream import PAGE_SORT
+
+from conftest import DATE, FakeClient, make_items
+
+def test_merge_items_joins_variables_of_the_same_station():
+    livelli = make_items(2)
+    piogge = make_items(1, variable='pioggia', value=0.0)
+    piogge[0]['anagrafica']['nome'] = 'altro nome'
+
+    unite = merge_items([livelli, piogge])
+
+    assert [item['_id'] for item in unite] == ['1000', '1001']
+    assert unite[0]['anagrafica']['nome'] == 'Stazione 0'
+    assert unite[0]['dati'][DATE]['0000'] == {'livello_idro': 1.0, 'pioggia': 0.0}
+    assert unite[1]['dati'][DATE]['0000'] == {'livello_idro': 1.01}
+    # Gli item di partenza non vengono modificati
+    assert livelli[0]['dati'][DATE]['0000'] == {'livello_idro': 1.0}
+
+def test_merge_items_passes_malformed_items_through():
+    senza_id = {'anagrafica': {}}
+    dati_malformati = {'_id': '1000', 'dati': {DATE: ['non', 'un', 'dizionario']}}
+
+    unite = merge_items([[senza_id, dati_malformati], make_items(1)])
+
+    assert senza_id in unite and dati_malformati in unite
+    assert len(unite) == 3
+
+def test_iter_paged_items_returns_every_station_once():
+    client = FakeClient({DATE: make_items(10)})
+
+    items = list(iter_paged_items(DATE, page_size=3, concurrency=2, client=client, metrics=IngestMetrics()))
+
+    assert sorted(item['_id'] for item in items) == [str(1000 + i) for i in range(10)]
+    assert sorted(params['page'] for params in client.calls) == [1, 2, 3, 4]
+    assert all(params['sort'] == PAGE_SORT for params in client.calls)
+
+def test_iter_paged_items_without_total_follows_pages_until_a_short_one():
+    client = FakeClient({DATE: make_items(7)}, with_total=False)
+
+    items = list(iter_paged_items(DATE, page_size=3, concurrency=2, client=client, metrics=IngestMetrics()))
+
+    assert [item['_id'] for item in items] == [str(1000 + i) for i in range(7)]
+    assert [params['page'] for params in client.calls] == [1, 2, 3]
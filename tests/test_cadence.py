@@ -0,0 +1,48 @@
+from datetime import datetime
+
+from cadence import FloodWatch, PublicationModel
+
+def _ore(ora, minuti=0):
+    return datetime(2024, 1, 5, ora, minuti)
+
+def _model():
+    return PublicationModel(default_lag=600, dense_interval=60, dense_window=900, min_wait=30, max_wait=1800)
+
+def test_next_delay_without_observations_polls_densely():
+    assert _model().next_delay(_ore(10)) == 60
+
+def test_next_delay_waits_for_expected_publication():
+    modello = _model()
+    modello.observe(_ore(10), _ore(10, 5))
+
+    # Prossimo slot 10:30 atteso con 600 s di ritardo, cioè alle 10:40
+    assert modello.next_publication() == _ore(10, 40)
+    assert modello.next_delay(_ore(10, 20)) == 1200
+    assert modello.next_delay(datetime(2024, 1, 5, 10, 39, 50)) == 30
+
+def test_next_delay_dense_then_backs_off_when_late():
+    modello = _model()
+    modello.observe(_ore(10), _ore(10, 5))
+
+    assert modello.next_delay(_ore(10, 45)) == 60
+    assert modello.next_delay(_ore(11, 40)) == 1800
+
+def test_observed_lag_replaces_default():
+    modello = _model()
+    modello.observe(_ore(10), _ore(10, 5))
+    assert not modello.observe(_ore(10), _ore(10, 35))
+    # Lo slot 10:30 compare tra le 10:35 e le 10:45: ritardo stimato di 10 minuti
+    assert modello.observe(_ore(10, 30), _ore(10, 45))
+
+    assert modello.expected_lag() == 600
+    assert modello.next_publication() == _ore(11, 10)
+
+def test_flood_watch_alerts_recent_stations_near_threshold():
+    watch = FloodWatch(margin=0.5, burst_interval=120, max_age=3600)
+    stazioni = {
+        '1000': {'bacino': 'RENO', 'sottobacino': None, 'soglie': {'livello_idro': (1.0, 2.0, 3.0)}},
+        '1001': {'bacino': 'PO', 'sottobacino': 'TARO', 'soglie': {'livello_idro': (1.0, 2.0, 3.0)}},
+    }
+    ultimi = {('1000', 'livello_idro'): (_ore(12), 1.6), ('1001', 'livello_idro'): (_ore(9), 2.9)}
+
+    assert watch.alert_basins(stazioni, ultimi) == {('RENO', None)}
@@ -0,0 +1,154 @@
+import json
+import sqlite3
+from datetime import date, datetime
+
+import pytest
+
+import database
+from database import LoaderConfig, decode_day_block
+from storage import create_storage
+from upstream import PAGE_SORT
+
+from conftest import DATE, FakeClient, count, make_items, metric
+
+@pytest.fixture(autouse=True)
+def no_replay_backoff(monkeypatch):
+    monkeypatch.setattr(database, 'REPLAY_BACKOFF_SECONDS', 0)
+
+def _count_commits(storage):
+    commits = []
+    conferma = storage.commit
+
+    def commit():
+        commits.append(1)
+        conferma()
+
+    storage.commit = commit
+    return commits
+
+def _reject_station(storage, station_id, failures=None):
+    """Fa fallire la scrittura della stazione indicata (per failures volte, o sempre)."""
+    scrivi = storage.upsert
+    falliti = []
+
+    def upsert(table, columns, key_columns, rows):
+        if table == 'stazioni' and any(riga[0] == station_id for riga in rows):
+            if failures is None or len(falliti) < failures:
+                falliti.append(1)
+                raise sqlite3.OperationalError('database is locked' if failures else 'valore troppo lungo per nome')
+        scrivi(table, columns, key_columns, rows)
+
+    storage.upsert = upsert
+    return falliti
+
+def test_decode_day_block():
+    giornata = decode_day_block(DATE, {'0000': {'livello_idro': 1.0}, '1330': {'livello_idro': 2.0, 'pioggia': 0.2},
+                                       '0015': {'livello_idro': 3.0}})
+
+    assert giornata.data == date(2024, 1, 5)
+    assert giornata.timestamps == [datetime(2024, 1, 5, 0, 0), datetime(2024, 1, 5, 13, 30),
+                                   datetime(2024, 1, 5, 13, 30), datetime(2024, 1, 5, 0, 15)]
+    assert giornata.ore == ['00:00:00', '13:30:00', '13:30:00', '00:15:00']
+    assert giornata.tipi == ['livello_idro', 'livello_idro', 'pioggia', 'livello_idro']
+    assert giornata.valori == [1.0, 2.0, 0.2, 3.0]
+
+def test_decode_day_block_rejects_invalid_keys():
+    with pytest.raises(ValueError):
+        decode_day_block(DATE, {'ore1': {'livello_idro': 1.0}})
+
+def test_loader_config_validation(monkeypatch):
+    with pytest.raises(ValueError):
+        LoaderConfig(commit_policy='sempre')
+    with pytest.raises(ValueError):
+        LoaderConfig(stream=True, page_size=500)
+    assert LoaderConfig(stream=True, page_size=0).stream
+    # Con più variabili lo streaming non si usa e le pagine restano ammesse
+    assert LoaderConfig(stream=True, page_size=500, variables=['livello_idro', 'pioggia']).page_size == 500
+
+    monkeypatch.delenv('PAGE_SIZE', raising=False)
+    assert LoaderConfig.from_env(stream=True).page_size == 0
+    assert LoaderConfig.from_env(bulk=True).commit_policy == 'run'
+
+@pytest.mark.parametrize('policy, every, commits', [('run', 5000, 1), ('rows', 48, 5)])
+def test_commit_policy(make_loader, policy, every, commits):
+    loader = make_loader(commit_policy=policy, commit_every=every)
+    conferme = _count_commits(loader.storage)
+
+    assert loader.process_data(DATE, items=make_items(4)) == 192
+    assert len(conferme) == commits
+    assert count(loader, 'misurazioni') == 192
+
+def test_unchanged_values_are_skipped(make_loader):
+    # Il confronto con le impronte vale per i giorni recenti, non per le date storiche
+    oggi = date.today().strftime('%Y%m%d')
+    loader = make_loader()
+    loader.process_data(oggi, items=make_items(4, oggi))
+
+    assert loader.process_data(oggi, items=make_items(4, oggi)) == 0
+    assert loader.rows_skipped == 192
+
+def test_replayed_batch_is_written_and_counted_once(make_loader):
+    loader = make_loader(commit_policy='rows', commit_every=48)
+    falliti = _reject_station(loader.storage, '1002', failures=2)
+
+    assert loader.process_data(DATE, items=make_items(4)) == 192
+    assert len(falliti) == 2
+    assert count(loader, 'misurazioni') == 192
+    assert metric(loader.metrics, 'rows_written_total', table='misurazioni') == 192
+    assert metric(loader.metrics, 'rows_written_total', table='stazioni') == 4
+
+def test_rejected_station_is_dead_lettered_once(make_loader):
+    loader = make_loader(commit_policy='run', max_batch_retries=1, incremental=False)
+    _reject_station(loader.storage, '1002')
+
+    for _ in range(2):
+        assert loader.process_data(DATE, items=make_items(4)) == 144
+
+    scarti = loader.storage.query("SELECT data_richiesta, stazione_id, errore FROM scarti")
+    assert scarti == [{'data_richiesta': DATE, 'stazione_id': '1002',
+                       'errore': 'OperationalError: valore troppo lungo per nome'}]
+    assert loader.items_dead_lettered == 2
+
+def test_dead_letter_file_is_written_after_commit(make_loader, tmp_path):
+    percorso = tmp_path / 'scarti.jsonl'
+    items = make_items(3)
+    items[1]['dati'][DATE]['0100']['livello_idro'] = 'n/d'
+    loader = make_loader(commit_policy='run', dead_letter_file=str(percorso), incremental=False)
+
+    loader.dead_letter(items[1], DATE, ValueError('non numerico'))
+    loader.rollback()
+    assert not percorso.exists()
+
+    loader.process_data(DATE, items=items)
+    loader.process_data(DATE, items=items)
+    righe = [json.loads(riga) for riga in percorso.read_text(encoding='utf-8').splitlines()]
+    assert [(r['stazione_id'], r['errore']) for r in righe] == [
+        ('1001', "ValueError: Valore non numerico per livello_idro: 'n/d'")
+    ]
+    assert count(loader, 'scarti') == 0
+
+@pytest.mark.parametrize('write_behind', [False, True])
+def test_close_commits_buffered_rows(make_loader, db_path, write_behind):
+    loader = make_loader(write_behind=write_behind, batch_size=50, incremental=False)
+    for item in make_items(5):
+        loader._process_item(item, DATE)
+    loader.close()
+
+    storage = create_storage('sqlite', db_path)
+    assert storage.query("SELECT COUNT(*) AS n FROM misurazioni")[0]['n'] == 240
+    storage.close()
+
+def test_paged_fetch_loads_every_station(make_loader):
+    client = FakeClient({DATE: make_items(10)})
+    loader = make_loader(client=client, page_size=3, fetch_concurrency=2)
+
+    assert loader.process_data(DATE) == 480
+    assert count(loader, 'stazioni') == 10
+    assert all(params['sort'] == PAGE_SORT for params in client.calls)
+
+def test_single_request_without_paging(make_loader):
+    client = FakeClient({DATE: make_items(4)})
+    loader = make_loader(client=client, page_size=0)
+
+    assert loader.process_data(DATE) == 192
+    assert [('page' in params, 'sort' in params) for params in client.calls] == [(False, False)]
@@ -0,0 +1,18 @@
+from shards import assign_shards, shard_id
+
+def test_assign_shards_balances_station_counts():
+    gruppi = assign_shards({'A': 10, 'B': 6, 'C': 5, 'D': 1}, 2)
+
+    assert gruppi == [['A', 'D'], ['B', 'C']]
+
+def test_assign_shards_never_returns_empty_groups():
+    assert assign_shards({'A': 3, 'B': 2}, 5) == [['A'], ['B']]
+    assert assign_shards({}, 3) == []
+
+def test_assign_shards_keeps_missing_values():
+    gruppi = assign_shards({None: 4, 'RENO': 4}, 1)
+
+    assert len(gruppi) == 1 and sorted(gruppi[0], key=str) == [None, 'RENO']
+
+def test_shard_id_ignores_value_order():
+    assert shard_id('bacino', ['RENO', None, 'PO']) == shard_id('bacino', ['PO', 'RENO', None]) == 'bacino:|PO|RENO'
@@ -0,0 +1,73 @@
+from datetime import date, datetime
+
+from snapshots import ABSENT, SnapshotDiff, pack_fingerprint, pack_value, unpack_fingerprint, unpack_value
+
+GIORNO = date(2024, 1, 5)
+
+def _slot(ora, minuti=0):
+    return datetime(2024, 1, 5, ora, minuti)
+
+def test_pack_value_roundtrip():
+    assert unpack_value(pack_value(1.25)) == 1.25
+    assert unpack_value(pack_value('2.5')) == 2.5
+    assert unpack_value(pack_value(None)) is None
+    assert pack_value('n/d') is None
+
+def test_fingerprint_roundtrip_keeps_absent_and_null_slots():
+    diff = SnapshotDiff()
+    diff.diff('1000', GIORNO, [_slot(0), _slot(0, 30), _slot(1)], ['livello_idro', 'livello_idro', 'pioggia'],
+              [1.5, None, 0.0])
+    serie = unpack_fingerprint(pack_fingerprint(diff._pending[('1000', GIORNO)]))
+
+    assert sorted(serie) == ['livello_idro', 'pioggia']
+    livello = serie['livello_idro']
+    assert unpack_value(bytes(livello[0:8])) == 1.5
+    assert unpack_value(bytes(livello[8:16])) is None
+    assert unpack_value(bytes(livello[16:24])) is ABSENT
+
+def test_diff_reports_only_new_or_changed_values():
+    diff = SnapshotDiff()
+    timestamps = [_slot(0), _slot(0, 30)]
+    tipi = ['livello_idro', 'livello_idro']
+
+    assert diff.diff('1000', GIORNO, timestamps, tipi, [1.0, 2.0]) == [(0, ABSENT), (1, ABSENT)]
+    diff.commit()
+    assert diff.diff('1000', GIORNO, timestamps, tipi, [1.0, 2.0]) == []
+    assert diff.diff('1000', GIORNO, timestamps, tipi, [1.0, 2.5]) == [(1, 2.0)]
+
+def test_diff_partial_response_keeps_other_slots():
+    diff = SnapshotDiff()
+    diff.diff('1000', GIORNO, [_slot(0), _slot(0, 30)], ['livello_idro'] * 2, [1.0, 2.0])
+    diff.commit()
+
+    assert diff.diff('1000', GIORNO, [_slot(0, 30)], ['livello_idro'], [2.0]) == []
+    diff.commit()
+    assert diff.latest_values()[('1000', 'livello_idro')] == (_slot(0, 30), 2.0)
+    assert diff.diff('1000', GIORNO, [_slot(0)], ['livello_idro'], [1.0]) == []
+
+def test_diff_always_returns_off_grid_and_non_numeric_values():
+    diff = SnapshotDiff()
+    timestamps = [_slot(0, 15), _slot(1)]
+    diff.diff('1000', GIORNO, timestamps, ['livello_idro'] * 2, [1.0, 'n/d'])
+    diff.commit()
+
+    assert diff.diff('1000', GIORNO, timestamps, ['livello_idro'] * 2, [1.0, 'n/d']) == [(0, ABSENT), (1, ABSENT)]
+
+def test_rollback_discards_pending_fingerprints():
+    diff = SnapshotDiff()
+    diff.diff('1000', GIORNO, [_slot(0)], ['livello_idro'], [1.0])
+    diff.rollback()
+
+    assert diff.pending_rows(datetime.now()) == []
+    assert diff.diff('1000', GIORNO, [_slot(0)], ['livello_idro'], [1.0]) == [(0, ABSENT)]
+
+def test_load_restores_saved_fingerprints():
+    diff = SnapshotDiff()
+    diff.diff('1000', GIORNO, [_slot(0)], ['livello_idro'], [1.0])
+    righe = [{'stazione_id': r[0], 'data_rilevazione': r[1].isoformat(), 'valori': r[2]}
+             for r in diff.pending_rows(datetime.now())]
+
+    ripristinate = SnapshotDiff()
+    ripristinate.load(righe)
+    assert len(ripristinate) == 1
+    assert ripristinate.diff('1000', GIORNO, [_slot(0)], ['livello_idro'], [1.0]) == []
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+import upstream
+from metrics import IngestMetrics
+from upstream import PAGE_SORT, CircuitBreaker, arpae_params
+
+from conftest import metric
+
+def test_arpae_params_sorts_only_paged_queries():
+    params = arpae_params('20240105')
+    assert 'page' not in params and 'sort' not in params
+    assert json.loads(params['projection']) == {'dati.20240105': 1, 'anagrafica': 1}
+
+    paginata = arpae_params('20240105', max_results=500, page=3)
+    assert paginata['page'] == 3
+    assert paginata['max_results'] == 500
+    assert paginata['sort'] == PAGE_SORT
+
+def test_arpae_params_slots_and_filters():
+    params = arpae_params('20240105', slots=['0000', '0030'], filters={'anagrafica.bacino': 'RENO'})
+    assert json.loads(params['projection']) == {'dati.20240105.0000': 1, 'dati.20240105.0030': 1, 'anagrafica': 1}
+    assert json.loads(params['where']) == {'anagrafica.variabili': 'livello_idro', 'anagrafica.bacino': 'RENO'}
+
+@pytest.fixture
+def clock(monkeypatch):
+    orologio = [1000.0]
+    monkeypatch.setattr(upstream.time, 'monotonic', lambda: orologio[0])
+    return orologio
+
+def test_circuit_opens_after_consecutive_failures(clock):
+    metrics = IngestMetrics()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60, metrics=metrics)
+
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_success()
+    for _ in range(3):
+        breaker.record_failure()
+
+    assert breaker.state == 'open'
+    assert metric(metrics, 'upstream_circuit_state') == 2
+    assert not breaker.allow()
+
+def test_circuit_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60, metrics=IngestMetrics())
+    breaker.record_failure()
+
+    clock[0] += 61
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+def test_circuit_failed_probe_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60, metrics=IngestMetrics())
+    breaker.record_failure()
+    clock[0] += 61
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    clock[0] += 61
+    assert breaker.allow()
+
+def test_circuit_release_frees_the_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60, metrics=IngestMetrics())
+    breaker.record_failure()
+    clock[0] += 61
+    assert breaker.allow()
+
+    breaker.release()
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+from metrics import IngestMetrics
+from writebehind import WriteBehindQueue
+
+def test_drain_writes_all_rows_in_blocks():
+    blocchi = []
+    coda = WriteBehindQueue(blocchi.append, flush_rows=4, flush_interval=60, max_rows=100, metrics=IngestMetrics())
+    coda.put([(i,) for i in range(10)])
+    coda.drain()
+
+    assert [riga for blocco in blocchi for riga in blocco] == [(i,) for i in range(10)]
+    assert all(len(blocco) <= 4 for blocco in blocchi)
+    coda.close()
+
+def test_put_blocks_while_queue_is_full():
+    scritte = []
+    sblocca = threading.Event()
+
+    def scrivi(righe):
+        sblocca.wait(5)
+        scritte.extend(righe)
+
+    coda = WriteBehindQueue(scrivi, flush_rows=2, flush_interval=60, max_rows=4, metrics=IngestMetrics())
+    # Il writer prende il primo blocco e resta fermo nella scrittura; la coda si riempie
+    coda.put([(1,), (2,)])
+    coda.put([(3,), (4,)])
+    coda.put([(5,), (6,)])
+
+    produttore = threading.Thread(target=coda.put, args=([(7,)],))
+    produttore.start()
+    produttore.join(0.2)
+    assert produttore.is_alive()
+
+    sblocca.set()
+    produttore.join(5)
+    assert not produttore.is_alive()
+    coda.close()
+    assert sorted(scritte) == [(i,) for i in range(1, 8)]
+
+def test_write_error_is_raised_on_drain_and_cleared_by_discard():
+    def scrivi(righe):
+        raise RuntimeError('database non disponibile')
+
+    coda = WriteBehindQueue(scrivi, flush_rows=2, flush_interval=60, max_rows=10, metrics=IngestMetrics())
+    coda.put([(1,), (2,)])
+    with pytest.raises(RuntimeError):
+        coda.drain()
+
+    coda.discard()
+    coda.write = lambda righe: None
+    coda.put([(3,)])
+    coda.drain()
+    coda.close()
+
+def test_close_writes_pending_rows():
+    scritte = []
+    coda = WriteBehindQueue(scritte.extend, flush_rows=100, flush_interval=60, max_rows=100, metrics=IngestMetrics())
+    coda.put([(1,), (2,), (3,)])
+    coda.close()
+
+    assert scritte == [(1,), (2,), (3,)]
@@ -0,0 +1,256 @@
+"""Client HTTP verso l'API ARPAE condiviso dal loader e dall'applicazione web.
+
+UpstreamClient usa una sessione requests con connessioni keep-alive in pool,
+timeout separati di connessione e lettura, ritentativi con backoff esponenziale
+e jitter e un circuit breaker che, mentre ARPAE non risponde, fa fallire subito
+le richieste invece di attendere ogni volta i timeout. Lo stato del client
+finisce nelle metriche (upstream_*).
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS, IngestMetrics
+
+logger = logging.getLogger(__name__)
+
+ARPAE_API_URL = "https://apps.arpae.it/REST/meteo_osservati"
+
+# Variabile delle stazioni idrometriche importate per default
+DEFAULT_VARIABLE = 'livello_idro'
+
+# Ordinamento stabile delle query paginate (l'ordine naturale cambia con gli aggiornamenti)
+PAGE_SORT = '[("_id", 1)]'
+
+# Risposte temporanee per cui vale la pena ritentare
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Valore della metrica upstream_circuit_state per ogni stato
+CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+def basin_filter(basins) -> Dict[str, Any]:
+    """Condizione della where per le stazioni dei bacini (bacino, sottobacino) indicati."""
+    condizioni = []
+    for bacino, sottobacino in sorted(basins, key=lambda b: (b[0], b[1] or '')):
+        condizione = {"anagrafica.bacino": bacino}
+        if sottobacino:
+            condizione["anagrafica.sottobacino"] = sottobacino
+        condizioni.append(condizione)
+    return {"$or": condizioni}
+
+def field_filter(field: str, values) -> Dict[str, Any]:
+    """Condizione della where per le stazioni con anagrafica.<field> tra i valori indicati (None: campo assente)."""
+    return {"$or": [{f"anagrafica.{field}": valore} for valore in sorted(values, key=lambda v: (v is None, str(v)))]}
+
+def arpae_params(selected_date: str, variable: str = DEFAULT_VARIABLE, max_results: int = 100000,
+                 page: Optional[int] = None, slots: Optional[List[str]] = None,
+                 filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Parametri della query ARPAE: stazioni che misurano variable, con anagrafica e dati del giorno.
+
+    Con page si chiede la pagina indicata (da 1) di max_results stazioni,
+    ordinate per _id: le pagine scaricate in parallelo restano disgiunte anche
+    se ARPAE aggiorna la collezione nel frattempo. Con slots la proiezione si
+    limita a quelle chiavi HHMM (dati.YYYYMMDD.HHMM);
+    filters aggiunge condizioni Mongo alla where (es. solo alcuni bacini).
+    """
+    if slots:
+        projection = {f"dati.{selected_date}.{slot}": 1 for slot in slots}
+    else:
+        projection = {f"dati.{selected_date}": 1}
+    projection["anagrafica"] = 1
+    where = {"anagrafica.variabili": variable}
+    where.update(filters or {})
+    params = {
+        "where": json.dumps(where),
+        "projection": json.dumps(projection),
+        "max_results": max_results
+    }
+    if page is not None:
+        params["page"] = page
+        params["sort"] = PAGE_SORT
+    return params
+
+class CircuitOpenError(requests.RequestException):
+    """Richiesta rifiutata senza contattare ARPAE perché il circuito è aperto."""
+
+class CircuitBreaker:
+    """Circuit breaker thread-safe a tre stati (closed, open, half_open).
+
+    Dopo failure_threshold errori consecutivi il circuito si apre e le richieste
+    falliscono subito per reset_timeout secondi; poi una sola richiesta di prova
+    (half_open) decide se richiuderlo o riaprirlo.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60.0,
+                 metrics: Optional[IngestMetrics] = None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.metrics = metrics or METRICS
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._publish()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def _publish(self) -> None:
+        self.metrics.set('upstream_circuit_state', CIRCUIT_STATES[self._state])
+
+    def _transition(self, state: str) -> None:
+        if state != self._state:
+            logger.warning(f"Circuit breaker ARPAE: {self._state} -> {state}")
+            self._state = state
+            self._publish()
+
+    def allow(self) -> bool:
+        """Indica se una richiesta può partire; in half_open ne lascia passare una sola."""
+        with self._lock:
+            if self._state == 'open':
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._transition('half_open')
+            if self._state == 'half_open':
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._transition('closed')
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == 'half_open' or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._transition('open')
+
+    def release(self) -> None:
+        """Libera la richiesta di prova terminata senza esito (es. per un'eccezione imprevista)."""
+        with self._lock:
+            self._probe_in_flight = False
+
+class UpstreamClient:
+    """Client HTTP resiliente per l'API ARPAE.
+
+    I parametri non indicati vengono letti dall'ambiente: ARPAE_CONNECT_TIMEOUT (5 s),
+    ARPAE_READ_TIMEOUT (60 s), ARPAE_MAX_RETRIES (3), ARPAE_BACKOFF_BASE (1 s),
+    ARPAE_BACKOFF_MAX (30 s), ARPAE_CIRCUIT_THRESHOLD (5), ARPAE_CIRCUIT_RESET (60 s)
+    e ARPAE_POOL_SIZE (10 connessioni).
+    """
+
+    def __init__(self, connect_timeout: Optional[float] = None, read_timeout: Optional[float] = None,
+                 max_retries: Optional[int] = None, backoff_base: Optional[float] = None,
+                 backoff_max: Optional[float] = None, pool_size: Optional[int] = None,
+                 breaker: Optional[CircuitBreaker] = None, metrics: Optional[IngestMetrics] = None):
+        self.connect_timeout = connect_timeout or float(os.getenv('ARPAE_CONNECT_TIMEOUT', '5'))
+        self.read_timeout = read_timeout or float(os.getenv('ARPAE_READ_TIMEOUT', '60'))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('ARPAE_MAX_RETRIES', '3'))
+        self.backoff_base = backoff_base or float(os.getenv('ARPAE_BACKOFF_BASE', '1'))
+        self.backoff_max = backoff_max or float(os.getenv('ARPAE_BACKOFF_MAX', '30'))
+        self.metrics = metrics or METRICS
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=int(os.getenv('ARPAE_CIRCUIT_THRESHOLD', '5')),
+            reset_timeout=float(os.getenv('ARPAE_CIRCUIT_RESET', '60')),
+            metrics=self.metrics
+        )
+
+        pool_size = pool_size or int(os.getenv('ARPAE_POOL_SIZE', '10'))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _backoff(self, tentativo: int, response: Optional[requests.Response] = None) -> float:
+        """Attesa prima del ritentativo: Retry-After se indicato, altrimenti backoff esponenziale con jitter."""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** tentativo))
+
+    def get(self, url: str, params: Optional[Dict[str, Any]] = None, stream: bool = False) -> requests.Response:
+        """Esegue una GET con timeout, ritentativi e circuit breaker.
+
+        Restituisce solo risposte 2xx; gli altri esiti sollevano una
+        requests.RequestException (CircuitOpenError se il circuito è aperto).
+        Con stream=True si ritenta solo fino all'arrivo degli header: un errore
+        durante la lettura del corpo resta a carico del chiamante.
+        """
+        tentativo = 0
+        while True:
+            if not self.breaker.allow():
+                self.metrics.inc('upstream_requests_total', outcome='rejected')
+                raise CircuitOpenError(f"Circuito aperto: richiesta a {url} non eseguita")
+
+            response = None
+            registrato = False
+            try:
+                response = self.session.get(url, params=params, stream=stream,
+                                            timeout=(self.connect_timeout, self.read_timeout))
+                if response.status_code not in RETRY_STATUS:
+                    # Un 4xx è un errore della richiesta, non di ARPAE: non apre il circuito
+                    self.breaker.record_success()
+                    registrato = True
+                    response.raise_for_status()
+                    self.metrics.inc('upstream_requests_total', outcome='ok')
+                    return response
+                errore: requests.RequestException = requests.HTTPError(
+                    f"{response.status_code} dall'API ARPAE", response=response
+                )
+                response.close()
+                self.breaker.record_failure()
+                registrato = True
+            except requests.HTTPError:
+                self.metrics.inc('upstream_requests_total', outcome='error')
+                raise
+            except requests.RequestException as e:
+                # Connessione e timeout, ma anche un corpo troncato (ChunkedEncodingError, ContentDecodingError)
+                errore = e
+                self.breaker.record_failure()
+                registrato = True
+            finally:
+                # Un'eccezione imprevista non deve lasciare occupata per sempre la richiesta di prova
+                if not registrato:
+                    self.breaker.release()
+
+            if tentativo >= self.max_retries:
+                self.metrics.inc('upstream_requests_total', outcome='error')
+                raise errore
+
+            attesa = self._backoff(tentativo, response)
+            tentativo += 1
+            self.metrics.inc('upstream_retries_total')
+            logger.warning(f"Richiesta ad ARPAE fallita ({errore}), tentativo {tentativo}/{self.max_retries} "
+                           f"tra {attesa:.1f}s")
+            time.sleep(attesa)
+
+    def close(self) -> None:
+        self.session.close()
+
+_client: Optional[UpstreamClient] = None
+_client_lock = threading.Lock()
+
+def upstream_client() -> UpstreamClient:
+    """Client condiviso dal processo, creato al primo uso (dopo il caricamento del .env)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = UpstreamClient()
+        return _client
@@ -0,0 +1,137 @@
+"""Coda di scrittura differita (write-behind) delle misurazioni.
+
+WriteBehindQueue separa la decodifica delle stazioni dalla scrittura sul
+database: il loader accoda le righe e prosegue con il download e la
+decodifica, mentre un thread dedicato le raggruppa e le scrive quando sono
+almeno flush_rows o quando la più vecchia attende da flush_interval secondi.
+La coda è limitata a max_rows righe: oltre, put attende che il writer ne
+smaltisca una parte (backpressure), così un picco di risposte ARPAE non fa
+crescere la memoria senza limite.
+
+Il thread scrive sulla stessa connessione del loader, serializzato da un
+lock, quindi le righe restano nella transazione corrente: prima del commit il
+loader chiama drain, che attende la scrittura di tutte le righe accodate. Un
+errore di scrittura viene sollevato nel thread del loader alla put o alla
+drain successiva, e discard lo azzera insieme alle righe in attesa dopo il
+rollback.
+"""
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+from metrics import METRICS, IngestMetrics
+
+logger = logging.getLogger(__name__)
+
+class WriteBehindQueue:
+    """Coda limitata di righe scritte in blocchi da un thread dedicato."""
+
+    def __init__(self, write: Callable[[List[tuple]], None], flush_rows: int, flush_interval: float,
+                 max_rows: int, metrics: Optional[IngestMetrics] = None):
+        self.write = write
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_rows = max(max_rows, flush_rows)
+        self.metrics = metrics or METRICS
+        self._cond = threading.Condition()
+        self._rows: List[tuple] = []
+        # Istante (monotonic) in cui è arrivata la riga più vecchia in attesa
+        self._oldest: Optional[float] = None
+        self._writing = False
+        self._flush_requested = False
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='arpae-writer', daemon=True)
+        self._thread.start()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _publish(self) -> None:
+        self.metrics.set('write_queue_rows', len(self._rows))
+
+    def put(self, rows: List[tuple]) -> None:
+        """Accoda le righe; se la coda è piena attende che il writer ne scriva una parte."""
+        if not rows:
+            return
+        with self._cond:
+            self._raise_error()
+            if self._rows and len(self._rows) + len(rows) > self.max_rows:
+                with self.metrics.time('backpressure'):
+                    while self._rows and len(self._rows) + len(rows) > self.max_rows and self._error is None:
+                        self._cond.wait()
+                self._raise_error()
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.extend(rows)
+            self._publish()
+            self._cond.notify_all()
+
+    def drain(self) -> None:
+        """Scrive subito tutte le righe accodate e attende che il writer abbia finito."""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while (self._rows or self._writing) and self._error is None:
+                self._cond.wait()
+            self._flush_requested = False
+            self._raise_error()
+
+    def discard(self) -> None:
+        """Scarta le righe in attesa e l'eventuale errore (dopo un rollback), attendendo la scrittura in corso."""
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            self._rows = []
+            self._oldest = None
+            self._error = None
+            self._publish()
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        """Scrive le righe rimaste nella transazione corrente (il commit spetta al chiamante) e ferma il thread."""
+        try:
+            self.drain()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._thread.join()
+
+    def _due(self) -> bool:
+        if not self._rows or self._error is not None:
+            return False
+        return (self._flush_requested or self._closed or len(self._rows) >= self.flush_rows
+                or time.monotonic() - self._oldest >= self.flush_interval)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._due():
+                    if self._closed:
+                        return
+                    attesa = None
+                    if self._rows and self._error is None:
+                        attesa = max(0.0, self._oldest + self.flush_interval - time.monotonic())
+                    self._cond.wait(attesa)
+                blocco = self._rows[:self.flush_rows]
+                self._rows = self._rows[self.flush_rows:]
+                if not self._rows:
+                    self._oldest = None
+                self._writing = True
+                self._publish()
+                # Si libera spazio per le put in attesa prima di scrivere
+                self._cond.notify_all()
+
+            try:
+                self.write(blocco)
+            except BaseException as e:
+                logger.error(f"Scrittura differita di {len(blocco)} misurazioni fallita: {str(e)}")
+                with self._cond:
+                    self._error = e
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()